@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# bench_nfs40.py - Compare the RPC transports of the NFSv4.0 server
+#
+# Starts nfs4.0/nfs4server.py once per transport, and has a number of
+# client threads each loop over OPEN (with OPEN_CONFIRM), WRITE, READ and
+# CLOSE of their own file.  Every iteration uses a fresh open owner, so a
+# failed operation does not throw off the seqids of the next one.
+# The time per loop, and the status of each operation, is printed per
+# transport.
+
+import sys
+import os
+import time
+import socket
+import threading
+import subprocess
+from optparse import OptionParser
+
+# The nfs4.0 tree has its own rpc package, so use_local is no good here
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+nfs40 = os.path.join(top, "nfs4.0")
+sys.path[1:1] = [nfs40, os.path.join(nfs40, "lib"), os.path.join(top, "xdr")]
+
+import nfs4lib
+from xdrdef.nfs4_const import *
+
+nfs4lib.SHOW_TRAFFIC = 0
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(transport, port):
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(nfs40, "nfs4server.py"),
+                               "--transport", transport, "", str(port)],
+                              stdout=subprocess.DEVNULL, cwd=nfs40)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return server
+        except socket.error:
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("%s server did not start" % transport)
+
+def run_client(index, port, iterations, data, results):
+    c = nfs4lib.NFS4Client(b"bench%i" % index, b"127.0.0.1", port,
+                           homedir=[])
+    c.init_connection()
+    path = [b"file%i" % index]
+    status = {}
+    def count(op, res):
+        key = (op, nfsstat4[res.status])
+        status[key] = status.get(key, 0) + 1
+    fh, stateid = c.create_confirm(b"create", path,
+                                   deny=OPEN4_SHARE_DENY_NONE)
+    c.close_file(b"create", fh, stateid)
+    start = time.perf_counter()
+    for i in range(iterations):
+        owner = b"owner%i" % i
+        res = c.open_file(owner, path, access=OPEN4_SHARE_ACCESS_BOTH,
+                          deny=OPEN4_SHARE_DENY_NONE)
+        count("OPEN", res)
+        if res.status != NFS4_OK:
+            continue
+        fh, stateid = c.confirm(owner, res)
+        count("WRITE", c.write_file(fh, data, 0, stateid))
+        count("READ", c.read_file(fh, 0, len(data), stateid))
+        count("CLOSE", c.close_file(owner, fh, stateid))
+    results[index] = (time.perf_counter() - start, status)
+
+def time_transport(transport, clients, iterations, data):
+    port = free_port()
+    server = start_server(transport, port)
+    try:
+        results = [None] * clients
+        threads = [threading.Thread(target=run_client,
+                                    args=(i, port, iterations, data, results))
+                   for i in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.kill()
+        server.wait()
+    if None in results:
+        raise RuntimeError("A client failed, see above")
+    status = {}
+    for t, s in results:
+        for key, n in s.items():
+            status[key] = status.get(key, 0) + n
+    return elapsed, status
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--transports", default="legacy,shared",
+                 help="Comma separated server transports (legacy,shared)")
+    p.add_option("--clients", type="int", default=4,
+                 help="Number of client threads (4)")
+    p.add_option("--iterations", type="int", default=200,
+                 help="OPEN/WRITE/READ/CLOSE loops per client (200)")
+    p.add_option("--size", type="int", default=1000,
+                 help="Bytes per WRITE and READ (1000)")
+    opts, args = p.parse_args()
+    data = b"x" * opts.size
+    loops = opts.clients * opts.iterations
+    print("%8s  %10s  %10s  %s" % ("server", "total", "per loop", "status"))
+    for transport in opts.transports.split(","):
+        elapsed, status = time_transport(transport, opts.clients,
+                                         opts.iterations, data)
+        print("%8s  %9.2fs  %8.0fus  %s" %
+              (transport, elapsed, elapsed * 1e6 / loops,
+               ", ".join("%s %s %i" % (op, s, n)
+                         for (op, s), n in sorted(status.items()))))
+
+if __name__ == "__main__":
+    main()
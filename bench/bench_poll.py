@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# bench_poll.py - Measure cost of a single wakeup of the rpc polling loop
+#
+# A number of idle listening sockets are registered with the poller, along
+# with one busy socketpair.  Each iteration writes a byte to the busy pair,
+# waits in the poller, and reads the byte back, which is exactly what the
+# ConnectionHandler polling thread does for every alarm buzz.
+
+import use_local
+import sys
+import time
+import socket
+import select
+import resource
+from optparse import OptionParser
+
+import rpc.rpc as rpc
+
+FD_SETSIZE = 1024 # Compiled into glibc, not exported by python
+
+def raise_fd_limit(want):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < want:
+        soft = min(want, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+def idle_sockets(count):
+    """Sockets that will never become ready"""
+    out = []
+    for i in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((rpc.LOOPBACK, 0))
+        s.listen(1)
+        s.setblocking(0)
+        out.append(s)
+    return out
+
+def time_select(idle, iterations):
+    """The polling loop as it was, select() over python sets"""
+    a, b = socket.socketpair()
+    readlist = set(s.fileno() for s in idle)
+    readlist.add(b.fileno())
+    try:
+        start = time.perf_counter()
+        for i in range(iterations):
+            a.send(b'\x00')
+            r, w, e = select.select(readlist, set(), readlist)
+            b.recv(1)
+        return time.perf_counter() - start
+    finally:
+        a.close()
+        b.close()
+
+def time_poller(kind, idle, iterations):
+    a, b = socket.socketpair()
+    b.setblocking(0)
+    poller = rpc.make_poller(kind)
+    for s in idle:
+        poller.register(s.fileno())
+    poller.register(b.fileno())
+    try:
+        # Flush out the initial write edges
+        poller.poll(0)
+        start = time.perf_counter()
+        for i in range(iterations):
+            a.send(b'\x00')
+            poller.poll()
+            b.recv(1)
+        return time.perf_counter() - start
+    finally:
+        poller.close()
+        a.close()
+        b.close()
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--sizes", default="100,1000,10000",
+                 help="Comma separated numbers of idle connections "
+                 "(100,1000,10000)")
+    p.add_option("--iterations", type="int", default=2000,
+                 help="Wakeups to time at each size (2000)")
+    opts, args = p.parse_args()
+    sizes = [int(x) for x in opts.sizes.split(",")]
+    limit = raise_fd_limit(max(sizes) + 64)
+    kinds = ["select"] + sorted(rpc.pollers)
+    print("%8s  %s" % ("idle", "".join("%12s" % k for k in kinds)))
+    for size in sizes:
+        if size + 16 > limit:
+            print("%8i  skipped, fd limit is %i" % (size, limit))
+            continue
+        idle = idle_sockets(size)
+        row = []
+        try:
+            for kind in kinds:
+                if kind == "select":
+                    if idle[-1].fileno() + 2 >= FD_SETSIZE:
+                        # select() can not see fds this high
+                        row.append("n/a")
+                        continue
+                    t = time_select(idle, opts.iterations)
+                else:
+                    t = time_poller(kind, idle, opts.iterations)
+                row.append("%.2fus" % (t * 1e6 / opts.iterations))
+        finally:
+            for s in idle:
+                s.close()
+        print("%8i  %s" % (size, "".join("%12s" % x for x in row)))
+
+if __name__ == "__main__":
+    main()
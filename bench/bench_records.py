@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# bench_records.py - Measure reassembly of fragmented RPC records
+#
+# A writer thread streams 1 MiB WRITE-sized records, each split into many
+# record-marked fragments, down a socketpair.  The reader reassembles
+# them with rpc.Pipe.recv_records, and with the original implementation
+# that built the stream up with bytes concatenation.
+
+import use_local
+import sys
+import time
+import socket
+import struct
+import threading
+from optparse import OptionParser
+
+import rpc.rpc as rpc
+
+class LegacyPipe(rpc.Pipe):
+    """The receive path as it was before recv_into was used"""
+    def __init__(self, *args, **kwargs):
+        rpc.Pipe.__init__(self, *args, **kwargs)
+        self._read_buf = b''
+        self._packet_buf = []
+
+    def recv_records(self, count):
+        data = self._s.recv(count)
+        if not data:
+            return None
+        out = []
+        self._read_buf += data
+        while self._read_buf:
+            buf = self._read_buf
+            if len(buf) < 4:
+                break
+            packetlen = struct.unpack('>L', buf[0:4])[0]
+            last = 0x80000000 & packetlen
+            packetlen &= 0x7fffffff
+            packetlen += 4
+            if len(buf) < packetlen:
+                break
+            self._packet_buf.append(buf[4:packetlen])
+            self._read_buf = buf[packetlen:]
+            if last:
+                record = b''.join(self._packet_buf)
+                self._packet_buf = []
+                out.append(record)
+        return out
+
+def make_stream(size, fragsize):
+    """A single record of the given size, split into fragments"""
+    record = bytes(range(256)) * (size // 256)
+    out = []
+    for i in range(0, len(record), fragsize):
+        chunk = record[i:i + fragsize]
+        last = 0x80000000 if i + fragsize >= len(record) else 0
+        out.append(struct.pack('>L', last | len(chunk)) + chunk)
+    return record, b''.join(out)
+
+def writer(sock, stream, count):
+    for i in range(count):
+        sock.sendall(stream)
+    sock.close()
+
+def time_pipe(klass, record, stream, count, rsize):
+    a, b = socket.socketpair()
+    pipe = klass(b, None)
+    t = threading.Thread(target=writer, args=(a, stream, count))
+    start = time.perf_counter()
+    t.start()
+    got = 0
+    while got < count:
+        records = pipe.recv_records(rsize)
+        if records is None:
+            raise RuntimeError("Connection closed after %i records" % got)
+        for r in records:
+            if r != record:
+                raise RuntimeError("Record %i was garbled" % got)
+        got += len(records)
+    elapsed = time.perf_counter() - start
+    t.join()
+    b.close()
+    return elapsed
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--size", type="int", default=1 << 20,
+                 help="Size of each record (1 MiB)")
+    p.add_option("--fragments", default="1,16,256",
+                 help="Comma separated fragment counts per record (1,16,256)")
+    p.add_option("--records", type="int", default=50,
+                 help="Records to send for each test (50)")
+    p.add_option("--rsize", type="int", default=4096,
+                 help="count passed to recv_records (4096)")
+    opts, args = p.parse_args()
+    print("%10s %10s %14s %14s" % ("fragments", "fragsize", "legacy", "recv_into"))
+    for frags in [int(x) for x in opts.fragments.split(",")]:
+        fragsize = opts.size // frags
+        record, stream = make_stream(opts.size, fragsize)
+        row = []
+        for klass in (LegacyPipe, rpc.Pipe):
+            t = time_pipe(klass, record, stream, opts.records, opts.rsize)
+            mb = opts.records * len(stream) / float(1 << 20)
+            row.append("%.0f MiB/s" % (mb / t))
+        print("%10i %10i %14s %14s" % (frags, fragsize, row[0], row[1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# bench_startup.py - Measure how long the nfs4.1 tools take to start
+#
+# Runs "testserver.py --showcodes" and "nfs4server.py --help" a number of
+# times each, and prints the best and median wall clock time.  Both
+# import everything the tool needs before doing their little bit of
+# work.  By default the byte code cached in __pycache__ is used, and
+# written if missing, as on a second run of a tool.  With --no-write,
+# nothing is written, as where the tree is not writable, or with
+# PYTHONDONTWRITEBYTECODE set, so only what the build left there is used.
+
+import os
+import sys
+import time
+import subprocess
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+nfs41 = os.path.join(os.path.dirname(here), "nfs4.1")
+
+commands = [
+    ("testserver --showcodes", ["testserver.py", "--showcodes"]),
+    ("nfs4server --help", ["nfs4server.py", "--help"]),
+    ]
+
+def run(args, write):
+    env = dict(os.environ)
+    if write:
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+    else:
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable] + args, cwd=nfs41, env=env,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--count", type="int", default=10,
+                 help="Runs of each command (10)")
+    p.add_option("--no-write", action="store_true", default=False,
+                 help="Do not write byte code to __pycache__")
+    opts, args = p.parse_args()
+    print("%24s %10s %10s" % ("command", "best", "median"))
+    for name, args in commands:
+        write = not opts.no_write
+        if write:
+            run(args, write) # Fill __pycache__
+        times = sorted(run(args, write) for i in range(opts.count))
+        print("%24s %8.0fms %8.0fms" %
+              (name, times[0] * 1e3, times[len(times) // 2] * 1e3))
+
+if __name__ == "__main__":
+    main()
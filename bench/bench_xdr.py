@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# bench_xdr.py - Measure the cost of the generated XDR codecs
+#
+# Builds typical COMPOUNDs, both calls and replies, and times packing them
+# with nfs4lib.FancyNFS4Packer and unpacking them with FancyNFS4Unpacker,
+# just as the client and server do.  Also timed are dict2fattr and
+# fattr2dict, and the RPC call and reply headers.  For each case the
+# number of operations per second, and the peak memory allocated by a
+# single operation (as seen by tracemalloc) are reported.
+#
+# With --save the results are written out as JSON, which a later run
+# given --compare checks against, reporting any case that got slower or
+# allocates more by more than --tolerance, and exiting with status 1.
+# Run it before and after changing xdrgen.
+
+import use_local
+import os
+import sys
+import json
+import time
+import platform
+import tracemalloc
+from optparse import OptionParser
+
+# The NFSv4.1 codecs are generated under nfs4.1
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.join(os.path.dirname(here), "nfs4.1"))
+
+import nfs4lib
+import rpc.rpc as rpc
+import rpc.rpc_const as rpc_const
+import rpc.rpc_type as rpc_type
+from rpc.rpc_pack import RPCPacker
+from xdrdef.nfs4_const import *
+from xdrdef.nfs4_type import *
+from xdrdef.nfs4_pack import NFS4Packer, NFS4Unpacker
+from xdrdef.pnfs_block_const import PNFS_BLOCK_READWRITE_DATA
+from xdrdef.pnfs_block_type import pnfs_block_layout4, pnfs_block_extent4
+from xdrdef.pnfs_block_pack import PNFS_BLOCKPacker, PNFS_BLOCKUnpacker
+
+sessionid = b"s" * 16
+fh = b"f" * 32
+stateid = stateid4(1, b"x" * 12)
+deviceid = b"d" * 16
+ls_attrs = (1 << FATTR4_TYPE | 1 << FATTR4_CHANGE | 1 << FATTR4_SIZE |
+            1 << FATTR4_FSID | 1 << FATTR4_FILEID | 1 << FATTR4_MODE |
+            1 << FATTR4_NUMLINKS | 1 << FATTR4_OWNER |
+            1 << FATTR4_OWNER_GROUP | 1 << FATTR4_RAWDEV |
+            1 << FATTR4_SPACE_USED | 1 << FATTR4_TIME_ACCESS |
+            1 << FATTR4_TIME_METADATA | 1 << FATTR4_TIME_MODIFY)
+
+def file_attrs(fileid):
+    """The attributes an "ls -l" asks for, as a {bitnum: value} dict"""
+    now = nfstime4(1500000000, 999)
+    return {FATTR4_TYPE: NF4REG,
+            FATTR4_CHANGE: fileid * 7,
+            FATTR4_SIZE: 4096,
+            FATTR4_FSID: fsid4(1, 1),
+            FATTR4_FILEID: fileid,
+            FATTR4_MODE: 0o644,
+            FATTR4_NUMLINKS: 1,
+            FATTR4_OWNER: b"root",
+            FATTR4_OWNER_GROUP: b"root",
+            FATTR4_RAWDEV: specdata4(0, 0),
+            FATTR4_SPACE_USED: 4096,
+            FATTR4_TIME_ACCESS: now,
+            FATTR4_TIME_METADATA: now,
+            FATTR4_TIME_MODIFY: now,
+            }
+
+def arg(op, **kwargs):
+    return nfs_argop4(globals()["OP_" + op.upper()], **kwargs)
+
+def res(op, **kwargs):
+    return nfs_resop4(globals()["OP_" + op.upper()], **kwargs)
+
+def file_layout():
+    return nfsv4_1_file_layout4(deviceid, 0x10000, 0, 0, [fh] * 4)
+
+def block_layout(extents):
+    size = 1 << 20
+    return pnfs_block_layout4([pnfs_block_extent4(deviceid, i * size, size,
+                                                  (i + 7) * size,
+                                                  PNFS_BLOCK_READWRITE_DATA)
+                               for i in range(extents)])
+
+def compounds(opts):
+    """[(name, (args, res, layout))] of the COMPOUNDs to time
+
+    Each layout is (value, packer class, unpacker class, type name) of
+    the body of a LAYOUTGET reply, or None.
+    """
+    ok = NFS4_OK
+    sequence = arg("sequence", opsequence=SEQUENCE4args(sessionid, 7, 3, 15,
+                                                       False))
+    sequence_res = res("sequence", opsequence=SEQUENCE4res(
+        ok, SEQUENCE4resok(sessionid, 7, 3, 15, 15, 0)))
+    putfh = arg("putfh", opputfh=PUTFH4args(fh))
+    putfh_res = res("putfh", opputfh=PUTFH4res(ok))
+    getfh_res = res("getfh", opgetfh=GETFH4res(ok, GETFH4resok(fh)))
+    getattr_arg = arg("getattr", opgetattr=GETATTR4args(ls_attrs))
+    getattr_res = res("getattr", opgetattr=GETATTR4res(
+        ok, GETATTR4resok(file_attrs(2))))
+    data = bytes(opts.io_size)
+
+    read = ([sequence, putfh,
+             arg("read", opread=READ4args(stateid, 0, opts.io_size))],
+            [sequence_res, putfh_res,
+             res("read", opread=READ4res(ok, READ4resok(False, data)))])
+    write = ([sequence, putfh,
+              arg("write", opwrite=WRITE4args(stateid, 0, UNSTABLE4, data))],
+             [sequence_res, putfh_res,
+              res("write", opwrite=WRITE4res(
+                  ok, WRITE4resok(opts.io_size, UNSTABLE4, b"verifier")))])
+    getattrs = ([sequence, putfh, getattr_arg],
+                [sequence_res, putfh_res, getattr_res])
+    entries = [entry4(i + 3, b"file%08i" % i, file_attrs(i + 3), None)
+               for i in range(opts.entries)]
+    readdir = ([sequence, putfh,
+                arg("readdir", opreaddir=READDIR4args(0, b"", 8192, 32768,
+                                                      ls_attrs))],
+               [sequence_res, putfh_res,
+                res("readdir", opreaddir=READDIR4res(
+                    ok, READDIR4resok(b"verifier",
+                                      dirlist4(entries, True))))])
+    how = openflag4(OPEN4_CREATE, how=createhow4(
+        UNCHECKED4, createattrs={FATTR4_MODE: 0o644}))
+    opens = ([sequence, putfh,
+              arg("open", opopen=OPEN4args(
+                  0, OPEN4_SHARE_ACCESS_BOTH, OPEN4_SHARE_DENY_NONE,
+                  open_owner4(1, b"owner"), how,
+                  open_claim4(CLAIM_NULL, file=b"name"))),
+              arg("getfh"), getattr_arg],
+             [sequence_res, putfh_res,
+              res("open", opopen=OPEN4res(ok, OPEN4resok(
+                  stateid, change_info4(True, 1, 2),
+                  OPEN4_RESULT_LOCKTYPE_POSIX, 1 << FATTR4_MODE,
+                  open_delegation4(OPEN_DELEGATE_NONE)))),
+              getfh_res, getattr_res])
+    def layoutget(type):
+        args = [sequence, putfh,
+                arg("layoutget", oplayoutget=LAYOUTGET4args(
+                    False, type, LAYOUTIOMODE4_RW, 0, NFS4_UINT64_MAX, 0,
+                    stateid, 4096))]
+        layout = layout4(0, NFS4_UINT64_MAX, LAYOUTIOMODE4_RW,
+                         layout_content4(type, None))
+        return (args,
+                [sequence_res, putfh_res,
+                 res("layoutget", oplayoutget=LAYOUTGET4res(
+                     ok, LAYOUTGET4resok(False, stateid, [layout])))])
+    files = (file_layout(), NFS4Packer, NFS4Unpacker,
+             "nfsv4_1_file_layout4")
+    blocks = (block_layout(opts.extents), PNFS_BLOCKPacker,
+              PNFS_BLOCKUnpacker, "pnfs_block_layout4")
+    return [
+        ("read", read + (None,)),
+        ("write", write + (None,)),
+        ("getattr", getattrs + (None,)),
+        ("readdir", readdir + (None,)),
+        ("open", opens + (None,)),
+        ("layoutget file", layoutget(LAYOUT4_NFSV4_1_FILES) + (files,)),
+        ("layoutget block", layoutget(LAYOUT4_BLOCK_VOLUME) + (blocks,)),
+        ]
+
+def compound_cases(name, args, results, layout):
+    """[(name, function)] packing and unpacking a COMPOUND call and reply"""
+    args = COMPOUND4args(b"", 1, args)
+    results = COMPOUND4res(NFS4_OK, b"", results)
+    def pack_args():
+        p = nfs4lib.FancyNFS4Packer()
+        p.pack_COMPOUND4args(args)
+        return p.get_buffer()
+    def pack_res():
+        if layout is not None:
+            # As the server does, packing the layout body as it goes
+            value, packer, unpacker, type = layout
+            p = packer()
+            getattr(p, "pack_" + type)(value)
+            content = results.resarray[-1].oplayoutget.logr_resok4 \
+                      .logr_layout[0].lo_content
+            content.loc_body = p.get_buffer()
+        p = nfs4lib.FancyNFS4Packer()
+        p.pack_COMPOUND4res(results)
+        return p.get_buffer()
+    packed_args = pack_args()
+    packed_res = pack_res()
+    def unpack_args():
+        u = nfs4lib.FancyNFS4Unpacker(packed_args)
+        u.unpack_COMPOUND4args()
+        u.done()
+    def unpack_res():
+        u = nfs4lib.FancyNFS4Unpacker(packed_res)
+        out = u.unpack_COMPOUND4res()
+        u.done()
+        if layout is not None:
+            value, packer, unpacker, type = layout
+            content = out.resarray[-1].oplayoutget.logr_resok4 \
+                      .logr_layout[0].lo_content
+            u = unpacker(content.loc_body)
+            getattr(u, "unpack_" + type)()
+            u.done()
+    return [("pack %s args" % name, pack_args),
+            ("unpack %s args" % name, unpack_args),
+            ("pack %s res" % name, pack_res),
+            ("unpack %s res" % name, unpack_res)]
+
+def fattr_cases():
+    attrs = file_attrs(2)
+    fattr = nfs4lib.dict2fattr(attrs)
+    return [("dict2fattr", lambda: nfs4lib.dict2fattr(attrs)),
+            ("fattr2dict", lambda: nfs4lib.fattr2dict(fattr))]
+
+def rpc_cases():
+    p = RPCPacker()
+    p.pack_authsys_parms(rpc_type.authsys_parms(1500000000, b"client.example",
+                                                0, 0, [0, 1, 2, 3]))
+    cred = rpc_type.opaque_auth(rpc_const.AUTH_SYS, p.get_buffer())
+    verf = rpc_type.opaque_auth(rpc_const.AUTH_NONE, b"")
+    call = rpc_type.rpc_msg(1234, rpc_type.rpc_msg_body(
+        rpc_const.CALL, rpc_type.call_body(2, 100003, 4, 1, cred, verf)))
+    areply = rpc_type.accepted_reply(verf, rpc_type.rpc_reply_data(
+        rpc_const.SUCCESS, b""))
+    reply = rpc_type.rpc_msg(1234, rpc_type.rpc_msg_body(
+        rpc_const.REPLY, rbody=rpc_type.reply_body(rpc_const.MSG_ACCEPTED,
+                                                   areply=areply)))
+    def pack(msg):
+        p = rpc.FancyRPCPacker()
+        p.pack_rpc_msg(msg)
+        return p.get_buffer()
+    def unpack(data):
+        u = rpc.FancyRPCUnpacker(data)
+        u.unpack_rpc_msg()
+    packed_call = pack(call)
+    packed_reply = pack(reply)
+    return [("pack rpc call", lambda: pack(call)),
+            ("unpack rpc call", lambda: unpack(packed_call)),
+            ("pack rpc reply", lambda: pack(reply)),
+            ("unpack rpc reply", lambda: unpack(packed_reply))]
+
+def measure(function, min_time, repeat):
+    """Returns (operations per second, peak bytes allocated by one)"""
+    function() # Warm up
+    count = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(count):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        count = max(count * 2, int(count * min_time / max(elapsed, 1e-6)))
+    best = elapsed
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(count):
+            function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count / best, peak
+
+def compare(name, result, baseline, tolerance):
+    """Returns a description of how result differs from baseline"""
+    if name not in baseline:
+        return "new"
+    old = baseline[name]
+    speed = result["ops_per_sec"] / old["ops_per_sec"]
+    alloc = (result["peak_bytes"] + 1.0) / (old["peak_bytes"] + 1.0)
+    out = "%5.2fx" % speed
+    if speed < 1 - tolerance:
+        out += " SLOWER"
+    if alloc > 1 + tolerance:
+        out += " MORE MEMORY (%i bytes before)" % old["peak_bytes"]
+    return out
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--time", type="float", default=0.2,
+                 help="Seconds to run each case for, per repeat (0.2)")
+    p.add_option("--repeat", type="int", default=3,
+                 help="Times to run each case, taking the best (3)")
+    p.add_option("--only", default=None,
+                 help="Only run cases whose name contains this")
+    p.add_option("--io-size", type="int", default=65536,
+                 help="Bytes of READ and WRITE data (65536)")
+    p.add_option("--entries", type="int", default=100,
+                 help="Entries in the READDIR reply (100)")
+    p.add_option("--extents", type="int", default=32,
+                 help="Extents in the block layout (32)")
+    p.add_option("--save", metavar="FILE",
+                 help="Write the results to FILE as JSON")
+    p.add_option("--compare", metavar="FILE",
+                 help="Compare the results with those saved in FILE")
+    p.add_option("--tolerance", type="float", default=0.15,
+                 help="Fraction by which a case may get worse before "
+                 "--compare fails it (0.15)")
+    opts, args = p.parse_args()
+    cases = []
+    for name, (args, results, layout) in compounds(opts):
+        cases += compound_cases(name, args, results, layout)
+    cases += fattr_cases() + rpc_cases()
+    if opts.only is not None:
+        cases = [c for c in cases if opts.only in c[0]]
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)["results"]
+    print("%28s %12s %12s%s" % ("case", "ops/sec", "peak alloc",
+                                "" if baseline is None else " vs baseline"))
+    results = {}
+    failed = False
+    for name, function in cases:
+        ops, peak = measure(function, opts.time, opts.repeat)
+        results[name] = {"ops_per_sec": ops, "peak_bytes": peak}
+        line = "%28s %12.0f %10.1fKiB" % (name, ops, peak / 1024.0)
+        if baseline is not None:
+            change = compare(name, results[name], baseline, opts.tolerance)
+            failed = failed or "SLOWER" in change or "MORE" in change
+            line += " " + change
+        print(line)
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "options": {"io_size": opts.io_size,
+                                   "entries": opts.entries,
+                                   "extents": opts.extents},
+                       "results": results}, f, indent=1, sort_keys=True)
+            f.write("\n")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
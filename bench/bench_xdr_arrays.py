@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# bench_xdr_arrays.py - Measure bulk packing of arrays of primitives
+#
+# Generates the NFSv4 codecs with a pack_/unpack_ call per array element,
+# and with arrays of fixed size primitives handled by a single struct
+# call, then times packing and unpacking of bitmaps and of the stripe
+# index lists found in file layout device addresses.
+
+import use_local
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from bench_xdr_fixed import generate, time_type
+
+def samples(types):
+    """(label, name, value) of the arrays to time"""
+    def ds_addr(count):
+        return types.nfsv4_1_file_layout_ds_addr4(list(range(count)), [])
+    return [
+        ("bitmap4 x2", "bitmap4", [0x0010011a, 0x00b0a23a]),
+        ("bitmap4 x3", "bitmap4", [0x0010011a, 0x00b0a23a, 0x00000800]),
+        ("bitmap4 x64", "bitmap4", [0xffffffff] * 64),
+        ("stripes x16", "nfsv4_1_file_layout_ds_addr4", ds_addr(16)),
+        ("stripes x1024", "nfsv4_1_file_layout_ds_addr4", ds_addr(1024)),
+        ]
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--count", type="int", default=20000,
+                 help="Values to pack and unpack per array (20000)")
+    opts, args = p.parse_args()
+    dir = tempfile.mkdtemp()
+    sys.path.insert(0, dir)
+    try:
+        each = generate(dir, "xdr_each", bulk_arrays=False)
+        bulk = generate(dir, "xdr_bulk", bulk_arrays=True)
+    finally:
+        shutil.rmtree(dir)
+    print("%14s %10s %10s %8s %10s %10s %8s" %
+          ("array", "pack", "bulk", "gain", "unpack", "bulk", "gain"))
+    for (label, name, value), (l, n, bvalue) in zip(samples(each[1]),
+                                                    samples(bulk[1])):
+        old = time_type(each[0], name, value, opts.count)
+        new = time_type(bulk[0], name, bvalue, opts.count)
+        if old[0] != new[0]:
+            raise RuntimeError("%s packed differently" % label)
+        us = 1e6 / opts.count
+        print("%14s %8.2fus %8.2fus %7.2fx %8.2fus %8.2fus %7.2fx" %
+              (label, old[1] * us, new[1] * us, old[1] / new[1],
+               old[2] * us, new[2] * us, old[2] / new[2]))
+
+if __name__ == "__main__":
+    main()
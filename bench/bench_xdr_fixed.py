@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# bench_xdr_fixed.py - Measure the fixed layout fast paths of xdrgen
+#
+# Generates the NFSv4 codecs twice into a scratch directory, once as
+# before (a pack_/unpack_ call per field) and once with runs of fixed
+# size fields handled by a single struct.Struct, then times packing and
+# unpacking of the small fixed size types found on every compound.
+
+import use_local
+import os
+import sys
+import time
+import shutil
+import tempfile
+import importlib
+import contextlib
+from optparse import OptionParser
+
+import xdrgen
+
+here = os.path.dirname(os.path.abspath(__file__))
+xfile = os.path.join(os.path.dirname(here), "nfs4.1", "xdrdef", "nfs4.x")
+
+def generate(dir, name, **options):
+    """Build the nfs4 codecs as package name in dir, and import them
+
+    options are passed on to xdrgen.run.
+    """
+    pkg = os.path.join(dir, name)
+    os.mkdir(pkg)
+    open(os.path.join(pkg, "__init__.py"), "w").close()
+    shutil.copy(xfile, pkg)
+    cwd = os.getcwd()
+    os.chdir(pkg)
+    try:
+        with open(os.devnull, "w") as null:
+            with contextlib.redirect_stdout(null):
+                xdrgen.run("nfs4.x", **options)
+    finally:
+        os.chdir(cwd)
+    pack = importlib.import_module(name + ".nfs4_pack")
+    return pack, importlib.import_module(name + ".nfs4_type")
+
+def samples(types):
+    """(name, value) of the types to time, built from given nfs4_type"""
+    return [
+        ("stateid4", types.stateid4(1, b"x" * 12)),
+        ("nfstime4", types.nfstime4(1500000000, 999)),
+        ("SEQUENCE4args", types.SEQUENCE4args(b"s" * 16, 7, 3, 15, True)),
+        ("channel_attrs4", types.channel_attrs4(0, 1049620, 1049480, 3428,
+                                                 8, 16, [])),
+        ("change_info4", types.change_info4(True, 12, 13)),
+        ("LOCK4denied", types.LOCK4denied(0, 1 << 40, 2,
+                                          types.lock_owner4(7, b"owner"))),
+        ]
+
+def time_type(pack, name, value, count):
+    packer = pack.NFS4Packer()
+    pack_one = getattr(packer, "pack_" + name)
+    start = time.perf_counter()
+    for i in range(count):
+        pack_one(value)
+    packed = time.perf_counter() - start
+    data = packer.get_buffer()
+    unpacker = pack.NFS4Unpacker(data)
+    unpack_one = getattr(unpacker, "unpack_" + name)
+    start = time.perf_counter()
+    for i in range(count):
+        unpack_one()
+    unpacked = time.perf_counter() - start
+    unpacker.done()
+    return data[:len(data) // count], packed, unpacked
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--count", type="int", default=100000,
+                 help="Values to pack and unpack per type (100000)")
+    opts, args = p.parse_args()
+    dir = tempfile.mkdtemp()
+    sys.path.insert(0, dir)
+    try:
+        plain = generate(dir, "xdr_plain", fast_structs=False)
+        fixed = generate(dir, "xdr_fixed", fast_structs=True)
+    finally:
+        shutil.rmtree(dir)
+    print("%16s %10s %10s %8s %10s %10s %8s" %
+          ("type", "pack", "fixed", "gain", "unpack", "fixed", "gain"))
+    for (name, value), (n, fvalue) in zip(samples(plain[1]),
+                                          samples(fixed[1])):
+        old = time_type(plain[0], name, value, opts.count)
+        new = time_type(fixed[0], name, fvalue, opts.count)
+        if old[0] != new[0]:
+            raise RuntimeError("%s packed differently" % name)
+        us = 1e6 / opts.count
+        print("%16s %8.2fus %8.2fus %7.2fx %8.2fus %8.2fus %7.2fx" %
+              (name, old[1] * us, new[1] * us, old[1] / new[1],
+               old[2] * us, new[2] * us, old[2] / new[2]))
+
+if __name__ == "__main__":
+    main()
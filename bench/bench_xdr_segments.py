@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# bench_xdr_segments.py - Measure the memory used packing READ replies
+#
+# Packs a COMPOUND4res carrying a READ of the given size twice, once into
+# a single buffer as before, and once as a list of segments with the READ
+# data kept as it is, then reports the peak memory allocated by packing,
+# as seen by tracemalloc, and the time taken.  The READ data itself is
+# allocated beforehand, so is not counted.
+
+import use_local
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+from optparse import OptionParser
+
+from bench_xdr_fixed import generate
+
+def read_reply(types, const, size):
+    data = bytes(size)
+    read = types.nfs_resop4(const.OP_READ, opread=types.READ4res(
+        const.NFS4_OK, types.READ4resok(True, data)))
+    sequence = types.nfs_resop4(const.OP_SEQUENCE,
+                                opsequence=types.SEQUENCE4res(
+        const.NFS4_OK, types.SEQUENCE4resok(b"s" * 16, 7, 3, 15, 15, 0)))
+    putfh = types.nfs_resop4(const.OP_PUTFH,
+                             opputfh=types.PUTFH4res(const.NFS4_OK))
+    return types.COMPOUND4res(const.NFS4_OK, b"", [sequence, putfh, read])
+
+def pack(pack, reply, segment_min):
+    p = pack.NFS4Packer()
+    p.segment_min = segment_min
+    p.pack_COMPOUND4res(reply)
+    if segment_min is None:
+        return [p.get_buffer()]
+    return p.get_segments()
+
+def measure(pack_module, reply, segment_min, count):
+    tracemalloc.start()
+    out = pack(pack_module, reply, segment_min)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for i in range(count):
+        pack(pack_module, reply, segment_min)
+    elapsed = (time.perf_counter() - start) / count
+    return out, peak, elapsed
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--size", type="int", default=1 << 20,
+                 help="Bytes of READ data (1048576)")
+    p.add_option("--count", type="int", default=200,
+                 help="Replies to pack for the timing (200)")
+    opts, args = p.parse_args()
+    dir = tempfile.mkdtemp()
+    sys.path.insert(0, dir)
+    try:
+        pack_module, types = generate(dir, "xdr_segments")
+    finally:
+        shutil.rmtree(dir)
+    const = sys.modules["xdr_segments.nfs4_const"]
+    reply = read_reply(types, const, opts.size)
+    print("%10s %10s %10s %10s" % ("packing", "segments", "peak", "time"))
+    results = []
+    for name, segment_min in (("buffer", None), ("segments", 4096)):
+        out, peak, elapsed = measure(pack_module, reply, segment_min,
+                                     opts.count)
+        results.append(b"".join(out))
+        print("%10s %10d %8.2fMiB %8.1fus" %
+              (name, len(out), peak / float(1 << 20), elapsed * 1e6))
+    if results[0] != results[1]:
+        raise RuntimeError("replies packed differently")
+
+if __name__ == "__main__":
+    main()
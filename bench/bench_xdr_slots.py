@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# bench_xdr_slots.py - Measure memory held by unpacked READDIR replies
+#
+# Generates the NFSv4 codecs with and without __slots__, then unpacks
+# enough READDIR replies to hold the requested number of entry4s, and
+# reports the memory they take up, as seen by tracemalloc.  Each entry
+# carries a fattr4 of the size an "ls -l" would ask for.
+
+import use_local
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+from optparse import OptionParser
+
+from bench_xdr_fixed import generate
+
+def make_reply(pack, types, count, start):
+    """A packed READDIR4res holding count entries"""
+    const = sys.modules[pack.__name__.replace("_pack", "_const")]
+    chain = []
+    for i in range(start + count - 1, start - 1, -1):
+        attrs = types.fattr4([0x0010011a, 0x00b0a23a], bytes(88))
+        chain = [types.entry4(i + 1, b"file%08i" % i, attrs, chain)]
+    resok = types.READDIR4resok(b"verifier", types.dirlist4(chain, True))
+    p = pack.NFS4Packer()
+    p.pack_READDIR4res(types.READDIR4res(const.NFS4_OK, resok))
+    return p.get_buffer()
+
+def unpack_all(pack, replies):
+    held = []
+    for data in replies:
+        u = pack.NFS4Unpacker(data)
+        held.append(u.unpack_READDIR4res())
+        u.done()
+    return held
+
+def time_variant(pack, replies):
+    """Unpack all the replies, returning (bytes held, seconds)
+
+    tracemalloc slows everything down, so the timing is a separate run.
+    """
+    start = time.perf_counter()
+    unpack_all(pack, replies)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    held = unpack_all(pack, replies)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, elapsed
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--entries", type="int", default=100000,
+                 help="Total directory entries to hold (100000)")
+    p.add_option("--per-reply", type="int", default=200,
+                 help="Entries per READDIR reply (200).  The entry4 "
+                 "chain is unpacked recursively, so keep this small.")
+    opts, args = p.parse_args()
+    dir = tempfile.mkdtemp()
+    sys.path.insert(0, dir)
+    try:
+        plain = generate(dir, "xdr_plain")
+        slots = generate(dir, "xdr_slots", slots=True)
+    finally:
+        shutil.rmtree(dir)
+    replies = [make_reply(plain[0], plain[1], opts.per_reply, i)
+               for i in range(0, opts.entries, opts.per_reply)]
+    entries = len(replies) * opts.per_reply
+    print("%d entries in %d replies" % (entries, len(replies)))
+    print("%10s %10s %12s %10s" % ("types", "held", "per entry", "unpack"))
+    for name, (pack, types) in (("plain", plain), ("__slots__", slots)):
+        size, elapsed = time_variant(pack, replies)
+        print("%10s %8.1fMiB %10.0f B %9.2fs" %
+              (name, size / float(1 << 20), size / float(entries), elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# bench_xdr_unions.py - Measure union dispatch tables in xdrgen output
+#
+# Generates the NFSv4 codecs with the old if/elif chain over the cases of
+# each union, and with the dict dispatch used for unions with many cases,
+# then times packing and unpacking of typical COMPOUNDs.  Every op is an
+# nfs_argop4 or nfs_resop4, which have one case per operation.
+
+import use_local
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from bench_xdr_fixed import generate
+
+def compounds(types, const):
+    """(name, type, value) of the COMPOUNDs to time"""
+    def arg(op, **kwargs):
+        return types.nfs_argop4(getattr(const, "OP_" + op.upper()), **kwargs)
+    def res(op, **kwargs):
+        return types.nfs_resop4(getattr(const, "OP_" + op.upper()), **kwargs)
+    ok = const.NFS4_OK
+    fh = b"f" * 32
+    stateid = types.stateid4(1, b"x" * 12)
+    attrs = types.fattr4([0x0010011a, 0x00b0a23a], bytes(88))
+    sequence = arg("sequence", opsequence=types.SEQUENCE4args(
+        b"s" * 16, 7, 3, 15, False))
+    sequence_res = res("sequence", opsequence=types.SEQUENCE4res(
+        ok, types.SEQUENCE4resok(b"s" * 16, 7, 3, 15, 15, 0)))
+    getattr_arg = arg("getattr", opgetattr=types.GETATTR4args(
+        [0x0010011a, 0x00b0a23a]))
+    getattr_res = res("getattr", opgetattr=types.GETATTR4res(
+        ok, types.GETATTR4resok(attrs)))
+    lookup = [sequence,
+              arg("putfh", opputfh=types.PUTFH4args(fh)),
+              arg("lookup", oplookup=types.LOOKUP4args(b"name")),
+              arg("getfh"),
+              getattr_arg]
+    lookup_res = [sequence_res,
+                  res("putfh", opputfh=types.PUTFH4res(ok)),
+                  res("lookup", oplookup=types.LOOKUP4res(ok)),
+                  res("getfh", opgetfh=types.GETFH4res(
+                      ok, types.GETFH4resok(fh))),
+                  getattr_res]
+    read = [sequence,
+            arg("putfh", opputfh=types.PUTFH4args(fh)),
+            arg("access", opaccess=types.ACCESS4args(0x1f)),
+            getattr_arg,
+            arg("read", opread=types.READ4args(stateid, 0, 4096)),
+            getattr_arg,
+            arg("savefh"),
+            arg("restorefh"),
+            getattr_arg,
+            arg("getfh")]
+    read_res = [sequence_res,
+                res("putfh", opputfh=types.PUTFH4res(ok)),
+                res("access", opaccess=types.ACCESS4res(
+                    ok, types.ACCESS4resok(0x1f, 0x1f))),
+                getattr_res,
+                res("read", opread=types.READ4res(
+                    ok, types.READ4resok(False, bytes(4096)))),
+                getattr_res,
+                res("savefh", opsavefh=types.SAVEFH4res(ok)),
+                res("restorefh", oprestorefh=types.RESTOREFH4res(ok)),
+                getattr_res,
+                res("getfh", opgetfh=types.GETFH4res(
+                    ok, types.GETFH4resok(fh)))]
+    return [
+        ("lookup args", "COMPOUND4args", types.COMPOUND4args(b"", 1, lookup)),
+        ("lookup res", "COMPOUND4res",
+         types.COMPOUND4res(ok, b"", lookup_res)),
+        ("read args", "COMPOUND4args", types.COMPOUND4args(b"", 1, read)),
+        ("read res", "COMPOUND4res", types.COMPOUND4res(ok, b"", read_res)),
+        ]
+
+def time_compound(pack, name, value, count):
+    packer = pack.NFS4Packer()
+    pack_one = getattr(packer, "pack_" + name)
+    start = time.perf_counter()
+    for i in range(count):
+        pack_one(value)
+    packed = time.perf_counter() - start
+    data = packer.get_buffer()
+    unpacker = pack.NFS4Unpacker(data)
+    unpack_one = getattr(unpacker, "unpack_" + name)
+    start = time.perf_counter()
+    for i in range(count):
+        unpack_one()
+    unpacked = time.perf_counter() - start
+    unpacker.done()
+    return data[:len(data) // count], packed, unpacked
+
+def main():
+    p = OptionParser("%prog [options]")
+    p.add_option("--count", type="int", default=20000,
+                 help="COMPOUNDs to pack and unpack per sample (20000)")
+    opts, args = p.parse_args()
+    dir = tempfile.mkdtemp()
+    sys.path.insert(0, dir)
+    try:
+        chain = generate(dir, "xdr_chain", union_tables=False)
+        table = generate(dir, "xdr_table", union_tables=True)
+        chain += (sys.modules["xdr_chain.nfs4_const"],)
+        table += (sys.modules["xdr_table.nfs4_const"],)
+    finally:
+        shutil.rmtree(dir)
+    print("%12s %10s %10s %8s %10s %10s %8s" %
+          ("compound", "pack", "table", "gain", "unpack", "table", "gain"))
+    for (name, type, value), (n, t, tvalue) in \
+            zip(compounds(*chain[1:]), compounds(*table[1:])):
+        old = time_compound(chain[0], type, value, opts.count)
+        new = time_compound(table[0], type, tvalue, opts.count)
+        if old[0] != new[0]:
+            raise RuntimeError("%s packed differently" % name)
+        us = 1e6 / opts.count
+        print("%12s %8.2fus %8.2fus %7.2fx %8.2fus %8.2fus %7.2fx" %
+              (name, old[1] * us, new[1] * us, old[1] / new[1],
+               old[2] * us, new[2] * us, old[2] / new[2]))
+
+if __name__ == "__main__":
+    main()
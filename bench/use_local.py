@@ -0,0 +1,10 @@
+import sys
+from os.path import join, split, dirname, abspath
+
+# Let the benchmarks import the in-tree rpc and xdr packages
+here = dirname(abspath(__file__))
+head, tail = split(here)
+sys.path[1:1] = [ join(head, "xdr"),
+                  head, # rpc
+                  here,
+                  ]
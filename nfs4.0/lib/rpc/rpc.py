@@ -13,6 +13,7 @@ import socket
 import select
 import threading
 import errno
+import os
 
 try:
     import xdrlib3 as xdrlib
@@ -22,6 +23,8 @@ except:
 from rpc.rpc_const import *
 from rpc.rpc_type import *
 import rpc.rpc_pack as rpc_pack
+from . import drc
+from .drc import DuplicateRequestCache
 
 # Import security flavors and store valid ones
 from .rpcsec.sec_auth_none import SecAuthNone
@@ -145,40 +148,46 @@ class RPCDeniedError(RPCError):
 
 def _recv_all(self, n):
     """Receive n bytes, or raise an error"""
-    data = b""
-    while n > 0:
-        newdata = self.recv(n)
-        count = len(newdata)
+    data = bytearray(n)
+    view = memoryview(data)
+    pos = 0
+    while pos < n:
+        count = self.recv_into(view[pos:])
         if not count:
             raise socket.error("Connection closed")
-        data += newdata
-        n -= count
-    return data
+        pos += count
+    return bytes(data)
 
 def _recv_record(self):
     """Receive data sent using record marking standard"""
     last = False
-    data = b""
+    frags = []
     while not last:
         rec_mark = self.recv_all(4)
         count = struct.unpack('>L', rec_mark)[0]
         last = count & 0x80000000
         if last:
             count &= 0x7fffffff
-        data += self.recv_all(count)
-    return data
+        frags.append(self.recv_all(count))
+    return b"".join(frags)
 
-def _send_record(self, data, chunksize=2048):
-    """Send data using record marking standard"""
+def _mark_record(data, chunksize=2048):
+    """Return data with record marking added"""
     dlen = len(data)
+    out = []
     i = last = 0
     while not last:
         chunk = data[i:i+chunksize]
         i += chunksize
         if i >= dlen:
             last = 0x80000000
-        mark = struct.pack('>L', last | len(chunk))
-        self.sendall(mark + chunk)
+        out.append(struct.pack('>L', last | len(chunk)))
+        out.append(chunk)
+    return b"".join(out)
+
+def _send_record(self, data, chunksize=2048):
+    """Send data using record marking standard"""
+    self.sendall(_mark_record(data, chunksize))
 
 socket.socket.recv_all = _recv_all
 socket.socket.recv_record = _recv_record
@@ -187,19 +196,31 @@ socket.socket.send_record = _send_record
 #################################################
 
 class RPCClient(object):
+    """Client side of an RPC connection.
+
+    All threads share one connection, on which any number of calls may be
+    outstanding.  A reader thread collects the replies, and wakes whichever
+    thread is listening for each xid, so several threads (or one thread
+    sending several calls before listening) keep the connection busy
+    instead of waiting out a round trip per call.
+    """
+    rsize = 65536 # Initial size of the reader's buffer
+
     def __init__(self, host='localhost', port=51423,
                  program=None, version=None, sec_list=None, timeout=15.0,
                  uselowport=False):
         self.debug = 0
         t = threading.currentThread()
         self.lock = threading.Lock()
+        self._send_lock = threading.Lock() # Keeps records from interleaving
         res = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
         self.af, socktype, proto, cannonname, self.sa = res[0]
         self.remotehost = host
         self.remoteport = port
         self.timeout = timeout
         self.uselowport = uselowport
-        self._socket = {}
+        self._socket = None # The connection, see getsocket
+        self._xidlist = {} # {xid: XidCache} for calls awaiting a reply
         self.getsocket() # init socket, is this needed here?
         self.ipaddress = os.fsencode(self.socket.getsockname()[0])
         self._rpcpacker = {t : rpc_pack.RPCPacker()}
@@ -207,7 +228,6 @@ class RPCClient(object):
         self.default_prog = program
         self.default_vers = version
         self.xid = 0
-        self._xidlist = {}
         if sec_list is None:
             sec_list = [SecAuthNone()]
         self.sec_list = sec_list
@@ -237,19 +257,31 @@ class RPCClient(object):
                     print("Could not use low port")
                     return
 
+    def _connect(self):
+        """Open a new connection, and start its reader.  Hold self.lock."""
+        out = socket.socket(self.af, socket.SOCK_STREAM)
+        if self.uselowport:
+            self.bindsocket(out)
+        out.connect(self.sa)
+        out.settimeout(self.timeout)
+        # Calls from many threads share the connection, so a small CALL must
+        # not wait on Nagle for the ack of the one before.
+        out.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket = out
+        t = threading.Thread(target=self._read_replies, args=(out,),
+                             name="RPCClientReader")
+        t.setDaemon(True)
+        t.start()
+        return out
+
     def getsocket(self):
-        t = threading.currentThread()
         self.lock.acquire()
-        if t in self._socket:
-            out = self._socket[t]
-        else:
-            out = self._socket[t] = socket.socket(self.af, socket.SOCK_STREAM)
-            if self.uselowport:
-                self.bindsocket(out)
-            out.connect(self.sa)
-            out.settimeout(self.timeout)
-        self.lock.release()
-        return out
+        try:
+            if self._socket is None:
+                self._connect()
+            return self._socket
+        finally:
+            self.lock.release()
 
     socket = property(getsocket)
 
@@ -270,8 +302,8 @@ class RPCClient(object):
         if t in self._rpcunpacker:
             out = self._rpcunpacker[t]
         else:
-            self._rpcpacker[t] = gss_pack.GSSPacker()
-            out = self._rpcunpacker[t] = gss_pack.GSSUnpacker('')
+            self._rpcpacker[t] = rpc_pack.RPCPacker()
+            out = self._rpcunpacker[t] = rpc_pack.RPCUnpacker('')
         self.lock.release()
         return out
 
@@ -283,39 +315,57 @@ class RPCClient(object):
             self.rhead = None    # unpacked reply header
             self.rdata = None    # unsecured reply data
             self.proc = proc     # unpacked proc from header
+            self.reply = None    # raw reply, as filled in by reader thread
+            self.sock = None     # connection the call was last sent on
+            self.event = threading.Event() # Set when reply or sock fails
 
         def __repr__(self):
             return "%s\n%s" % (self.header, self.data)
 
     def add_outstanding_xids(self, xid, header, data, cred, proc):
-        t = threading.currentThread()
         self.lock.acquire()
-        if t in self._xidlist:
-            if xid in self._xidlist[t]: raise
-            self._xidlist[t][xid] = self.XidCache(header, data, cred, proc)
-        else:
-            self._xidlist[t] = {xid : self.XidCache(header, data, cred, proc)}
-        self.lock.release()
+        try:
+            if xid in self._xidlist:
+                raise RPCError("xid %i is already outstanding" % xid)
+            out = self._xidlist[xid] = self.XidCache(header, data, cred, proc)
+        finally:
+            self.lock.release()
+        return out
 
     def get_outstanding_xids(self):
-        t = threading.currentThread()
-        self.lock.acquire()
-        out = self._xidlist[t]
-        self.lock.release()
-        return out
+        return self._xidlist
 
-    def reconnect(self):
-        t = threading.currentThread()
+    def reconnect(self, old=None):
+        """Replace the connection, returning the new one.
+
+        If old is given, and another thread has already replaced it, the
+        current connection is returned instead.
+        """
         self.lock.acquire()
-        self._socket[t].close()
-        out = self._socket[t] = socket.socket(self.af, socket.SOCK_STREAM)
-        if self.uselowport:
-            self.bindsocket(out)
-        out.connect((self.remotehost, self.remoteport))
-        out.settimeout(self.timeout)
+        try:
+            if old is not None and self._socket is not old:
+                if self._socket is None:
+                    self._connect()
+                return self._socket
+            if self._socket is not None:
+                self._socket.close()
+            return self._connect()
+        finally:
+            self.lock.release()
+
+    def _send_on(self, sock, entry):
+        """Send (or resend) the call in entry on the connection sock"""
+        self.lock.acquire()
+        entry.event.clear()
+        entry.sock = sock
         self.lock.release()
-        return out
-        
+        record = _mark_record(entry.header + entry.data)
+        self._send_lock.acquire()
+        try:
+            sock.sendall(record)
+        finally:
+            self._send_lock.release()
+
     def send(self, procedure, data=b'', program=None, version=None):
         """Send an RPC call to the server
 
@@ -329,80 +379,149 @@ class RPCClient(object):
         xid = self.get_new_xid()
         header, cred = self.get_call_header(xid, program, version, procedure)
         data = self.security.secure_data(data, cred)
+        # Must be listed before sending, as the reply can beat us back
+        entry = self.add_outstanding_xids(xid, header, data, cred, procedure)
+        sock = self.socket
         try:
             if self.debug: print("send %i" % xid)
-            self.socket.send_record(header + data)
+            self._send_on(sock, entry)
         except socket.timeout:
+            self._forget(xid)
             raise
         except socket.error as e:
             print("Got error:", e)
             if self.debug: print("resend", xid)
             try:
-                self.reconnect().send_record(header + data)
+                self._send_on(self.reconnect(sock), entry)
             except socket.error:
+                self._forget(xid)
                 self.reconnect()
                 raise
-        self.add_outstanding_xids(xid, header, data, cred, procedure)
         return xid
 
+    def _forget(self, xid):
+        self.lock.acquire()
+        self._xidlist.pop(xid, None)
+        self.lock.release()
+
+    def _read_replies(self, sock):
+        """Reader thread for connection sock.
+
+        Replies are matched to the XidCache of their call, and the
+        listening thread woken.  When the connection fails, every call
+        still waiting on it is woken with no reply.
+        """
+        buf = bytearray(self.rsize)
+        view = memoryview(buf)
+        start = end = 0 # Unparsed data is buf[start:end]
+        frags = [] # Fragments of the record being received
+        try:
+            while True:
+                if end == len(buf):
+                    # Out of room, so move unparsed data to the front,
+                    # and if that does not help, get a bigger buffer.
+                    size = len(buf) if start else 2 * len(buf)
+                    new = bytearray(size)
+                    new[:end - start] = view[start:end]
+                    view.release()
+                    buf, view = new, memoryview(new)
+                    start, end = 0, end - start
+                try:
+                    count = sock.recv_into(view[end:])
+                except socket.timeout:
+                    continue
+                if not count:
+                    raise socket.error("Connection closed")
+                end += count
+                while end - start >= 4:
+                    mark = struct.unpack_from('>L', buf, start)[0]
+                    size = mark & 0x7fffffff
+                    if end - start - 4 < size:
+                        break
+                    start += 4
+                    frags.append(bytes(view[start:start + size]))
+                    start += size
+                    if mark & 0x80000000:
+                        self._reply_received(b"".join(frags))
+                        frags = []
+                if start == end:
+                    start = end = 0
+        except (socket.error, ValueError) as e:
+            if self.debug: print("reader for %s exiting: %s" % (sock, e))
+        self.lock.acquire()
+        if self._socket is sock:
+            self._socket = None
+        for entry in self._xidlist.values():
+            if entry.sock is sock and entry.reply is None:
+                entry.event.set()
+        self.lock.release()
+        sock.close()
+
+    def _reply_received(self, reply):
+        if len(reply) < 4:
+            return
+        xid = struct.unpack_from('>L', reply)[0]
+        self.lock.acquire()
+        try:
+            entry = self._xidlist.get(xid)
+            if entry is None or entry.reply is not None:
+                if self.debug: print("Dropping reply with xid %i" % xid)
+                return
+            entry.reply = reply
+            entry.event.set()
+        finally:
+            self.lock.release()
+
     def listen(self, xid):
-        # Exists (per thread) list of outstanding xid/seq pairs
-        # If xid not on list, return error.
-        # Listen until get reply with given xid.  Cache others received
-        # on list.  Return error if get one not on list.
+        # Wait for the reader thread to hand us the reply with given xid.
+        # If the connection fails, reconnect and resend the call once.
         if self.debug: print("listen", xid)
         list = self.get_outstanding_xids()
         if xid not in list:
-            raise
-        done = False
-        rdata = list[xid].rdata
-        if rdata is not None:
-            rhead = list[xid].rhead
-            done = True
-        while not done:
+            raise RPCError("No outstanding call with xid %i" % xid)
+        entry = list[xid]
+        resent = False
+        while True:
+            if not entry.event.wait(self.timeout):
+                # Nobody will listen for it again, so drop any late reply
+                self._forget(xid)
+                raise socket.timeout("No reply to xid %i" % xid)
+            if entry.reply is not None:
+                break
+            e = "Connection closed"
+            print("Got error:", e)
+            if resent:
+                self._forget(xid)
+                raise socket.error(e)
+            if self.debug: print("relisten", xid)
             try:
-                reply = self.socket.recv_record()
-            except socket.timeout:
+                self._send_on(self.reconnect(entry.sock), entry)
+            except socket.error:
+                self._forget(xid)
+                self.reconnect()
                 raise
-            except socket.error as e:
-                print("Got error:", e)
-                if self.debug: print("relisten", xid)
-                try:
-                    s = self.reconnect()
-                    s.send_record(list[xid].header + list[xid].data)
-                    reply = s.recv_record()
-                except socket.error:
-                    self.reconnect()
-                    raise
-            p = self.getrpcunpacker()
-            p.reset(reply)
-            rhead = p.unpack_rpc_msg()
-            rxid = rhead.xid
-            if rxid not in list:
-                raise RPCError("Got reply xid %i, expected %i" % \
-                               (rxid, xid))
-            if list[rxid].rhead is not None:
-                raise RPCError("Duplicated reply xid %i" % rxid)
-            rdata = reply[p.get_position():]
-            try:
-                # BUG?, should use rhead credentials?
-                # This conditional is gss specific code that should be hidden
-                if rhead.rbody.stat == MSG_ACCEPTED and \
-                        rhead.areply.reply_data.stat == SUCCESS:
-                    rdata = self.security.unsecure_data(rdata, list[rxid].cred)
-            except:
-                if 0:
-                    # need for servers that don't add gss checksum to errors
-                    pass
-                else:
-                    raise
-            list[rxid].rhead = rhead
-            list[rxid].rdata = rdata
-            if rxid == xid:
-                done = True
-        out = list[xid]
-        del list[xid]
-        self.check_reply(out)
+            resent = True
+        self._forget(xid)
+        reply = entry.reply
+        p = self.getrpcunpacker()
+        p.reset(reply)
+        rhead = p.unpack_rpc_msg()
+        rdata = reply[p.get_position():]
+        try:
+            # BUG?, should use rhead credentials?
+            # This conditional is gss specific code that should be hidden
+            if rhead.rbody.stat == MSG_ACCEPTED and \
+                    rhead.areply.reply_data.stat == SUCCESS:
+                rdata = self.security.unsecure_data(rdata, entry.cred)
+        except:
+            if 0:
+                # need for servers that don't add gss checksum to errors
+                pass
+            else:
+                raise
+        entry.rhead = rhead
+        entry.rdata = rdata
+        self.check_reply(entry)
         return rdata
 
     def call(self, procedure, data=b'', program=None, version=None):
@@ -507,7 +626,7 @@ class Server(object):
                                 self.event_close(fd)
 
 class RPCServer(Server):
-    def __init__(self, prog=10, vers=4, host='', port=51423):
+    def __init__(self, prog=10, vers=4, host='', port=51423, drc=None):
         Server.__init__(self, host, port)
         self.rpcpacker =  rpc_pack.RPCPacker()
         self.rpcunpacker = rpc_pack.RPCUnpacker('')
@@ -527,6 +646,10 @@ class RPCServer(Server):
         self.recordbufs = {} # write buffer for outgoing records
         self.sockets = {}
         self.s.listen(5)
+        # Replies to recent calls, see cached_reply.  True gives the default.
+        if drc is True:
+            drc = DuplicateRequestCache()
+        self.drc = drc or None
 
     def handle_0(self, data, cred):
         if data != '':
@@ -577,7 +700,7 @@ class RPCServer(Server):
                             reply = self.event_command(fd, struct.unpack('>L', recv_data)[0])
                         else:
                             # All handle_* functions are called in compute_reply
-                            reply = self.compute_reply(recv_data)
+                            reply = self.cached_reply(fd, recv_data)
                         if reply is not None:
                             self.recordbufs[fd].append(reply)
                             self.p.register(fd, _bothmask)
@@ -612,7 +735,7 @@ class RPCServer(Server):
         if debug:
             print("SERVER: command = %i, cfd = %i" % (comm, cfd))
         if comm == 0: # Turn off server
-            self.compute_reply = lambda x: None
+            self.compute_reply = lambda *args: None
             return b'\0'*4
         elif comm == 1: # Turn server on
             self.compute_reply = self.__compute_reply_orig
@@ -634,14 +757,53 @@ class RPCServer(Server):
         
     event_hup = event_error
 
-    def compute_reply(self, recv_data):
-        # Decode RPC specific info
+    def cached_reply(self, fd, recv_data):
+        """compute_reply, but answering retransmits from self.drc"""
+        if self.drc is None:
+            return self.compute_reply(recv_data)
         self.rpcunpacker.reset(recv_data)
         try:
             recv_msg = self.rpcunpacker.unpack_rpc_msg()
-        except xdrlib.Error as e:
-            print("XDRError", e)
-            return
+        except xdrlib.Error:
+            # compute_reply reports it
+            return self.compute_reply(recv_data)
+        if recv_msg.body.mtype != CALL:
+            return self.compute_reply(recv_data)
+        call = recv_msg.body.cbody
+        # Over TCP the port changes if the client reconnects to retransmit
+        client = self.sockets[fd].getpeername()[0]
+        args = recv_data[self.rpcunpacker.get_position():]
+        key = self.drc.make_key(recv_msg.xid, client, call.prog, call.vers,
+                                call.proc, call.cred.flavor, args)
+        if key is None:
+            return self.compute_reply(recv_data, recv_msg)
+        state, reply = self.drc.lookup(key)
+        if state == drc.HIT:
+            return reply
+        elif state == drc.IN_PROGRESS:
+            # Can't happen, since calls are handled one at a time
+            return None
+        reply = self.compute_reply(recv_data, recv_msg)
+        if reply is None:
+            self.drc.abandon(key)
+        else:
+            self.drc.complete(key, reply, len(reply))
+        return reply
+
+    def compute_reply(self, recv_data, recv_msg=None):
+        """Returns the reply to the CALL recv_data, or None to drop it.
+
+        recv_msg is the CALL's header, if self.rpcunpacker has already
+        unpacked it from recv_data.
+        """
+        if recv_msg is None:
+            # Decode RPC specific info
+            self.rpcunpacker.reset(recv_data)
+            try:
+                recv_msg = self.rpcunpacker.unpack_rpc_msg()
+            except xdrlib.Error as e:
+                print("XDRError", e)
+                return
         if recv_msg.body.mtype != CALL:
             print("Received a REPLY, expected a CALL")
             return
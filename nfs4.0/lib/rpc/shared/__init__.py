@@ -0,0 +1,4 @@
+# The modules of the top level rpc package which the 4.0 server runs on.
+# They are linked in, rather than the whole package, so that installing
+# this does not also install the package's setup.py and tests.
+__all__ = ["rpc"]
@@ -0,0 +1 @@
+../../../../rpc/drc.py
\ No newline at end of file
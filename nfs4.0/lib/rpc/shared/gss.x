@@ -0,0 +1 @@
+../../../../rpc/gss.x
\ No newline at end of file
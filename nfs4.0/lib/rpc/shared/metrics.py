@@ -0,0 +1 @@
+../../../../rpc/metrics.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../../rpc/rpc.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../../rpc/rpc.x
\ No newline at end of file
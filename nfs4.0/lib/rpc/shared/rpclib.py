@@ -0,0 +1 @@
+../../../../rpc/rpclib.py
\ No newline at end of file
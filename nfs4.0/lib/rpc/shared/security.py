@@ -0,0 +1 @@
+../../../../rpc/security.py
\ No newline at end of file
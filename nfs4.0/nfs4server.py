@@ -29,9 +29,9 @@ from xdrdef.nfs4_const import *
 from xdrdef.nfs4_type import *
 import xdrdef.nfs4_pack as nfs4_pack
 import rpc.rpc as rpc
+import rpc.shared.rpc as shared_rpc
 import nfs4lib
-import time, StringIO, random, traceback, codecs
-import StringIO
+import time, random, traceback, codecs
 import nfs4state
 from nfs4state import NFS4Error, printverf
 
@@ -40,8 +40,8 @@ try:
 except:
     from xdrlib import Error as XDRError
 
-unacceptable_names = [ "", ".", ".." ]
-unacceptable_characters = [ "/", "~", "#", ]
+unacceptable_names = [ b"", b".", b".." ]
+unacceptable_characters = [ b"/", b"~", b"#", ]
 #unacceptable_unicode_values = [ 0xd800, 0xdb7f, 0xdb80, 0xdb80, 0xdbff, 0xdc00, 0xdf80, 0xdfff, 0xFFFE, 0xFFFF ];
 
 def verify_name(name):
@@ -97,10 +97,14 @@ def simple_error(error, *args):
         pass
     raise RuntimeError("Bad caller name %s" % name)
 
-class NFS4Server(rpc.RPCServer):
-    def __init__(self, rootfh, host, port, pubfh = None):
-        rpc.RPCServer.__init__(self, prog=NFS4_PROGRAM, vers=NFS_V4,
-                               host=host, port=port)
+class NFS4Service(object):
+    """The NFSv4.0 program, without any RPC transport.
+
+    A transport class is mixed in to give NFS4Server or LegacyNFS4Server.
+    Calls are handled one at a time, since COMPOUND processing keeps the
+    current filehandle, packer and unpacker in self.
+    """
+    def init_service(self, rootfh, pubfh=None):
         self.nfs4packer = nfs4lib.FancyNFS4Packer()
         self.nfs4unpacker = nfs4lib.FancyNFS4Unpacker('')
         self.state = nfs4state.NFSServerState(rootfh)
@@ -112,17 +116,11 @@ class NFS4Server(rpc.RPCServer):
     def handle_0(self, data, cred):
         print
         print("******** TCP RPC NULL CALL ********")
-        print("  flavor = %i" % cred.flavor)
-        if cred.flavor == rpc.RPCSEC_GSS:
-            gss = self.security[cred.flavor]
-            body = gss.read_cred(cred.body)
-            if body.gss_proc:
-                return gss.handle_proc(body, data)
-        if data != '':
+        if data:
             print("  ERROR - unexpected data")
-            return rpc.GARBAGE_ARGS, ''
+            return rpc.GARBAGE_ARGS, b''
         else:
-            return rpc.SUCCESS, ''
+            return rpc.SUCCESS, b''
 
     def handle_1(self, data, cred):
         self.nfs4unpacker.reset(data)
@@ -235,7 +233,7 @@ class NFS4Server(rpc.RPCServer):
             self.state.advance_seqid(stateid, op, (e.code,))
             return simple_error(e.code)
         # Return a garbage state id
-        sid4 = stateid4(0, '')
+        sid4 = stateid4(0, b'')
         self.state.advance_seqid(stateid, op, (NFS4_OK, sid4), self.curr_fh)
         return simple_error(NFS4_OK, sid4)
 
@@ -305,7 +303,7 @@ class NFS4Server(rpc.RPCServer):
         print("  FILEHANDLE %s" % self.curr_fh.handle)
         # XXX BUG - fhcache not set on getattr or readdir(getattr)
         self.fhcache[self.curr_fh.handle] = self.curr_fh
-        confirmres = GETFH4resok(str(self.curr_fh.handle))
+        confirmres = GETFH4resok(self.curr_fh.handle)
         return simple_error(NFS4_OK, confirmres)
 
     def op_link(self, op):
@@ -333,7 +331,9 @@ class NFS4Server(rpc.RPCServer):
         try:
             replay = None
             if op.oplock.locker.new_lock_owner:
-                owner = op.oplock.locker.open_owner.lock_owner
+                locker = op.oplock.locker.open_owner
+                owner = locker.lock_owner = nfs4state.lock_owner4(
+                    locker.lock_owner.clientid, locker.lock_owner.owner)
                 seqid = op.oplock.locker.open_owner.lock_seqid
                 openstateid = op.oplock.locker.open_owner.open_stateid
                 openseqid = op.oplock.locker.open_owner.open_seqid
@@ -376,9 +376,10 @@ class NFS4Server(rpc.RPCServer):
             return simple_error(NFS4ERR_ISDIR)
         if self.curr_fh.get_type() != NF4REG:
             return simple_error(NFS4ERR_INVAL)
+        owner = nfs4state.lock_owner4(op.oplockt.owner.clientid,
+                                      op.oplockt.owner.owner)
         try:
-            self.state.testlock(self.curr_fh,
-                                op.oplockt.owner, op.oplockt.locktype,
+            self.state.testlock(self.curr_fh, owner, op.oplockt.locktype,
                                 op.oplockt.offset, op.oplockt.length)
         except NFS4Error as e:
             return simple_error(e.code, e.lock_denied)
@@ -452,7 +453,8 @@ class NFS4Server(rpc.RPCServer):
     def op_open(self, op):
         print("  CURRENT FILEHANDLE: %s" % repr(self.curr_fh))
         print("  SEQID: %i" % op.opopen.seqid)
-        owner = op.opopen.owner
+        owner = nfs4state.open_owner4(op.opopen.owner.clientid,
+                                      op.opopen.owner.owner)
         print("  CLIENTID: %d" % owner.clientid)
         print("  OWNER: '%s'" % repr(owner.owner))
         try:
@@ -736,8 +738,8 @@ class NFS4Server(rpc.RPCServer):
         return simple_error(NFS4_OK, r4resok)
 
     def op_rename(self, op):
-        print("  SAVED FILEHANDLE: %s" % repr(self.saved_fh)  # old dir)
-        print("  CURRENT FILEHANDLE: %s" % repr(self.curr_fh) # new dir)
+        print("  SAVED FILEHANDLE: %s" % repr(self.saved_fh))  # old dir
+        print("  CURRENT FILEHANDLE: %s" % repr(self.curr_fh)) # new dir
         print("  OLD NAME: %s" % op.oprename.oldname)
         print("  NEW NAME: %s" % op.oprename.newname)
         if self.curr_fh is None or self.saved_fh is None:
@@ -951,9 +953,42 @@ class NFS4Server(rpc.RPCServer):
     def op_illegal(self, op):
         return simple_error(NFS4ERR_OP_ILLEGAL)
 
-def startup(host, port):
+class NFS4Server(NFS4Service, shared_rpc.Server):
+    """NFSv4.0 server, on the polling loop shared with the 4.1 server"""
+    def __init__(self, rootfh, host, port, pubfh = None, drc=None):
+        shared_rpc.Server.__init__(self, NFS4_PROGRAM, [NFS_V4], port,
+                                   host, workers=1, drc=drc)
+        # A single worker, since calls must be handled one at a time (see
+        # NFS4Service).  Still, a slow call does not hold up the polling
+        # thread, so other connections are read and written meanwhile.
+        self.init_service(rootfh, pubfh)
+
+    def run(self):
+        self.start()
+
+class LegacyNFS4Server(NFS4Service, rpc.RPCServer):
+    """NFSv4.0 server, on the select loop in lib/rpc"""
+    def __init__(self, rootfh, host, port, pubfh = None, drc=None):
+        rpc.RPCServer.__init__(self, prog=NFS4_PROGRAM, vers=NFS_V4,
+                               host=host, port=port, drc=drc)
+        self.init_service(rootfh, pubfh)
+
+    def handle_0(self, data, cred):
+        if cred.flavor == rpc.RPCSEC_GSS:
+            gss = self.security[cred.flavor]
+            body = gss.read_cred(cred.body)
+            if body.gss_proc:
+                return gss.handle_proc(body, data)
+        return NFS4Service.handle_0(self, data, cred)
+
+transports = {"shared" : NFS4Server,
+              "legacy" : LegacyNFS4Server,
+              }
+
+def startup(host, port, drc=False, transport="shared"):
     rootfh = nfs4state.VirtualHandle()
-    server = NFS4Server(rootfh, port=port, host=host, pubfh=rootfh)
+    server = transports[transport](rootfh, port=port, host=host, pubfh=rootfh,
+                                   drc=drc)
     try:
         import rpc.portmap as portmap
         if not portmap.set(NFS4_PROGRAM, NFS_V4, portmap.IPPROTO_TCP, port):
@@ -971,11 +1006,22 @@ def startup(host, port):
         pass
 
 if __name__ == "__main__":
+    from optparse import OptionParser
+    p = OptionParser("%prog [options] [host [port]]")
+    p.add_option("--drc", action="store_true", default=False,
+                 help="Answer retransmitted calls from a duplicate request "
+                 "cache, instead of running them again")
+    p.add_option("--transport", type="choice", choices=sorted(transports),
+                 default="shared",
+                 help="RPC implementation to serve with: shared (the "
+                 "rpc package, as used by the 4.1 server) or legacy "
+                 "(lib/rpc) [default: %default]")
+    opts, args = p.parse_args()
     port = 2049
     server = ''
-    if len(sys.argv) > 2:
-        port = int(sys.argv[2])
-    if len(sys.argv) > 1:
-        server = sys.argv[1]
+    if len(args) > 1:
+        port = int(args[1])
+    if len(args) > 0:
+        server = args[0]
 
-    startup(server, port)
+    startup(server, port, opts.drc, opts.transport)
@@ -4,21 +4,18 @@ import rpc.rpc
 import nfs4acl
 import nfs4lib
 import os, time, array, random, string
-try:
-    import cStringIO.StringIO as StringIO
-except:
-    from io import StringIO
+from io import BytesIO
 from stat import *
-import sha
+import hashlib
 
 
 inodecount = 0
 generationcount = 0
 
-InstanceKey = string.join([random.choice(string.ascii_letters) for x in range(4)], "")
+InstanceKey = "".join([random.choice(string.ascii_letters) for x in range(4)]).encode()
 def Mutate():
     global InstanceKey
-    InstanceKey = string.join([random.choice(string.ascii_letters) for x in range(4)], "")
+    InstanceKey = "".join([random.choice(string.ascii_letters) for x in range(4)]).encode()
 
 
 POSIXLOCK = True # If True, allow locks to be split/joined automatically
@@ -38,6 +35,15 @@ class NFS4Error(Exception):
     def __str__(self):
         return self.msg
 
+# The xdr declares open_owner4 and lock_owner4 as typedefs of state_owner4,
+# so both names are that one class.  The state code tells the two kinds of
+# owner apart by class, so the server converts owners to these on the way in.
+class open_owner4(state_owner4):
+    pass
+
+class lock_owner4(state_owner4):
+    pass
+
 def mod32(number):
     # int(number%0x100000000) doesn't work, since int is signed, we only
     # have 31 bits to play with
@@ -56,29 +62,29 @@ def packnumber(number, size=NFS4_VERIFIER_SIZE, factor=1):
 
     If result will not fit, the high bits are truncated.
     """
-    numb = long(number * factor)
+    numb = int(number * factor)
     bytes = array.array('B')
     for i in range(size):
         bytes.append(0)
     # i == size - 1
     while numb > 0 and i >= 0:
         bytes[i] = numb % 256
-        numb /= 256
+        numb //= 256
         i -= 1
-    return bytes.tostring()
+    return bytes.tobytes()
 
 def unpacknumber(str):
     """Return number associated with bitpacked string"""
     numb = 0
-    for c in str:
-        numb = 256 * numb + ord(c)
+    for c in bytearray(str):
+        numb = 256 * numb + c
     return numb
 
 def printverf(verifier):
     """Returns a printable version of a 'binary' string"""
     str = ""
-    for c in verifier:
-        str += "%x" % ord(c)
+    for c in bytearray(verifier):
+        str += "%x" % c
     return str
 
 #########################################################################
@@ -285,7 +291,7 @@ class NFSServerState:
         # RFC 3530 sec 8.1.5
         try:
             info = self.__getinfo(owner)
-        except (ValueError as NFS4Error):
+        except (ValueError, NFS4Error):
             # An unknown owner, do nothing
             return
         if info is None:
@@ -381,9 +387,9 @@ class NFSServerState:
         if not isinstance(stateid, stateid4):
             raise TypeError("State was given as %s" % str(stateid))
         # Check for special stateids
-        if stateid.seqid==0 and stateid.other==chr(0)*12:
+        if stateid.seqid==0 and stateid.other==b"\0"*12:
             return 0
-        if stateid.seqid==0xffffffff and stateid.other==chr(0xff)*12:
+        if stateid.seqid==0xffffffff and stateid.other==b"\xff"*12:
             return 1
         # Check for self consistency
         if stateid.other[:4] != self.instance:
@@ -479,7 +485,7 @@ class NFSServerState:
 
     def __check_clientid(self, clientid):
         """Checks that clientid is not stale"""
-        if clientid / 0x100000000 != unpacknumber(self.instance):
+        if clientid // 0x100000000 != unpacknumber(self.instance):
             raise NFS4Error(NFS4ERR_STALE_CLIENTID)
 
     def __renew(self, id):
@@ -712,6 +718,10 @@ class NFSFileState:
             elif self.end > other.end: return 1
             else: return 0
 
+        def __lt__(self, other):
+            # python3 sorts with this, not __cmp__
+            return self.__cmp__(other) < 0
+
         def overlaps(self, start, end):
             """Returns True if given range overlaps that of lock"""
             return start <= self.start <= end or \
@@ -890,7 +900,7 @@ class NFSFileHandle:
         global InstanceKey
         # Note: name should be removed, since hardlinking makes it unknowable
         self.name = name
-        self.handle = InstanceKey + self.get_fhclass() + sha.new(self.name+str(time.time())).hexdigest() + "\x00\x00\x00\x00"
+        self.handle = InstanceKey + self.get_fhclass() + hashlib.sha1(self.name + str(time.time()).encode()).hexdigest().encode() + b"\x00\x00\x00\x00"
         self.fattr4_change = 0
         self.lock_status = {}
         self.parent = parent
@@ -903,7 +913,7 @@ class NFSFileHandle:
         return "<NFSFileHandle(%s): %s>" % (self.get_fhclass(), str(self))
 
     def __str__(self):
-        return self.name
+        return self.name.decode("utf8", "replace")
 
     def supported_access(self, client):
         raise "Implement supported_access()"
@@ -937,7 +947,7 @@ class NFSFileHandle:
 
 
 class VirtualHandle(NFSFileHandle):
-    def __init__(self, name="/", type=None, parent=None):
+    def __init__(self, name=b"/", type=None, parent=None):
         NFSFileHandle.__init__(self, name, parent)
         try:
             self.fattr4_type = type.type
@@ -954,7 +964,7 @@ class VirtualHandle(NFSFileHandle):
             self.dirent = DirList()
             self.fattr4_mode = 0o755
         if self.fattr4_type == NF4REG:
-            self.file = StringIO.StringIO()
+            self.file = BytesIO()
             self.state = NFSFileState()
         if self.fattr4_type == NF4LNK:
             self.link_target = type.linkdata
@@ -975,7 +985,7 @@ class VirtualHandle(NFSFileHandle):
         self.fattr4_unique_handles = False
         self.fattr4_lease_time = 90 # Seconds
         self.fattr4_rdattr_error = NFS4_OK
-        self.fattr4_filehandle = str(self.handle)
+        self.fattr4_filehandle = self.handle
         self.fattr4_aclsupport = ACL4_SUPPORT_ALLOW_ACL | ACL4_SUPPORT_DENY_ACL
         self.fattr4_case_insensitive = False
         self.fattr4_case_preserving = True
@@ -1233,7 +1243,7 @@ class VirtualHandle(NFSFileHandle):
         return
 
     def get_fhclass(self):
-        return "virt"
+        return b"virt"
 
     def get_type(self):
         return self.fattr4_type
@@ -1386,7 +1396,7 @@ class HardHandle(NFSFileHandle):
         return ret_dict
 
     def get_fhclass(self):
-        return "hard"
+        return b"hard"
 
         def get_link(self):
                 return os.readlink(self.file)
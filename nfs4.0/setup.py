@@ -57,6 +57,10 @@ def generate_files():
 
     dir = os.path.join(topdir, 'lib', 'rpc', 'rpcsec')
     use_xdr(dir, 'gss.x')
+
+    dir = os.path.join(topdir, 'lib', 'rpc', 'shared')
+    use_xdr(dir, 'rpc.x')
+    use_xdr(dir, 'gss.x')
     os.chdir(home)
 
 # FRED - figure how to get this to run only with build/install type command
@@ -74,7 +78,7 @@ setup(name = "newpynfs",
       maintainer_email = "calum.mackay@oracle.com",
 
       package_dir = {'': 'lib'},
-      packages = ['servertests', 'rpc', 'rpc.rpcsec'],
+      packages = ['servertests', 'rpc', 'rpc.rpcsec', 'rpc.shared'],
       py_modules = ['testmod'],
       scripts = ['testserver.py', 'showresults.py']
       )
@@ -1505,7 +1505,7 @@ class FileLayoutFile(object): # XXX This should inherit from fs_base.py
             out.append(segment)
             self._pos += len(segment)
             bytes_to_read -= len(segment)
-        return ''.join(out)
+        return b''.join(out)
 
     def _query_size(self):
         size = self._size
@@ -1520,7 +1520,7 @@ class FileLayoutFile(object): # XXX This should inherit from fs_base.py
             vol.seek(v_pos)
             v_len = min(v_len, length)
             v_len = min(v_len, 8192) # Don't overwhelm MDS/DS channel limits
-            vol.write('\0' * v_len)
+            vol.write(b'\0' * v_len)
             length -= v_len
 
     def write(self, data):
@@ -27,14 +27,15 @@ log_cb = logging.getLogger("nfs.client.cb")
 op3 = nfs_ops.NFS3ops()
 
 class PORTMAPClient(rpc.Client):
-    def __init__(self, host='localhost', port=PMAP_PORT):
+    def __init__(self, host='localhost', port=PMAP_PORT, udp=False):
         rpc.Client.__init__(self, PMAP_PROG, PMAP_VERS)
         self.server_address = (host, port)
+        self.udp = udp # Send calls as datagrams, avoiding connection setup
         self._pipe = None
 
     def get_pipe(self):
         if not self._pipe or not self._pipe.is_active():
-           self._pipe = self.connect(self.server_address)
+           self._pipe = self.connect(self.server_address, udp=self.udp)
         return self._pipe
 
     def proc_async(self, procnum, procarg, credinfo=None, pipe=None,
@@ -64,21 +65,22 @@ class PORTMAPClient(rpc.Client):
             data = res_unpacker()
         return data
 
-    def get_port(self, prog, vers):
-        arg = mapping(prog, vers, IPPROTO_TCP, 0)
+    def get_port(self, prog, vers, prot=IPPROTO_TCP):
+        arg = mapping(prog, vers, prot, 0)
 
         res = self.proc(PMAPPROC_GETPORT, arg, 'uint')
         return res
 
 class Mnt3Client(rpc.Client):
-    def __init__(self, host='localhost', port=None):
+    def __init__(self, host='localhost', port=None, udp=False):
         rpc.Client.__init__(self, MOUNT_PROGRAM, MOUNT_V3)
         self.server_address = (host, port)
+        self.udp = udp # Send calls as datagrams, avoiding connection setup
         self._pipe = None
 
     def get_pipe(self):
         if not self._pipe or not self._pipe.is_active():
-            self._pipe = self.connect(self.server_address)
+            self._pipe = self.connect(self.server_address, udp=self.udp)
         return self._pipe
 
     def proc_async(self, procnum, procarg, credinfo=None, pipe=None,
@@ -118,10 +120,16 @@ class Mnt3Client(rpc.Client):
         return res.mountinfo.fhandle
 
 class NFS3Client(rpc.Client):
-    def __init__(self, host='localhost', port=None, ctrl_proc=16, summary=None):
+    def __init__(self, host='localhost', port=None, ctrl_proc=16, summary=None,
+                 udp=False):
         rpc.Client.__init__(self, 100003, 3)
-        self.portmap = PORTMAPClient(host=host)
-        self.mntport = self.portmap.get_port(MOUNT_PROGRAM, MOUNT_V3)
+        # With udp, the PORTMAP and MOUNT calls are sent as datagrams
+        self.portmap = PORTMAPClient(host=host, udp=udp)
+        if udp:
+            self.mntport = self.portmap.get_port(MOUNT_PROGRAM, MOUNT_V3,
+                                                 IPPROTO_UDP)
+        else:
+            self.mntport = self.portmap.get_port(MOUNT_PROGRAM, MOUNT_V3)
         if not port:
             self.port = self.portmap.get_port(100003, 3)
         else:
@@ -132,7 +140,7 @@ class NFS3Client(rpc.Client):
         self.ctrl_proc = ctrl_proc
         self.summary = summary
         self._pipe = None
-        self.mntclnt = Mnt3Client(host=host, port=self.mntport)
+        self.mntclnt = Mnt3Client(host=host, port=self.mntport, udp=udp)
 
     def get_pipe(self):
         if not self._pipe or not self._pipe.is_active():
@@ -38,7 +38,12 @@ class NFS4Client(rpc.Client, rpc.Server):
         self.impl_id = nfs_impl_id4(b"citi.umich.edu", b"pynfs X.X",
                                     nfs4lib.get_nfstime())
         self.verifier = struct.pack('>d', time.time())
-        self.server_address = (host, port)
+        if port is None:
+            # host is an AF_UNIX path, or an in-process server,
+            # see rpc.ConnectionHandler.connect
+            self.server_address = host
+        else:
+            self.server_address = (host, port)
         self.c1 = self.connect(self.server_address,secure=secure)
         self.sessions = {} # XXX Really, this should be per server
         self.clients = {} # XXX Really, this should be per server
@@ -95,7 +100,11 @@ class NFS4Client(rpc.Client, rpc.Server):
         if SHOW_TRAFFIC:
             log_cb.info("compound result = %r" % (res,))
         if self.summary:
-            self.summary.show_op('call v4.1 %s:%s' % self.server_address,
+            if isinstance(self.server_address, tuple):
+                where = '%s:%s' % self.server_address
+            else:
+                where = str(self.server_address)
+            self.summary.show_op('call v4.1 %s' % where,
                 [ nfs_opnum4[a.argop].lower()[3:] for a in args[0] ],
                 nfsstat4[res.status])
         return res
@@ -109,6 +118,28 @@ class NFS4Client(rpc.Client, rpc.Server):
             data = p.unpack_COMPOUND4res()
         return data
 
+    async def connect_aio(self, secure=False):
+        """Open an rpc.aio connection to the server
+
+        Callbacks arriving on it are handled by this client.
+        """
+        # Imported here, as asyncio takes a while to import
+        import rpc.aio as aio
+        return await aio.connect(self.server_address, self, secure)
+
+    async def compound_aio(self, ops, pipe, **kwargs):
+        """Like compound, but waits for the reply on an rpc.aio pipe
+
+        Since no thread is tied up waiting, a single thread can have
+        thousands of these in flight at once.
+        """
+        xid = self.compound_async(ops, pipe=pipe, **kwargs)
+        header, data = await pipe.wait(xid)
+        if data:
+            p = nfs4lib.FancyNFS4Unpacker(data)
+            data = p.unpack_COMPOUND4res()
+        return data
+
     def handle_0(self, data, cred):
         """NULL procedure"""
         allow_null_data = True
@@ -554,6 +585,24 @@ class SessionRecord(object):
         res = self.remove_seq_op(res)
         return res
 
+    def bind_conn(self, pipe, dir=CDFC4_FORE):
+        """Use pipe for this session, with BIND_CONN_TO_SESSION"""
+        return self.c.compound([op4.bind_conn_to_session(self.sessionid, dir,
+                                                         False)],
+                               credinfo=self.cred, pipe=pipe)
+
+    def bind_pool(self, pool, dir=CDFC4_FORE):
+        """bind_conn every connection of an rpc.ConnectionPool
+
+        Afterwards, compound(ops, pipe=pool) spreads calls over them:
+            pool = c.connect_pool(c.server_address, 4)
+            sess.bind_pool(pool)
+            sess.compound([op4.putrootfh()], pipe=pool)
+        """
+        for pipe in pool:
+            nfs4lib.check(self.bind_conn(pipe, dir),
+                          msg="BIND_CONN_TO_SESSION on %s" % pipe)
+
     def update_seq_state(self, res, slot):
         seq_res = res.resarray[0]
         slot.finish_call(seq_res)
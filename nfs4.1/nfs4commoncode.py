@@ -67,20 +67,25 @@ class %(CompoundArgResults)s(object):
     def __init__(self, env, prefix=b""):
         self.status = NFS4_OK # Generally == self.results[-1].status
         self.results = [] # Array of nfs_resop4 structures
-        self.packed = [] # Corresponding XDR encoded nfs_resop4 structures
         self.prefix = prefix # String to prepend onto COMPOUND tag
         self._base_len = 8 # status + arraysize
         self._p = nfs4lib.FancyNFS4Packer()
         self._env = env
 
-    def append(self, result):
-        """Add an nfs_resop4 structure to our list"""
+    def sizeof(self, result):
+        """Size of XDR encoded nfs_resop4 structure"""
+        return self._p.sizeof_%(nfs_resop4)s(result)
+
+    def append(self, result, size=None):
+        """Add an nfs_resop4 structure to our list
+
+        size is its encoded size, if already known.
+        """
+        if size is None:
+            size = self.sizeof(result)
         self.status = result.status
         self.results.append(result)
-        self._p.reset()
-        self._p.pack_%(nfs_resop4)s(result)
-        self.packed.append(self._p.get_buffer())
-        self._base_len += len(self.packed[-1])
+        self._base_len += size
 
     def __getitem__(self, key):
         return self.results[key]
@@ -95,10 +100,10 @@ class %(PairedResults)s(object):
         self.reply = %(CompoundArgResults)s(env)
         self.cache = %(CompoundArgResults)s(env, prefix=b"[REPLAY] ")
 
-    def append(self, result):
+    def append(self, result, size=None):
         if hasattr(result, "tag"):
             self.env.tag_msg(result.tag)
-        self.reply.append(result)
+        self.reply.append(result, size)
         # Basically, ignoring size checks, this does:
         #    if self.env.cacheing:
         #        self.cache = self.reply
@@ -107,10 +112,9 @@ class %(PairedResults)s(object):
         #                        ^
         #                         \should be SEQ
 
-        # STUB - do size checking on self.reply
+        # Size checking against the session is done by the server
         if self.env.caching or self.env.index == 0:
-            self.cache.append(result)
-            # STUB - do size checking on self.cache
+            self.cache.append(result, size)
         elif self.env.index == 1:
             name = %(nfs_opnum4)s[result.resop].lower()[3:]
             res = %(encode_status)s_by_name(name, NFS4ERR_RETRY_UNCACHED_REP)
@@ -156,6 +160,7 @@ class %(CompoundState)s(object):
         self.mech = None
         self.connection = self.get_connection(cred)
         self.header_size = self.get_header_size(cred)
+        self.reply_header_size = self.get_reply_header_size(cred)
         # Access to results, needed by some ops, and of course by COMPOUND
         self.tag = args.tag # This will be the returned tag
         self.results = %(PairedResults)s(self)
@@ -181,6 +186,10 @@ class %(CompoundState)s(object):
         """Pull size of RPC header from credential"""
         return cred.header_size
 
+    def get_reply_header_size(self, cred):
+        """Pull size of RPC reply header from credential"""
+        return cred.reply_header_size
+
     def set_cfh(self, fh, state=nfs4lib.state00):
         """Normally, need to clear cid when set cfh.
 
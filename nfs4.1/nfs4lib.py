@@ -243,36 +243,66 @@ class FancyNFS4Unpacker(NFS4Unpacker):
         data.entries = list
         return data
 
+class FattrPlan(object):
+    """How to pack and unpack the attributes of a given attribute bitmap.
+
+    Looking up the pack_fattr4_/unpack_fattr4_ method of each attribute
+    by name is a large part of the cost of dict2fattr and fattr2dict, and
+    the same few bitmaps are used again and again, so the methods are
+    looked up once per bitmap, and kept in attribute order.
+    """
+    def __init__(self, bitmap):
+        self.bitmap = bitmap
+        self.bitnums = bitmap2list(bitmap)
+        # Raises KeyError for an unknown attribute, as before
+        self.packers = [getattr(FancyNFS4Packer, bitnum2packer[bitnum])
+                        for bitnum in self.bitnums]
+        self.unpackers = [getattr(FancyNFS4Unpacker, bitnum2unpacker[bitnum])
+                          for bitnum in self.bitnums]
+
+    def pack(self, dict):
+        """Pack the attribute values of dict into a single buffer"""
+        packer = FancyNFS4Packer()
+        for bitnum, pack in zip(self.bitnums, self.packers):
+            pack(packer, dict[bitnum])
+        return packer.get_buffer()
+
+    def unpack(self, data):
+        """Unpack data into a dictionary of form {bitnum:value}"""
+        unpacker = FancyNFS4Unpacker(data)
+        result = {}
+        for bitnum, unpack in zip(self.bitnums, self.unpackers):
+            result[bitnum] = unpack(unpacker)
+        unpacker.done()
+        return result
+
+fattr_plans = {} # {bitmap: FattrPlan}
+fattr_plans_max = 1024 # Bitmaps come from the wire, so do not keep them all
+
+def fattr_plan(bitmap):
+    """Return the FattrPlan for bitmap, reusing one made earlier"""
+    plan = fattr_plans.get(bitmap)
+    if plan is None:
+        plan = FattrPlan(bitmap)
+        if len(fattr_plans) >= fattr_plans_max:
+            fattr_plans.clear()
+        fattr_plans[bitmap] = plan
+    return plan
+
 def dict2fattr(dict):
     """Convert a dictionary of form {numb:value} to a fattr4 object.
 
     Returns a fattr4 object.
     """
-
-    attrs = sorted(dict.keys())
-
-    packer = FancyNFS4Packer()
-    attr_vals = b""
-    for bitnum in attrs:
-        value = dict[bitnum]
-        packer.reset()
-        getattr(packer, bitnum2packer[bitnum])(value)
-        attr_vals += packer.get_buffer()
-    attrmask = list2bitmap(attrs)
-    return xdrdef.nfs4_type.fattr4(attrmask, attr_vals);
+    attrmask = list2bitmap(dict)
+    return xdrdef.nfs4_type.fattr4(attrmask, fattr_plan(attrmask).pack(dict))
 
 def fattr2dict(obj):
     """Convert a fattr4 object to a dictionary with attribute name and values.
 
     Returns a dictionary of form {bitnum:value}
     """
-    result = {}
-    list = bitmap2list(obj.attrmask)
-    unpacker = FancyNFS4Unpacker(obj.attr_vals)
-    for bitnum in list:
-        result[bitnum] = getattr(unpacker, bitnum2unpacker[bitnum])()
-    unpacker.done()
-    return result
+    return fattr_plan(obj.attrmask).unpack(obj.attr_vals)
 
 def list2bitmap(list):
     """Construct a bitmap from a list of bit numbers"""
@@ -281,15 +311,20 @@ def list2bitmap(list):
         mask |= 1 << bit
     return mask
 
+# The bit numbers set in each byte value, for bitmap2list
+_byte_bits = [[bit for bit in range(8) if byte & (1 << bit)]
+              for byte in range(256)]
+
 def bitmap2list(bitmap):
     """Return (sorted) list of bit numbers set in bitmap"""
     out = []
-    bitnum = 0
+    base = 0
     while bitmap:
-        if bitmap & 1:
-            out.append(bitnum)
-        bitnum += 1
-        bitmap >>= 1
+        byte = bitmap & 0xff
+        if byte:
+            out.extend([base + bit for bit in _byte_bits[byte]])
+        base += 8
+        bitmap >>= 8
     return out
 
 ##########################################################
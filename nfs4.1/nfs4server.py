@@ -113,6 +113,12 @@ class Recording(object):
     def add(self, call, reply):
         """Add call and reply strings to records"""
         if self.on:
+            # The call may be a view of the whole received record, see
+            # NFS4Server.payload_views, so keep a copy
+            call = bytes(call)
+            if isinstance(reply, list):
+                # A list of segments, see NFS4Server.segment_min
+                reply = b''.join(reply)
             self.queue.appendleft((call, reply))
 
     def set_stamp(self, stamp):
@@ -536,6 +542,23 @@ class SummaryOutput:
         if print_summary_line:
             print(summary_line)
 
+class CompoundUnpacker(nfs4lib.FancyNFS4Unpacker):
+    """Unpacks COMPOUND4args, with WRITE data as views of the record.
+
+    Other opaques, such as tags and link text, are always copied, since
+    they may be kept long after the call, and a view would keep the
+    whole record alive with them.  WRITE data only lives until it is
+    written to the backing store.
+    """
+    write_view_min = None
+
+    def unpack_WRITE4args(self):
+        self.opaque_view_min = self.write_view_min
+        try:
+            return nfs4lib.FancyNFS4Unpacker.unpack_WRITE4args(self)
+        finally:
+            self.opaque_view_min = None
+
 
 ##################################################
 # The primary class - it is excessively long     #
@@ -547,6 +570,14 @@ class NFS4Server(rpc.Server):
     # As the only per-server attribute, lease_time is handled specially
     fattr4_lease_time = property(lambda s: s.config.lease_time)
 
+    # Large WRITE data is passed down to the backing store as a memoryview
+    # of the received record, rather than as a copy.  See CompoundUnpacker.
+    payload_views = True
+    write_view_min = 4096
+    # Likewise large opaques in replies, such as READ data, are handed
+    # to the transport as they are, rather than copied into the reply.
+    segment_min = 4096
+
     def __init__(self, **kwargs):
         # Handle ctrl_proc keyword
         ctrl_proc = kwargs.pop("ctrl_proc", CONTROL_PROCEDURE)
@@ -690,12 +721,13 @@ class NFS4Server(rpc.Server):
         log_41.info("*" * 40)
         log_41.info("Handling COMPOUND")
         # data is an XDR packed string.  Unpack it.
-        unpacker = nfs4lib.FancyNFS4Unpacker(data)
+        unpacker = CompoundUnpacker(data)
+        unpacker.write_view_min = self.write_view_min
         try:
             args = unpacker.unpack_COMPOUND4args()
             unpacker.done()
         except:
-            log_41.info(repr(data))
+            log_41.info(repr(bytes(data)))
             log_41.warn("returning GARBAGE_ARGS")
             log_41.debug("unpacking raised the following error", exc_info=True)
             return rpc.GARBAGE_ARGS, None
@@ -711,8 +743,9 @@ class NFS4Server(rpc.Server):
                                env.results.reply.results)
             log_41.info(repr(res))
             p = nfs4lib.FancyNFS4Packer()
+            p.segment_min = self.segment_min
             p.pack_COMPOUND4res(res)
-            reply = p.get_buffer()
+            reply = p.get_segments()
             # Stuff the replay cache
             if env.cache is not None:
                 p.reset()
@@ -842,17 +875,46 @@ class NFS4Server(rpc.Server):
                     traceback.print_exc()
                     result = encode_status_by_name(opname.lower()[3:],
                                                    NFS4ERR_SERVERFAULT)
-            env.results.append(result)
+            result, size = self.check_reply_size(env, opname, result)
+            env.results.append(result, size)
             opnames.append(opname.lower()[3:])
             status = result.status
             if status != NFS4_OK:
                 break
         log_41.info("Replying.  Status %s (%d)" % (nfsstat4[status], status))
-        client_addr = '%s:%s' % cred.connection._s.getpeername()[:2]
+        client_addr = cred.connection.getpeername()
+        if isinstance(client_addr, tuple):
+            client_addr = '%s:%s' % client_addr[:2]
+        else:
+            # AF_UNIX peers are usually unnamed
+            client_addr = client_addr or 'local'
         self.summary.show_op('handle v4.1 %s' % client_addr,
                              opnames, status)
         return env
 
+    def check_reply_size(self, env, opname, result):
+        """Returns (result, size of its encoding).
+
+        If adding result would take the reply over the session's limits,
+        it is replaced by the appropriate error.
+        """
+        size = env.results.reply.sizeof(result)
+        if env.session is None or env.index == 0:
+            # SEQUENCE is always returned
+            return result, size
+        channel = env.session.channel_fore
+        # The limits include the reply's RPC header
+        total = env.reply_header_size + env.results.reply.size + size
+        if total > channel.maxresponsesize:
+            status = NFS4ERR_REP_TOO_BIG
+        elif env.caching and total > channel.maxresponsesize_cached:
+            status = NFS4ERR_REP_TOO_BIG_TO_CACHE
+        else:
+            return result, size
+        log_41.info("Reply size %i too big for session" % total)
+        result = encode_status_by_name(opname.lower()[3:], status)
+        return result, env.results.reply.sizeof(result)
+
     def delete_session(self, session, sessionid):
         log_41.info("delete_session REMOVE SESSION")
         del self.sessions[sessionid]
@@ -1546,12 +1608,7 @@ class NFS4Server(rpc.Server):
         return encode_status(NFS4_OK, res)
 
     def op_readdir(self, arg, env):
-        def find_size(e):
-            # Find size of xdr encoded response
-            p = nfs4lib.FancyNFS4Packer()
-            p.pack_entry4(e)
-            return len(p.get_buffer())
-
+        find_size = nfs4lib.FancyNFS4Packer().sizeof_entry4 # xdr encoded size
         offset = 3 # index offset used to avoid reserved cookies
         check_session(env)
         check_cfh(env)
@@ -1574,8 +1631,10 @@ class NFS4Server(rpc.Server):
             except IndexError:
                 eof = True
                 break
-            e = entry4(i+offset, name,
-                       self.get_attributes(obj, arg.attr_request), [])
+            # Encode the attributes now, rather than for both find_size
+            # and the reply
+            attrs = self.get_attributes(obj, arg.attr_request)
+            e = entry4(i+offset, name, nfs4lib.dict2fattr(attrs), [])
             size += find_size(e)
             if size > arg.maxcount:
                 if not entrylist:
@@ -1879,8 +1938,7 @@ class NFS4Server(rpc.Server):
         if maxcount:
             # Check that we don't exceed maxcount
             p = nfs4lib.FancyNFS4Packer()
-            p.pack_device_addr4(address)
-            buflen = len(p.get_buffer())
+            buflen = p.sizeof_device_addr4(address)
             if buflen > maxcount:
                 return encode_status(NFS4ERR_TOOSMALL, gdir_mincount = buflen)
         res = GETDEVICEINFO4resok(address, 0)
@@ -2071,7 +2129,7 @@ def read_exports(server, opts):
     mod = __import__(file)
     mod.mount_stuff(server, opts)
 
-def scan_options():
+def scan_options(args=None):
     from optparse import OptionParser, OptionGroup, IndentedHelpFormatter
     p = OptionParser("%prog [-r] [--bypass_checks]",
                     formatter = IndentedHelpFormatter(2, 25)
@@ -2095,6 +2153,25 @@ def scan_options():
                  help="File used to determine dataserver addresses")
     p.add_option("--port", type="int", default=2049,
                  help="Set port to listen on (2049)")
+    p.add_option("--unix", default=None, metavar="PATH",
+                 help="Also listen on the AF_UNIX socket PATH")
+    p.add_option("--workers", type="int", default=0,
+                 help="Handle requests with a pool of this many threads, "
+                 "instead of a thread per request")
+    p.add_option("--max_inflight", type="int", default=0,
+                 help="Stop reading from clients while this many requests "
+                 "are being handled (no limit)")
+    p.add_option("--max_conn_inflight", type="int", default=0,
+                 help="Stop reading from a single client while it has this "
+                 "many requests being handled (no limit)")
+    p.add_option("--asyncio", action="store_true", default=False,
+                 help="Run the connections on an asyncio event loop "
+                 "(not with --unix)")
+    p.add_option("--metrics", default=None, metavar="FILE",
+                 help="Dump per procedure RPC statistics as JSON to FILE "
+                 "when sent SIGUSR1")
+    p.add_option("--metrics_interval", type="int", default=0,
+                 metavar="SECS", help="Also dump statistics every SECS seconds")
 
     g = OptionGroup(p, "Debug options",
                     "These affect information collected and printed.")
@@ -2102,9 +2179,12 @@ def scan_options():
                  help="Threads track locks and their state")
     p.add_option_group(g)
 
-    opts, args = p.parse_args()
+    opts, args = p.parse_args(args)
     if args:
         p.error("Unhandled argument %r" % args[0])
+    if opts.asyncio and opts.unix:
+        # Only the polling loop in rpc.Server listens on AF_UNIX sockets
+        p.error("--unix can not be used with --asyncio")
     return opts
 
 if __name__ == "__main__":
@@ -2112,13 +2192,25 @@ if __name__ == "__main__":
     if opts.debug_locks:
         import locking
         locking.DEBUG = True
-    S = NFS4Server(port=opts.port,
+    S = NFS4Server(port=None if opts.asyncio else opts.port,
                    is_mds=opts.use_block or opts.use_files,
                    is_ds = opts.is_ds,
                    verbose = opts.verbose,
-                   show_summary = opts.show_summary)
+                   show_summary = opts.show_summary,
+                   workers = opts.workers,
+                   max_inflight = opts.max_inflight,
+                   max_conn_inflight = opts.max_conn_inflight,
+                   unix = opts.unix)
     read_exports(S, opts)
-    if True:
+    if opts.metrics:
+        S.metrics.dump_on_signal(opts.metrics)
+        if opts.metrics_interval:
+            S.metrics.dump_every(opts.metrics, opts.metrics_interval)
+    if opts.asyncio:
+        import asyncio
+        import rpc.aio as aio
+        asyncio.run(aio.serve_forever(S, '', opts.port))
+    elif True:
         S.start()
     else:
         import profile
@@ -118,7 +118,12 @@ class Environment(testmod.Environment):
     def __init__(self, opts):
         self._lock = Lock()
         self.opts = opts
-        self.c1 = nfs4client.NFS4Client(opts.server, opts.port, opts.minorversion, secure=opts.secure)
+        if opts.address is None:
+            host, port = opts.server, opts.port
+        else:
+            # Not using TCP, see testserver.py --transport
+            host, port = opts.address, None
+        self.c1 = nfs4client.NFS4Client(host, port, opts.minorversion, secure=opts.secure)
         s1 = rpc.security.instance(opts.flavor)
         if opts.flavor == rpc.AUTH_NONE:
             self.cred1 = s1.init_cred()
@@ -145,7 +150,7 @@ class Environment(testmod.Environment):
         self.stateid0 = stateid4(0, b'')
         self.stateid1 = stateid4(0xffffffff, b'\xff'*12)
 
-        log.info("Created client to %s, %i" % (opts.server, opts.port))
+        log.info("Created client to %s" % (self.c1.server_address,))
 
     def init(self):
         """Run once before any test is run"""
@@ -7,6 +7,7 @@ import random
 import nfs4lib
 import threading
 from rpc.rpc import RPCAcceptError, GARBAGE_ARGS
+from rpc.security import AuthSys
 
 def create_session(c, clientid, sequenceid, cred=None, flags=0):
     """Send a simple CREATE_SESSION"""
@@ -539,3 +540,29 @@ def testDRCMemLeak(t, env):
                                           fchan_attrs, bchan_attrs,
                                           123, [])], None)
     check(res, NFS4_OK)
+
+def testRepAtLimitBigCred(t, env):
+    """A reply exactly ca_maxresponsesize long, RPC header included, is
+       sent, even if the call had a larger RPC header
+
+    FLAGS: create_session all
+    CODE: CSESS30
+    """
+    c = env.c1.new_client(env.testname(t))
+    # An AUTH_SYS credential of several hundred bytes
+    cred = AuthSys().init_cred(uid=1111, gid=37, name=b"m" * 255,
+                               gids=list(range(16)))
+    ops = [op.putrootfh(), op.getfh()]
+    sess1 = c.create_session()
+    sess1.compound([op.reclaim_complete(FALSE)])
+    res = sess1.compound(ops, credinfo=cred)
+    check(res)
+    # The reply to AUTH_SYS has a NULL verifier, so a 24 byte RPC header
+    p = nfs4lib.FancyNFS4Packer()
+    p.pack_COMPOUND4res(res)
+    size = 24 + len(p.get_buffer())
+
+    chan_attrs = channel_attrs4(0,8192,size,size,128,8,[])
+    sess2 = c.create_session(fore_attrs=chan_attrs)
+    res = sess2.compound(ops, credinfo=cred)
+    check(res)
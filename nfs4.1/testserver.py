@@ -161,6 +161,19 @@ def scan_options(p):
                  help="Try to use 'secure' port number <1024 for client [False]")
     p.add_option_group(g)
 
+    g = OptionGroup(p, "Transport options",
+                    "By default the server is reached over TCP.  When it "
+                    "runs on the same host, the TCP stack can be bypassed.")
+    g.add_option("--transport", type="choice", default="tcp",
+                 choices=["tcp", "unix", "local"],
+                 help="tcp connects to SERVER, unix to the AF_UNIX socket "
+                 "given by --socket, local runs nfs4server.py in this "
+                 "process and connects over socketpairs [tcp]")
+    g.add_option("--socket", default=None, metavar="PATH",
+                 help="AF_UNIX socket for --transport=unix, "
+                 "see nfs4server.py --unix")
+    p.add_option_group(g)
+
 
     g = OptionGroup(p, "Server reboot script options",
                     "When running reboot scripts, these options determine "
@@ -177,6 +190,17 @@ def scan_options(p):
 
     return p.parse_args()
 
+def start_local_server():
+    """Run nfs4server.py with its default options in a background thread"""
+    import threading
+    import nfs4server
+    server = nfs4server.NFS4Server(port=None)
+    nfs4server.read_exports(server, nfs4server.scan_options([]))
+    t = threading.Thread(target=server.start, name="LocalServer")
+    t.setDaemon(True)
+    t.start()
+    return server
+
 class Argtype(object):
     """Args that are not options are either flags or testcodes"""
     def __init__(self, obj, run=True, flag=True):
@@ -258,6 +282,8 @@ def main():
         p.error("%s not a valid server name" % url)
 
     opt.server, opt.port = server_list[0]
+    if opt.transport == "unix" and opt.socket is None:
+        p.error("--transport=unix needs --socket")
 
     if not args:
         p.error("No tests given")
@@ -326,6 +352,12 @@ def main():
     tests.sort() # FIXME - add options for random sort
 
     # Run the tests and save/print(results)
+    if opt.transport == "unix":
+        opt.address = opt.socket
+    elif opt.transport == "local":
+        opt.address = start_local_server()
+    else:
+        opt.address = None
     try:
         env = environment.Environment(opt)
         env.init()
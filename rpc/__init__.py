@@ -1,3 +1 @@
-from rpc import *
-
 __all__ = ["rpc"]
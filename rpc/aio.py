@@ -0,0 +1,398 @@
+"""asyncio transport for ONC RPC
+
+This runs the same record marking, xid matching and security handling as
+rpc.RpcPipe, but on an asyncio event loop instead of the select thread in
+rpc.ConnectionHandler.  Any number of calls can be outstanding from a
+single thread, since waiting for a reply does not tie up a thread:
+
+    async def main():
+        client = AsyncClient(NFS4_PROGRAM, 4)
+        pipe = await client.connect(("server", 2049))
+        xids = [await client.send_call(pipe, 0) for i in range(1000)]
+        replies = [await client.listen(pipe, xid) for xid in xids]
+
+Incoming calls are handed to an rpc.Server (or anything else derived from
+rpc.ConnectionHandler), so existing handle_* methods run unchanged:
+
+    server = NFS4Server(port=None)
+    asyncio.run(serve_forever(server, "", 2049))
+
+The pipes keep the blocking RpcPipe interface as a compatibility shim, so
+threaded code such as a server sending callbacks from a worker thread, or
+a client using LoopThread, can keep calling send_call() and listen().
+"""
+from __future__ import absolute_import
+
+import asyncio
+import socket
+import threading
+import time
+import logging
+
+from . import rpc
+from .rpc_const import *
+
+log_a = logging.getLogger("rpc.aio")
+
+class AsyncDeferredData(rpc.CallFuture):
+    """A CallFuture which can also be awaited on the event loop"""
+    def __init__(self, msg=None, xid=None, deadline=None):
+        rpc.CallFuture.__init__(self, msg, xid, deadline)
+        self.future = None # Set by AsyncRpcPipe.wait, if anyone awaits us
+
+    def fill(self, data=None, exception=None):
+        # Replies are filled in on the event loop thread, but
+        # expire_calls may run in any thread
+        rpc.CallFuture.fill(self, data, exception)
+        future = self.future
+        if future is None:
+            return
+        loop = future.get_loop()
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            _wake(future)
+        else:
+            loop.call_soon_threadsafe(_wake, future)
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class LoopDispatcher(object):
+    """Handle incoming calls on the event loop thread itself.
+
+    Only suitable when the handle_* methods never block.
+    """
+    capacity = 0 # No limit on records outstanding
+
+    def __init__(self, loop):
+        self._loop = loop
+        self.submitted = 0
+
+    def submit(self, pipe, func, *args):
+        self.submitted += 1
+        self._loop.call_soon_threadsafe(func, *args)
+
+    def stats(self):
+        return {"workers" : 0,
+                "busy" : 0,
+                "queue_depth" : 0,
+                "submitted" : self.submitted,
+                }
+
+class AsyncRpcPipe(rpc.RpcPipe, asyncio.BufferedProtocol):
+    """An RpcPipe running as an asyncio protocol.
+
+    Incoming CALLs are handed to handler.dispatcher, where handler is an
+    rpc.ConnectionHandler.  Without a handler, incoming CALLs are dropped.
+    The handler's flow limits are applied by pausing the transport.
+    """
+    _deferred = AsyncDeferredData
+    wsize = 4098 # Max size of record fragments we send
+
+    def __init__(self, handler=None):
+        rpc.RpcPipe.__init__(self, None, None)
+        self.handler = handler
+        self._transport = None
+        self._loop = None
+        self._thread = None # The event loop thread
+
+    def __str__(self):
+        return "aiopipe-%s" % id(self)
+
+    # Protocol callbacks, all run on the event loop thread
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._s = transport.get_extra_info("socket")
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.current_thread()
+        if self.handler is not None and self.handler.max_backlog:
+            transport.set_write_buffer_limits(high=self.handler.max_backlog)
+        log_a.info("connection made to %s" %
+                   (transport.get_extra_info("peername"),))
+
+    def connection_lost(self, exc):
+        log_a.info("connection lost: %s" % exc)
+        self.clear_active()
+        self._transport = None
+        if self.handler is not None:
+            self.handler._throttle_forget(self)
+        # Nothing more can arrive, so fail anyone still waiting
+        for xid, defer in list(self._pending.items()):
+            if not defer.done():
+                defer.fill(None, rpc.RPCError("Connection lost"))
+
+    def get_buffer(self, sizehint):
+        self._make_room(max(sizehint, rpc.RECV_BUFSIZE // 2))
+        return memoryview(self._rbuf)[self._rend:]
+
+    def buffer_updated(self, nbytes):
+        self._rend += nbytes
+        for record in self._parse_records():
+            self._record_received(record)
+        if self.held_calls:
+            self._flow_check()
+
+    def eof_received(self):
+        return False # Close the transport
+
+    def pause_writing(self):
+        if self.handler is not None:
+            self._flow_check()
+
+    def resume_writing(self):
+        if self.handler is not None:
+            self._flow_check()
+
+    def _record_received(self, record):
+        if record[4:8] == rpc._REPLY_MTYPE or self.handler is None:
+            # Replies are handled right here, see rpc.ConnectionHandler
+            self._reply_received(record)
+        else:
+            self.held_calls.append((record, time.perf_counter()))
+            self.held_bytes += len(record)
+
+    def _reply_received(self, record):
+        try:
+            p = rpc.FancyRPCUnpacker(record)
+            msg = p.unpack_rpc_msg()
+            msg_data = record[p.get_position():]
+        except (rpc.rpc_pack.XDRError, EOFError) as e:
+            log_a.warn("XDRError: %s, dropping packet" % e)
+            return
+        if msg.mtype != REPLY:
+            log_a.warn("No handler for incoming CALL, dropping it")
+            return
+        try:
+            self.rcv_reply(msg, msg_data)
+        except Exception:
+            log_a.warn("Dropped reply with xid=%i" % msg.xid, exc_info=True)
+
+    # Flow control, see rpc.ConnectionHandler._throttle_check
+
+    def _flow_check(self):
+        if self._transport is None:
+            return
+        was_ok = self not in self.handler._throttled
+        ok = self.handler._flow_update(self)
+        if ok != was_ok:
+            if ok:
+                self._transport.resume_reading()
+            else:
+                self._transport.pause_reading()
+
+    def write_backlog(self):
+        if self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
+
+    def call_done(self):
+        # Runs after any reply, since call_soon_threadsafe is FIFO
+        if threading.current_thread() is self._thread:
+            self._call_done()
+        else:
+            self._loop.call_soon_threadsafe(self._call_done)
+
+    def _call_done(self):
+        for pipe in self.handler._call_done(self):
+            pipe._flow_check()
+
+    # Sending, which may be done from any thread
+
+    def push_record(self, record):
+        if threading.current_thread() is self._thread:
+            self._write_record(record)
+        else:
+            self._loop.call_soon_threadsafe(self._write_record, record)
+
+    def _write_record(self, record):
+        if self._transport is None or self._transport.is_closing():
+            log_a.warn("Dropping record sent on closed connection")
+            return
+        self._write_queue.appendleft(record)
+        self.pop_record(self.wsize)
+        self._transport.writelines(self._write_segs)
+        self._write_segs.clear()
+
+    # Waiting for replies
+
+    async def wait(self, xid, timeout=300):
+        """Wait for a reply to a CALL, without blocking the event loop"""
+        defer = self._pending[xid]
+        try:
+            if not defer.done():
+                defer.future = future = self._loop.create_future()
+                if defer.done():
+                    # expire_calls filled it from another thread before
+                    # future was set, so did not wake it
+                    _wake(future)
+                try:
+                    await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    raise rpc.RPCTimeout
+        finally:
+            self._pending.pop(xid, None)
+        return defer.result()
+
+    def listen(self, xid, timeout=None):
+        """Blocking wait for a reply, for use by threads other than the loop"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("listen() would block the event loop, "
+                               "use wait() instead")
+        return rpc.RpcPipe.listen(self, xid, timeout)
+
+    def close(self):
+        if self._transport is not None:
+            self._loop.call_soon_threadsafe(self._transport.close)
+
+def _make_socket(address, secure):
+    """Return a socket connected to address, optionally from a port < 1024
+
+    address may also be an AF_UNIX path or a ConnectionHandler, as for
+    rpc.ConnectionHandler.connect.
+    """
+    if isinstance(address, rpc.ConnectionHandler):
+        s, peer = socket.socketpair()
+        address.add_connection(peer)
+        return s
+    if isinstance(address, str):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(address)
+        return s
+    host, port = address
+    for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        af, socktype, proto, cannonname, sa = res
+        s = socket.socket(af, socktype, proto)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if secure:
+                rpc.bindsocket(s)
+            s.connect(sa)
+            return s
+        except socket.error:
+            s.close()
+    raise socket.error("Could not connect to %s:%s" % (host, port))
+
+async def connect(address, handler=None, secure=False):
+    """Connect to given address, returning a new AsyncRpcPipe
+
+    If secure==True, will bind local socket to a port < 1024.
+    """
+    loop = asyncio.get_running_loop()
+    s = await loop.run_in_executor(None, _make_socket, address, secure)
+    s.setblocking(0)
+    transport, pipe = await loop.create_connection(
+        lambda: AsyncRpcPipe(handler), sock=s)
+    return pipe
+
+async def serve(handler, host, port, inline=False):
+    """Start accepting calls for handler, returning the asyncio Server
+
+    handler is an rpc.Server, whose dispatcher decides which threads run
+    incoming calls.  If inline is True, they are run on the event loop,
+    by replacing handler.dispatcher with a LoopDispatcher.  Connections
+    the handler opens itself are made on the event loop too, by replacing
+    handler.connect.  Both stay in place after the server closes, so save
+    and restore them if the handler is to be used again.
+    """
+    loop = asyncio.get_running_loop()
+    if inline:
+        handler.dispatcher = LoopDispatcher(loop)
+    # The handler's own polling loop is not running, so connections it
+    # opens, say to a data server, must be made on this loop as well
+    handler.connect = _LoopConnect(loop, handler)
+    return await loop.create_server(lambda: AsyncRpcPipe(handler),
+                                    host or None, port, reuse_address=True)
+
+async def serve_forever(handler, host, port, inline=False):
+    """As serve, then run until cancelled, restoring handler.dispatcher
+
+    handler.connect is restored as well.
+    """
+    dispatcher = handler.dispatcher
+    try:
+        server = await serve(handler, host, port, inline)
+        async with server:
+            await server.serve_forever()
+    finally:
+        handler.dispatcher = dispatcher
+        handler.__dict__.pop("connect", None)
+
+class _LoopConnect(object):
+    """Replaces handler.connect while the handler is served by serve()
+
+    Blocks the calling thread, which must not be the loop's, until an
+    AsyncRpcPipe to address is open on loop.
+    """
+    def __init__(self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+
+    def __call__(self, address, secure=False, udp=False):
+        if udp:
+            raise ValueError("udp is not supported on asyncio")
+        future = asyncio.run_coroutine_threadsafe(
+            connect(address, self.handler, secure), self.loop)
+        return future.result()
+
+class AsyncClient(object):
+    """The coroutine version of rpc.Client"""
+    def __init__(self, program=None, version=None, secureport=False,
+                 handler=None):
+        self.default_prog = program
+        self.default_vers = version
+        self.default_cred = rpc.security.CredInfo()
+        self.secureport = secureport
+        self.handler = handler # Handles incoming callbacks, if any
+
+    async def connect(self, address, secure=None):
+        if secure is None:
+            secure = self.secureport
+        return await connect(address, self.handler, secure)
+
+    async def send_call(self, pipe, procedure, data=b'', credinfo=None,
+                        program=None, version=None):
+        if program is None: program = self.default_prog
+        if version is None: version = self.default_vers
+        if program is None or version is None:
+            raise Exception("Badness")
+        if credinfo is None:
+            credinfo = self.default_cred
+        return pipe.send_call(program, version, procedure, data, credinfo)
+
+    async def listen(self, pipe, xid, timeout=300):
+        return await pipe.wait(xid, timeout)
+
+    async def call(self, pipe, procedure, data=b'', credinfo=None,
+                   program=None, version=None, timeout=300):
+        """Send a CALL and wait for the reply, returning (header, data)"""
+        xid = await self.send_call(pipe, procedure, data, credinfo,
+                                   program, version)
+        return await pipe.wait(xid, timeout)
+
+class LoopThread(object):
+    """An event loop running in a background thread.
+
+    Lets threaded code open AsyncRpcPipes, and then use them through the
+    usual blocking send_call()/listen() interface.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        t = threading.Thread(target=self.loop.run_forever, name="AsyncioLoop",
+                             daemon=True)
+        t.start()
+
+    def run(self, coro, timeout=None):
+        """Run coroutine on the loop, blocking until it finishes"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    def connect(self, address, handler=None, secure=False):
+        return self.run(connect(address, handler, secure))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,148 @@
+"""Duplicate request cache for RPC programs without sessions
+
+A client which times out retransmits its CALL with the same xid.  If the
+first copy was in fact handled, a non-idempotent procedure (say a CREATE,
+RENAME or REMOVE) would be run twice, and the client would see an error
+for an operation that succeeded.  The cache remembers recent replies so
+that the retransmit is answered with the original reply instead:
+
+    drc = DuplicateRequestCache()
+    key = drc.make_key(xid, address, prog, vers, proc, flavor, args)
+    state, reply = drc.lookup(key)
+    if state == HIT:
+        send(reply)
+    elif state == MISS:
+        reply = handle_call()
+        drc.complete(key, reply, len(reply))
+        send(reply)
+    # else IN_PROGRESS: the original is still running, drop the retransmit
+
+This uses nothing outside the standard library, so the legacy nfs4.0
+rpc code can share it.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+RPCSEC_GSS = 6 # From rpc.x, not imported so as to stay self-contained
+
+# Returned by DuplicateRequestCache.lookup
+MISS = 0
+HIT = 1
+IN_PROGRESS = 2
+
+class _Entry(object):
+    __slots__ = ("reply", "size", "time")
+
+    def __init__(self):
+        self.reply = None # None while the call is being handled
+        self.size = 0
+        self.time = time.monotonic()
+
+class DuplicateRequestCache(object):
+    """Bounded LRU cache of replies, keyed on (xid, client, call).
+
+    Entries are dropped once there are more than max_entries of them,
+    they use more than max_bytes, or they are older than max_age seconds.
+    """
+    def __init__(self, max_entries=4096, max_bytes=16 << 20, max_age=120.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # {key: _Entry}, oldest first
+        self._bytes = 0
+        # Statistics, see stats
+        self.hits = 0
+        self.misses = 0
+        self.in_progress = 0 # Retransmits which arrived before the reply
+        self.evictions = 0
+
+    def make_key(self, xid, address, prog, vers, proc, flavor, args):
+        """Return the key for a call, or None if it should not be cached.
+
+        address identifies the client.  Over TCP it should be only the
+        host, since a client which reconnects to retransmit has a new port.
+        NULL calls are not worth caching, and RPCSEC_GSS retransmits carry
+        a new sequence number, so never look like duplicates.
+        The checksum catches a client reusing an xid for a different call.
+        """
+        if proc == 0 or flavor == RPCSEC_GSS:
+            return None
+        return (xid, address, prog, vers, proc, len(args), zlib.crc32(args))
+
+    def lookup(self, key):
+        """Return (state, reply), where state is one of MISS, HIT, IN_PROGRESS.
+
+        On a MISS an entry is created for the call, which the caller must
+        finish with complete() or abandon().
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.time > self.max_age:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                self._entries[key] = _Entry()
+                self._trim(now)
+                return MISS, None
+            if entry.reply is None:
+                self.in_progress += 1
+                return IN_PROGRESS, None
+            self.hits += 1
+            entry.time = now
+            self._entries.move_to_end(key)
+            return HIT, entry.reply
+
+    def complete(self, key, reply, size):
+        """Remember the reply to a call which lookup() reported as a MISS"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Evicted while the call was being handled
+                return
+            now = time.monotonic()
+            entry.reply = reply
+            entry.size = size
+            entry.time = now
+            self._entries.move_to_end(key)
+            self._bytes += size
+            self._trim(now)
+
+    def abandon(self, key):
+        """Forget a call which got no reply, so a retransmit is handled"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.reply is None:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _trim(self, now):
+        """Evict from the old end until within limits.  Hold self._lock."""
+        entries = self._entries
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if (len(entries) <= self.max_entries and
+                self._bytes <= self.max_bytes and
+                now - entry.time <= self.max_age):
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries" : len(self._entries),
+                    "bytes" : self._bytes,
+                    "hits" : self.hits,
+                    "misses" : self.misses,
+                    "in_progress" : self.in_progress,
+                    "evictions" : self.evictions,
+                    }
@@ -0,0 +1,217 @@
+"""Instrumentation for the RPC layer
+
+Each ConnectionHandler keeps an RpcMetrics instance in self.metrics,
+which records for every (prog, vers, proc) it serves the number of calls,
+request and reply bytes, and histograms of how long calls waited to be
+dispatched and how long they took to handle.  The cost of the security
+flavor (_check_auth, unsecure_data and secure_data) is kept per flavor.
+
+All times are recorded in microseconds.  A call costs one lock and a few
+dictionary updates, so this is cheap enough to leave running.
+
+    >>> server.metrics.snapshot()["procs"][0]["latency_us"]["p99"]
+    >>> server.metrics.dump_every("/tmp/rpc_metrics.json", 60)
+    >>> server.metrics.dump_on_signal("/tmp/rpc_metrics.json")
+"""
+from __future__ import absolute_import
+
+import os
+import json
+import math
+import signal
+import threading
+import time
+import logging
+
+log_m = logging.getLogger("rpc.metrics")
+
+class Histogram(object):
+    """Log-linear histogram of integers, in the style of HdrHistogram.
+
+    Values below 32 each get their own bucket.  Above that, each power of
+    two is split into 16 buckets, so every value is kept to within about
+    6%, however large it is.
+    """
+    def __init__(self):
+        self.counts = {} # {bucket index: count}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = int(value)
+        shift = value.bit_length() - 5
+        if shift < 0:
+            shift = 0
+        i = (shift << 4) + (value >> shift)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def bucket_range(i):
+        """Return (lowest, highest) value that lands in bucket i"""
+        if i < 32:
+            return i, i
+        shift = (i >> 4) - 1
+        low = (i - (shift << 4)) << shift
+        return low, low + (1 << shift) - 1
+
+    def percentile(self, pct):
+        """Upper bound of the value below which pct percent of values lie"""
+        if not self.count:
+            return 0
+        want = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= want:
+                return min(self.bucket_range(i)[1], self.max)
+        return self.max
+
+    def summary(self):
+        if self.count:
+            mean = self.total / float(self.count)
+        else:
+            mean = 0.0
+        return {"count" : self.count,
+                "mean" : mean,
+                "max" : self.max,
+                "p50" : self.percentile(50),
+                "p90" : self.percentile(90),
+                "p99" : self.percentile(99),
+                "p999" : self.percentile(99.9),
+                # [lowest value in bucket, count], for merging or plotting
+                "buckets" : [[self.bucket_range(i)[0], self.counts[i]]
+                             for i in sorted(self.counts)],
+                }
+
+class ProcStats(object):
+    """What was recorded for a single (prog, vers, proc)"""
+    def __init__(self):
+        self.calls = 0
+        self.drops = 0 # Calls that got no reply
+        self.request_bytes = 0
+        self.reply_bytes = 0
+        self.queue_wait = Histogram() # From being read, to a worker starting
+        self.latency = Histogram() # From a worker starting, to the reply
+        self.security = 0 # Total time spent in the security flavor
+
+    def summary(self):
+        return {"calls" : self.calls,
+                "drops" : self.drops,
+                "request_bytes" : self.request_bytes,
+                "reply_bytes" : self.reply_bytes,
+                "queue_wait_us" : self.queue_wait.summary(),
+                "latency_us" : self.latency.summary(),
+                "security_us" : self.security,
+                }
+
+class FlavorStats(object):
+    """Cost of each step of a security flavor"""
+    def __init__(self):
+        self.check_auth = Histogram()
+        self.unsecure_data = Histogram()
+        self.secure_data = Histogram()
+
+    def summary(self):
+        return {"check_auth_us" : self.check_auth.summary(),
+                "unsecure_data_us" : self.unsecure_data.summary(),
+                "secure_data_us" : self.secure_data.summary(),
+                }
+
+class RpcMetrics(object):
+    """Per procedure statistics, for ConnectionHandler._event_rpc_call"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.procs = {} # {(prog, vers, proc): ProcStats}
+            self.flavors = {} # {flavor: FlavorStats}
+            self.start_time = time.time()
+
+    def add_call(self, prog, vers, proc, flavor, request_bytes, reply_bytes,
+                 queue_wait, latency, check_auth, unsecure_data, secure_data):
+        """Record a call.  Times are in seconds, reply_bytes is None if
+        the call was dropped, and unused security steps are None.
+        """
+        key = (prog, vers, proc)
+        with self._lock:
+            stats = self.procs.get(key)
+            if stats is None:
+                stats = self.procs[key] = ProcStats()
+            stats.calls += 1
+            stats.request_bytes += request_bytes
+            if reply_bytes is None:
+                stats.drops += 1
+            else:
+                stats.reply_bytes += reply_bytes
+            stats.queue_wait.record(queue_wait * 1e6)
+            stats.latency.record(latency * 1e6)
+            if check_auth is None:
+                # Call was rejected before reaching the security flavor
+                return
+            fstats = self.flavors.get(flavor)
+            if fstats is None:
+                fstats = self.flavors[flavor] = FlavorStats()
+            fstats.check_auth.record(check_auth * 1e6)
+            used = check_auth
+            if unsecure_data is not None:
+                fstats.unsecure_data.record(unsecure_data * 1e6)
+                used += unsecure_data
+            if secure_data is not None:
+                fstats.secure_data.record(secure_data * 1e6)
+                used += secure_data
+            stats.security += int(used * 1e6)
+
+    def snapshot(self):
+        """Return everything recorded so far, in a form json can dump"""
+        with self._lock:
+            procs = []
+            for (prog, vers, proc), stats in sorted(self.procs.items()):
+                d = stats.summary()
+                d.update(prog=prog, vers=vers, proc=proc)
+                procs.append(d)
+            flavors = dict((str(flavor), stats.summary())
+                           for flavor, stats in self.flavors.items())
+            return {"time" : time.time(),
+                    "uptime" : time.time() - self.start_time,
+                    "procs" : procs,
+                    "flavors" : flavors,
+                    }
+
+    def dump(self, path):
+        """Write snapshot to path as JSON, replacing it atomically"""
+        tmp = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp, "w") as fd:
+            json.dump(self.snapshot(), fd, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    def dump_every(self, path, interval):
+        """Start a thread which dumps to path every interval seconds"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except Exception:
+                    log_m.error("Could not dump metrics to %s" % path,
+                                exc_info=True)
+        t = threading.Thread(target=loop, name="RPCMetrics", daemon=True)
+        t.start()
+
+    def dump_on_signal(self, path, signum=signal.SIGUSR1):
+        """Dump to path whenever signum arrives.
+
+        Must be called from the main thread.
+        """
+        def handler(signum, frame):
+            # The interrupted code may hold our lock, so let another
+            # thread do the work.
+            t = threading.Thread(target=self.dump, args=(path,), daemon=True)
+            t.start()
+        signal.signal(signum, handler)
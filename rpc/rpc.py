@@ -1,12 +1,18 @@
 from __future__ import with_statement
 from __future__ import absolute_import
 
+import os
+import stat
 import socket, select
+import selectors
 import struct
 import threading
 import logging
+import time
+import concurrent.futures
 from collections import deque as Deque
-from errno import EINPROGRESS, EWOULDBLOCK, EADDRINUSE
+from itertools import islice
+from errno import EADDRINUSE
 
 from . import rpc_pack
 from .rpc_const import *
@@ -14,6 +20,9 @@ from .rpc_type import *
 
 from . import security
 from . import rpclib
+from .metrics import RpcMetrics
+from . import drc
+from .drc import DuplicateRequestCache
 import random
 
 log_p = logging.getLogger("rpc.poll") # polling loop thread
@@ -24,6 +33,18 @@ log_t = logging.getLogger("rpc.thread") # handler threads
 
 LOOPBACK = "127.0.0.1"
 
+_REPLY_MTYPE = struct.pack(">L", REPLY) # Follows the xid in a reply record
+_CALL_MTYPE = struct.pack(">L", CALL) # Follows the xid in a call record
+_unpack_mark = struct.Struct(">L").unpack_from # Reads a record mark
+_pack_mark = struct.Struct(">L").pack # Builds a record mark
+
+RECV_BUFSIZE = 65536 # Initial size of each pipe's receive buffer
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX") # Max buffers per sendmsg call
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
 def inc_u32(i):
     """Increment a 32 bit integer, with wrap-around."""
     return int( (i+1) & 0xffffffff )
@@ -162,39 +183,394 @@ class DeferredData(object):
         self.data = data
         self._filled.set()
 
-class Alarm(object):
-    """A method of notifying select loop that there is data waiting"""
-    def __init__(self, address):
-        self._queue = Deque()
-        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._s.setblocking(0)
+class CallFuture(concurrent.futures.Future):
+    """The reply to a CALL made with RpcPipe.send_call.
+
+    result() is the (header, data) pair that RpcPipe.listen returns, or
+    raises the error that listen would.  Since this is a
+    concurrent.futures.Future, callbacks can be attached with
+    add_done_callback, and many calls can be waited on together with
+    concurrent.futures.wait or as_completed (see also RpcPipe.wait_any
+    and wait_all).
+
+    It also offers the fill/wait interface of DeferredData, which is
+    what RpcPipe itself uses.
+    """
+    def __init__(self, msg=None, xid=None, deadline=None):
+        concurrent.futures.Future.__init__(self)
+        self.msg = msg # (cred, sec), used to check the reply
+        self.xid = xid
+        # time.monotonic() after which RpcPipe.expire_calls fails the call
+        self.deadline = deadline
+        # False if the caller holds on to this future itself, rather than
+        # collecting the reply with RpcPipe.listen
+        self.keep = True
+
+    def fill(self, data=None, exception=None):
         try:
-            self._s.connect(address)
-        except socket.error as e:
-            if e.args[0] in [EINPROGRESS, EWOULDBLOCK]:
-                # address has not yet called accept, since this is done in a
-                # single thread, so get "op in progress error".  When the
-                # receiving end calls accept, all is good.
-                pass
+            if exception is None:
+                self.set_result(data)
             else:
-                raise
+                self.set_exception(exception)
+        except concurrent.futures.InvalidStateError:
+            # Already failed by expire_calls, or cancelled
+            pass
+
+    def wait(self, timeout=300):
+        """Return the reply, raising RPCTimeout if it takes too long"""
+        try:
+            return self.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise RPCTimeout
+
+class Alarm(object):
+    """A method of notifying the polling loop that there is work waiting.
+
+    Other threads queue (command, info) pairs with buzz.  However many
+    buzzes arrive before the polling loop gets to them, it is woken only
+    once, and then runs every queued command (see clear and pop).
+
+    The wakeup is an eventfd where the os module has one (Linux), and
+    otherwise a socketpair used as a self-pipe.
+    """
+    def __init__(self):
+        self._queue = Deque() # appendleft and pop are thread safe
+        # True from the first buzz until the polling loop calls clear,
+        # while a wakeup is already on its way.
+        self._signalled = False
+        self.wakeups = 0 # Number of times the polling loop was woken
+        if hasattr(os, "eventfd"):
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._r = self._w = None
+        else:
+            self._r, self._w = socket.socketpair()
+            self._r.setblocking(0)
+            self._w.setblocking(0)
+            self._fd = self._r.fileno()
+
+    def fileno(self):
+        """The fd for the polling loop to wait on"""
+        return self._fd
 
     def buzz(self, command, info):
         """Wake the polling loop, passing it info"""
-        self._queue.appendleft(info)
-        # Send one byte of data 'command' to wake select loop
-        # Note bytes sent are counted to determine how many items to pop
-        while (not self._s.send(command)):
-            # Just loop here until we actually send something
+        self._queue.appendleft((command[0], info))
+        # Note the flag is only tested after queueing, and clear resets it
+        # before draining, so a command can never be left behind.
+        if self._signalled:
+            return
+        self._signalled = True
+        if self._w is None:
+            os.eventfd_write(self._fd, 1)
+        else:
+            try:
+                self._w.send(b'\0')
+            except BlockingIOError:
+                # Buffer is full of earlier wakeups, so one is pending
+                pass
+
+    def clear(self):
+        """Called by polling loop when woken, before popping commands"""
+        self.wakeups += 1
+        try:
+            if self._w is None:
+                os.eventfd_read(self._fd)
+            else:
+                while self._r.recv(4096):
+                    pass
+        except BlockingIOError:
             pass
+        self._signalled = False
 
     def pop(self):
-        """Called by polling loop to grab the info passed in by buzz"""
+        """Called by polling loop to grab the (command, info) from buzz.
+
+        Raises IndexError once nothing is left.
+        """
         return self._queue.pop()
 
-    def __getattr__(self, attr):
-        """Show socket interface"""
-        return getattr(self._s, attr)
+    def close(self):
+        if self._w is None:
+            os.close(self._fd)
+        else:
+            self._r.close()
+            self._w.close()
+
+class EpollPoller(object):
+    """Edge-triggered epoll interest management (Linux only).
+
+    Each fd is registered exactly once, for both read and write edges, so
+    interest never has to be modified as data comes and goes.  Since an
+    edge is only reported once, the caller must drain reads and writes
+    until EWOULDBLOCK.
+    """
+    edge = True
+
+    def __init__(self):
+        self._ep = select.epoll()
+        self._mask = (select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP |
+                      select.EPOLLET)
+        self._rmask = (select.EPOLLIN | select.EPOLLRDHUP |
+                       select.EPOLLERR | select.EPOLLHUP)
+
+    def register(self, fd):
+        self._ep.register(fd, self._mask)
+
+    def unregister(self, fd):
+        try:
+            self._ep.unregister(fd)
+        except (OSError, ValueError):
+            pass
+
+    def want_write(self, fd, flag):
+        """Write edges are always armed, so there is nothing to do"""
+        pass
+
+    def want_read(self, fd, flag):
+        """Read edges are always armed, the caller ignores unwanted ones"""
+        pass
+
+    def poll(self, timeout=None):
+        """Returns list of (fd, readable, writable)"""
+        if timeout is None:
+            timeout = -1
+        return [(fd, bool(ev & self._rmask), bool(ev & select.EPOLLOUT))
+                for fd, ev in self._ep.poll(timeout)]
+
+    def close(self):
+        self._ep.close()
+
+class SelectorPoller(object):
+    """Level-triggered interest management using the selectors module.
+
+    Used where epoll is not available.  Write interest is only
+    armed while a pipe has data waiting to go out, and read interest is
+    dropped while a pipe is throttled.
+    """
+    edge = False
+
+    def __init__(self):
+        self._sel = selectors.DefaultSelector()
+        self._events = {} # {fd: interest mask}, may be 0
+
+    def register(self, fd):
+        self._events[fd] = selectors.EVENT_READ
+        self._sel.register(fd, selectors.EVENT_READ)
+
+    def unregister(self, fd):
+        if self._events.pop(fd, 0):
+            try:
+                self._sel.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+
+    def _set(self, fd, bit, flag):
+        old = self._events.get(fd)
+        if old is None:
+            return
+        new = (old | bit) if flag else (old & ~bit)
+        if new == old:
+            return
+        self._events[fd] = new
+        # selectors will not take an empty mask, so drop the fd instead
+        if not old:
+            self._sel.register(fd, new)
+        elif not new:
+            self._sel.unregister(fd)
+        else:
+            self._sel.modify(fd, new)
+
+    def want_write(self, fd, flag):
+        self._set(fd, selectors.EVENT_WRITE, flag)
+
+    def want_read(self, fd, flag):
+        self._set(fd, selectors.EVENT_READ, flag)
+
+    def poll(self, timeout=None):
+        """Returns list of (fd, readable, writable)"""
+        return [(key.fd, bool(mask & selectors.EVENT_READ),
+                 bool(mask & selectors.EVENT_WRITE))
+                for key, mask in self._sel.select(timeout)]
+
+    def close(self):
+        self._sel.close()
+
+pollers = {"epoll" : EpollPoller,
+           "selectors" : SelectorPoller,
+           }
+
+def make_poller(kind=None):
+    """Return a new poller of the given kind, or the best one available."""
+    if kind is None:
+        if hasattr(select, "epoll"):
+            kind = "epoll"
+        else:
+            kind = "selectors"
+    try:
+        return pollers[kind]()
+    except KeyError:
+        raise ValueError("Unknown poller %r, choose from %s" %
+                         (kind, sorted(pollers)))
+
+class ThreadDispatcher(object):
+    """Hand each incoming record to a brand new thread.
+
+    This is the historical behavior, and has no upper bound.
+    """
+    capacity = 0 # No limit on records outstanding
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self._busy = 0
+
+    def submit(self, pipe, func, *args):
+        with self._lock:
+            self.submitted += 1
+        t = threading.Thread(target=self._run, args=(func, args), daemon=True)
+        t.start()
+
+    def _run(self, func, args):
+        with self._lock:
+            self._busy += 1
+        try:
+            func(*args)
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"workers" : None,
+                    "busy" : self._busy,
+                    "queue_depth" : 0,
+                    "submitted" : self.submitted,
+                    }
+
+class InlineDispatcher(object):
+    """Handle each incoming record on the polling thread itself.
+
+    Only suitable when the handle_* methods never block, since no other
+    connection is serviced meanwhile.  Saves handing every call to
+    another thread, which costs more than a short call itself.
+    """
+    capacity = 0 # No limit on records outstanding
+
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, pipe, func, *args):
+        self.submitted += 1
+        func(*args)
+
+    def stats(self):
+        return {"workers" : 0,
+                "busy" : 0,
+                "queue_depth" : 0,
+                "submitted" : self.submitted,
+                }
+
+class WorkerPool(object):
+    """A fixed set of threads handling incoming records.
+
+    Records are queued per connection, and connections take turns, so one
+    busy client can not starve the others.  At most per_pipe records from
+    any single connection are handled at once.  submit never blocks, since
+    it is called by the polling thread.  Instead callers keep at most
+    capacity records outstanding, see ConnectionHandler._over_limit.
+    """
+    def __init__(self, workers, queue_size=1024, per_pipe=None):
+        if workers < 1:
+            raise ValueError("Need at least one worker, got %i" % workers)
+        if per_pipe is None:
+            per_pipe = max(1, workers // 2)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_pipe = per_pipe
+        self.capacity = workers + queue_size # Records running or queued
+        self._work = threading.Condition() # Signalled when _ready grows
+        self._ready = Deque() # Pipes with queued records and spare capacity
+        self._queued = {} # {pipe: Deque of (func, args)}
+        self._running = {} # {pipe: number of records being handled}
+        self._depth = 0 # Total number of queued records
+        self._busy = 0 # Number of workers handling a record
+        # Statistics
+        self.submitted = 0
+        self.completed = 0
+        self.max_depth = 0
+        self._busy_time = 0.0
+        self._start_time = time.time()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name="RPCWorker-%i" % i,
+                                 daemon=True)
+            t.start()
+
+    def submit(self, pipe, func, *args):
+        """Queue func(*args) to be run on behalf of pipe."""
+        with self._work:
+            q = self._queued.get(pipe)
+            if q is None:
+                q = self._queued[pipe] = Deque()
+            q.append((func, args))
+            self._depth += 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._depth)
+            if len(q) == 1 and self._running.get(pipe, 0) < self.per_pipe:
+                self._ready.append(pipe)
+                self._work.notify()
+
+    def _worker(self):
+        while True:
+            with self._work:
+                while not self._ready:
+                    self._work.wait()
+                pipe = self._ready.popleft()
+                q = self._queued[pipe]
+                func, args = q.popleft()
+                self._depth -= 1
+                running = self._running.get(pipe, 0) + 1
+                self._running[pipe] = running
+                if not q:
+                    del self._queued[pipe]
+                elif running < self.per_pipe:
+                    # Go to the back of the line
+                    self._ready.append(pipe)
+                self._busy += 1
+            start = time.time()
+            try:
+                func(*args)
+            except Exception:
+                log_t.error("Unhandled exception in worker", exc_info=True)
+            with self._work:
+                self._busy_time += time.time() - start
+                self._busy -= 1
+                self.completed += 1
+                running = self._running.pop(pipe) - 1
+                if running:
+                    self._running[pipe] = running
+                if pipe in self._queued and running == self.per_pipe - 1:
+                    # pipe was at its limit, so was not in _ready
+                    self._ready.append(pipe)
+                    self._work.notify()
+
+    def stats(self):
+        """Return a dictionary showing how busy the pool is"""
+        with self._work:
+            elapsed = time.time() - self._start_time
+            return {"workers" : self.workers,
+                    "busy" : self._busy,
+                    "queue_depth" : self._depth,
+                    "max_queue_depth" : self.max_depth,
+                    "submitted" : self.submitted,
+                    "completed" : self.completed,
+                    "utilisation" : self._busy_time / (self.workers * elapsed),
+                    }
+
+def make_dispatcher(workers=None, queue_size=1024, per_connection=None):
+    """Return a WorkerPool, or a ThreadDispatcher if workers is not set"""
+    if not workers:
+        return ThreadDispatcher()
+    return WorkerPool(workers, queue_size, per_connection)
 
 class Pipe(object):
     """Groups a socket with its buffers.
@@ -240,9 +616,23 @@ class Pipe(object):
         # looked at by the main thread, so no locking is required.
         self._write_queue = Deque() # Records waiting to be sent out
         self._alarm = write_alarm # Way to notify we have data to write
-        self._write_buf = b'' # Raw outgoing data
-        self._read_buf = b'' # Raw incoming data
-        self._packet_buf = [] # Store packets read until have a whole record
+        self._write_segs = Deque() # Raw outgoing data, as list of buffers
+        self._write_offset = 0 # Amount of _write_segs[0] already sent
+        self._write_bytes = 0 # Total unsent bytes in _write_segs
+        # Number of incoming calls handed to workers but not yet finished,
+        # protected by the ConnectionHandler's flow lock.
+        self.inflight = 0
+        # Incoming calls read while over the flow limits, which wait here
+        # until earlier calls finish.  Only touched by the reading thread.
+        self.held_calls = Deque()
+        self.held_bytes = 0 # Total size of held_calls
+        # Incoming data is read into _rbuf.  Bytes before _rstart belong
+        # to records already handed out, _rpos is the next record mark to
+        # parse, and _rend is the end of data read so far.
+        self._rbuf = bytearray(RECV_BUFSIZE)
+        self._rstart = self._rpos = self._rend = 0
+        self._rneed = 0 # Buffer offset where the partial fragment ends
+        self._frags = [] # (start, end) offsets of current record's packets
 
     def __getattr__(self, attr):
         """Show socket interface"""
@@ -251,40 +641,96 @@ class Pipe(object):
     def __str__(self):
         return "pipe-%i" % self._s.fileno()
 
+    def write_backlog(self):
+        """Number of bytes waiting for the socket to accept them"""
+        return self._write_bytes
+
+    def call_done(self):
+        """An incoming call has been handled, and any reply pushed.
+
+        This may be called from any thread.  The polling thread sees it
+        after the reply, so the reply is in the write backlog by the time
+        the call stops counting as in flight.
+        """
+        self._alarm.buzz(b'\x03', self)
+
     def recv_records(self, count):
-        """Pull up to count bytes from pipe, converting into records."""
+        """Pull at least count bytes from pipe, converting into records.
+
+        Data is read with recv_into straight into self._rbuf, where
+        fragments are tracked by offset.  Once a fragment's length is
+        known, room is made for all of it, so its body lands in place and
+        is never moved.  Each finished record is copied out exactly once.
+        """
         # This is only called from main handler thread, so doesn't need locking
-        data = self._s.recv(count)
-        if not data:
+        want = max(count, self._rneed - self._rend)
+        self._make_room(want)
+        with memoryview(self._rbuf) as view:
+            got = self._s.recv_into(view[self._rend:])
+        if not got:
             # This indicates socket has closed
             return None
+        self._rend += got
+        return self._parse_records()
+
+    def _make_room(self, want):
+        """Ensure there are want bytes free at the end of self._rbuf."""
+        buf = self._rbuf
+        if len(buf) - self._rend >= want:
+            return
+        # Drop everything before the record we are working on
+        start = self._rstart
+        used = self._rend - start
+        if start:
+            buf[:used] = buf[start:self._rend]
+            self._frags = [(a - start, b - start) for a, b in self._frags]
+            self._rpos -= start
+            self._rneed -= start
+            self._rstart = 0
+            self._rend = used
+        if len(buf) - used < want:
+            buf.extend(bytes(max(want + used, 2 * len(buf)) - len(buf)))
+
+    def _parse_records(self):
+        """Walk record marks in self._rbuf, returning complete records."""
         out = []
-        self._read_buf += data
-        while self._read_buf:
-            buf = self._read_buf
-            if len(buf) < 4:
-                # We don't even have the packet length yet, wait for more data
-                break
-            packetlen = struct.unpack('>L', buf[0:4])[0]
+        buf = self._rbuf
+        pos = self._rpos
+        end = self._rend
+        while end - pos >= 4:
+            packetlen = _unpack_mark(buf, pos)[0]
             last = 0x80000000 & packetlen
             packetlen &= 0x7fffffff
-            packetlen += 4 # Include size of record mark
-            if len(buf) < packetlen:
+            if end - pos - 4 < packetlen:
                 # We don't have a full packet yet, wait for more data
+                self._rneed = pos + 4 + packetlen
                 break
-            self._packet_buf.append(buf[4:packetlen])
-            self._read_buf = buf[packetlen:]
+            self._frags.append((pos + 4, pos + 4 + packetlen))
+            pos += 4 + packetlen
             if last:
                 # We have a full RPC record.  Note this does not imply that
-                # self._read_buf is empty.
-                record = b''.join(self._packet_buf)
-                self._packet_buf = []
+                # the buffer is empty.
+                with memoryview(buf) as view:
+                    if len(self._frags) == 1:
+                        a, b = self._frags[0]
+                        record = bytes(view[a:b])
+                    else:
+                        record = b''.join([view[a:b] for a, b in self._frags])
                 out.append(record)
+                self._frags = []
+                self._rstart = pos
+        self._rpos = pos
+        if self._rstart == end:
+            # Everything has been consumed, so rewind to start of buffer
+            self._rstart = self._rpos = self._rend = self._rneed = 0
         return out
 
     def push_record(self, record):
         """Prepares handler thread to send record.
 
+        The record may be a single buffer, or a list of buffers which are
+        sent back to back without being joined.
+
         If None is sent, no further data will be accepted, and pipe will be
         closed once previous data is flushed.
         """
@@ -301,23 +747,37 @@ class Pipe(object):
         for each push_record called.  This is handled by arranging to have
         the function called each time the the polling loop responds to
         self._alarm.buzz.
-        """
-        def add_record_marks(record, count):
-            """Given a record, convert it to actual stream to send over TCP"""
-            dlen = len(record)
-            i = last = 0
-            out = b'' # FRED - use stringio here?
-            while not last:
-                chunk = record[i: i + count]
-                i += count
-                if i >= dlen:
-                    last = 0x80000000
-                mark = struct.pack('>L', last | len(chunk))
-                out += mark + chunk
-            return out
 
+        The write buffer is a list of segments, the record marks
+        interleaved with memoryviews of the record itself, so no data
+        is copied here.
+        """
         record = self._write_queue.pop()
-        self._write_buf += add_record_marks(record, count)
+        if isinstance(record, (list, tuple)):
+            views = [memoryview(r).cast('B') for r in record]
+        else:
+            views = [memoryview(record).cast('B')]
+        out = self._write_segs
+        remaining = sum(len(v) for v in views)
+        if not remaining:
+            out.append(_pack_mark(0x80000000))
+            self._write_bytes += 4
+            return
+        self._write_bytes += remaining
+        room = 0 # Bytes still to be added to current packet
+        for v in views:
+            i = 0
+            while i < len(v):
+                if not room:
+                    room = min(count, remaining)
+                    remaining -= room
+                    last = 0 if remaining else 0x80000000
+                    out.append(_pack_mark(last | room))
+                    self._write_bytes += 4
+                chunk = v[i: i + room]
+                out.append(chunk)
+                i += len(chunk)
+                room -= len(chunk)
 
     def flush_pipe(self):
         """Try to flush the write buffer.
@@ -327,15 +787,52 @@ class Pipe(object):
         Note this only flushes the buffer of raw bytes waiting to be sent.
         It does not look at the waiting stack of non-marked records.
         """
-        if not self._write_buf:
+        segs = self._write_segs
+        if not segs:
             raise RuntimeError
-        try:
-            count = self._s.send(self._write_buf)
-        except socket.error as e:
-            log_p.error("flush_pipe got exception %s" % str(e))
-            return True # This is to stop retries
-        self._write_buf = self._write_buf[count:]
-        return (not self._write_buf)
+        # Keep sending until the kernel pushes back, since with an
+        # edge-triggered poller we will not be told again.
+        while segs:
+            iov = list(islice(segs, IOV_MAX))
+            if self._write_offset:
+                iov[0] = iov[0][self._write_offset:]
+            try:
+                if HAVE_SENDMSG:
+                    count = self._s.sendmsg(iov)
+                else:
+                    count = self._s.send(iov[0])
+            except BlockingIOError:
+                return False
+            except socket.error as e:
+                log_p.error("flush_pipe got exception %s" % str(e))
+                segs.clear()
+                self._write_offset = self._write_bytes = 0
+                return True # This is to stop retries
+            self._write_bytes -= count
+            # Drop whatever has been completely sent
+            count += self._write_offset
+            while segs and count >= len(segs[0]):
+                count -= len(segs.popleft())
+            self._write_offset = count
+        return True
+
+def _wait_xids(pipe, xids, timeout, return_when):
+    """concurrent.futures.wait, on the calls of pipe with the given xids"""
+    futures = dict((pipe.future(xid), xid) for xid in xids)
+    done, not_done = concurrent.futures.wait(futures, timeout, return_when)
+    return [futures[f] for f in done]
+
+class XidCounter(object):
+    """Hands out xids, to one or more pipes"""
+    def __init__(self):
+        self._lock = threading.Lock() # Protects fields below
+        self._xid = random.randint(0, 0x7fffffff)
+
+    def next(self):
+        with self._lock:
+            out = self._xid
+            self._xid = inc_u32(out)
+        return out
 
 class RpcPipe(Pipe):
     """Hide pipe related xid handling.
@@ -347,19 +844,18 @@ class RpcPipe(Pipe):
             pipe.send_reply()
     """
     rpcversion = 2 # The RPC version that is used by default
+    _deferred = CallFuture # What send_call uses to wait for a reply
+    expire_interval = 1.0 # Seconds between checks for calls past deadline
 
     def __init__(self, *args, **kwargs):
         Pipe.__init__(self, *args, **kwargs)
         self._pending = {} # {xid:defer}
-        self._lock = threading.Lock() # Protects fields below
-        self._xid = random.randint(0, 0x7fffffff)
+        self.xids = XidCounter() # Shared by all pipes of a ConnectionPool
+        self._next_expire = 0 # When send_call should next run expire_calls
         self.set_active()
 
     def _get_xid(self):
-        with self._lock:
-            out = self._xid
-            self._xid = inc_u32(out)
-        return out
+        return self.xids.next()
 
     def set_active(self):
         self._active = True
@@ -370,27 +866,101 @@ class RpcPipe(Pipe):
     def is_active(self):
         return self._active
 
+    def reply_pipe(self, record):
+        """Return where the reply to an incoming CALL record should go"""
+        return self
+
     def listen(self, xid, timeout=None):
         """Wait for a reply to a CALL."""
-        self._pending[xid].wait(timeout)
-        reply = self._pending[xid].data # This is set at end of self.rcv_reply
-        del self._pending[xid]
-        return reply
+        try:
+            return self._pending[xid].wait(timeout)
+        finally:
+            # Whether there was a reply, an error or a timeout, nobody
+            # else is going to collect it
+            self._pending.pop(xid, None)
+
+    def future(self, xid):
+        """The CallFuture for a CALL which has not yet been listened for"""
+        return self._pending[xid]
+
+    def wait_any(self, xids, timeout=None):
+        """Wait until at least one of xids has a reply, or timeout.
+
+        Returns the list of xids whose replies have arrived, which can
+        then be collected with listen without blocking.
+        """
+        return _wait_xids(self, xids, timeout,
+                          concurrent.futures.FIRST_COMPLETED)
+
+    def wait_all(self, xids, timeout=None):
+        """Wait until all of xids have a reply, or timeout.
+
+        Returns the list of xids whose replies have arrived.
+        """
+        return _wait_xids(self, xids, timeout,
+                          concurrent.futures.ALL_COMPLETED)
+
+    def expire_calls(self, now=None):
+        """Fail calls which have passed their deadline with RPCTimeout.
+
+        Runs every expire_interval from send_call, but can be called
+        whenever.  Returns the number of calls expired.
+        """
+        if now is None:
+            now = time.monotonic()
+        self._next_expire = now + self.expire_interval
+        expired = [(xid, defer) for xid, defer in list(self._pending.items())
+                   if defer.deadline is not None and defer.deadline <= now
+                   and not defer.done()]
+        for xid, defer in expired:
+            self._pending.pop(xid, None)
+            defer.fill(None, RPCTimeout("No reply to xid=%i" % xid))
+        return len(expired)
 
     def rpc_send(self, rpc_msg, data=b''):
-        """Send raw data over pipe using given rpc_msg"""
+        """Send raw data over pipe using given rpc_msg
+
+        data may be a list of buffers, which will not be joined.
+        """
         p = FancyRPCPacker()
         p.pack_rpc_msg(rpc_msg)
         header = p.get_buffer()
-        self.push_record(header + data)
+        if isinstance(data, (list, tuple)):
+            self.push_record([header] + list(data))
+            return len(header) + sum(len(d) for d in data)
+        else:
+            self.push_record([header, data])
+            return len(header) + len(data)
 
     def send_reply(self, xid, body, proc_response=""):
-        log_t.debug("send_reply\nbody = %r\ndata=%r" % (body, proc_response))
+        """Send a REPLY, returning the size of the record"""
+        log_t.debug("send_reply\nbody = %r\ndata=%r", body, proc_response)
         msg = rpc_msg(xid, rpc_msg_body(REPLY, rbody=body))
-        self.rpc_send(msg, proc_response)
+        return self.rpc_send(msg, proc_response)
 
     def send_call(self, program, version, procedure, data, credinfo):
         """Send a CALL, and store info needed to match and verify reply."""
+        return self._send_call(program, version, procedure, data,
+                               credinfo).xid
+
+    def send_call_future(self, program, version, procedure, data, credinfo,
+                         timeout=None):
+        """Send a CALL, returning a CallFuture for the reply.
+
+        The reply is not kept for listen, the future is the only way to
+        get at it.  If timeout is given, the call fails with RPCTimeout
+        once it has waited that many seconds without a reply.
+        """
+        defer = self._send_call(program, version, procedure, data, credinfo,
+                                timeout)
+        defer.keep = False
+        if defer.done():
+            # The reply beat us to it
+            self._pending.pop(defer.xid, None)
+        return defer
+
+    def _send_call(self, program, version, procedure, data, credinfo,
+                   timeout=None):
         sec = credinfo.sec
         cred = sec.make_cred(credinfo)
         body = call_body(self.rpcversion, program, version, procedure,
@@ -399,19 +969,28 @@ class RpcPipe(Pipe):
         body.verf = sec.make_call_verf(xid, body)
         msg = rpc_msg(xid, rpc_msg_body(CALL, body))
         data = sec.secure_data(cred, data)
+        now = time.monotonic()
+        if now >= self._next_expire:
+            self.expire_calls(now)
+        if timeout is not None:
+            deadline = now + timeout
+        else:
+            deadline = None
         # Store info needed be receiving thread to match and verify reply
-        self._pending[xid] = DeferredData((cred, sec))
+        defer = self._pending[xid] = self._deferred((cred, sec), xid, deadline)
         self.rpc_send(msg, data)
-        return xid
+        return defer
 
     def rcv_reply(self, msg, msg_data):
-        """Do sec handling of reply, then hand it off to matching call event."""
-        try:
-            # This should match a CALL made with self.send_call
-            deferred = self._pending[msg.xid]
-        except IndexError:
-            log_t.warn("Reply with unexpected xid=%i" % msg.xid)
-            raise
+        """Do sec handling of reply, then hand it off to matching call event.
+
+        A reply whose xid is unknown, or whose call has expired, is dropped.
+        """
+        # This should match a CALL made with self.send_call
+        deferred = self._pending.get(msg.xid)
+        if deferred is None:
+            log_t.warn("Dropping reply with unexpected xid=%i" % msg.xid)
+            return
         exc = None # Exception that will be raised in calling thread
         cred, sec = deferred.msg # This was set in self.send_call()
         try:
@@ -430,10 +1009,282 @@ class RpcPipe(Pipe):
                 # Unsure what to do here.
                 # FRED - what is the point of verifier, if this can occur?
                 exc = RPCError("Failed to unsecure data in reply")
-        log_t.debug("Filling deferral %i" % msg.xid)
+        log_t.debug("Filling deferral %i", msg.xid)
+        if not deferred.keep:
+            # Only the holder of the future wants it now
+            self._pending.pop(msg.xid, None)
         reply = (msg, msg_data) # The return value of self.listen()
         deferred.fill(reply, exc)
 
+class Datagram(bytes):
+    """A record received over UDP, which remembers who sent it"""
+    sender = None
+
+class UdpPipe(RpcPipe):
+    """An RpcPipe over a datagram socket.
+
+    Each record is sent as a single datagram, without record marking.
+    A client's socket is connected to the server, while a server's is not,
+    so replies to incoming calls are sent through a UdpPeer.
+
+    Since datagrams can be lost, listen() retransmits the CALL, doubling
+    the wait each time, until a reply with matching xid arrives.  Calls
+    made with send_call_future are not retransmitted.
+    """
+    retrans = 1.0 # Seconds to wait for a reply before first retransmit
+    max_retrans = 30.0 # Longest wait between retransmits
+    max_datagram = 65507 # Largest payload of a UDP datagram
+    max_burst = 64 # Most datagrams recv_records reads at once
+
+    def __init__(self, *args, **kwargs):
+        RpcPipe.__init__(self, *args, **kwargs)
+        self._calls = {} # {xid: record}, kept so listen can retransmit
+
+    def __str__(self):
+        return "udppipe-%i" % self._s.fileno()
+
+    def recv_records(self, count):
+        """Read waiting datagrams, each of which is a full record"""
+        out = []
+        with memoryview(self._rbuf) as view:
+            for i in range(self.max_burst):
+                try:
+                    got, sender = self._s.recvfrom_into(view)
+                except BlockingIOError:
+                    if out:
+                        break
+                    raise
+                except ConnectionRefusedError:
+                    # ICMP error from an earlier send, which will be retried
+                    continue
+                record = Datagram(view[:got])
+                record.sender = sender
+                out.append(record)
+        return out
+
+    def reply_pipe(self, record):
+        return UdpPeer(self, record.sender)
+
+    def push_record(self, record):
+        self.push_datagram(record, None)
+
+    def push_datagram(self, record, address):
+        """Queue record to be sent to address, or the connected peer"""
+        if isinstance(record, (list, tuple)):
+            record = b''.join(record)
+        if record[4:8] == _CALL_MTYPE:
+            self._calls[struct.unpack(">L", record[:4])[0]] = record
+        self._write_queue.appendleft((record, address))
+        self._alarm.buzz(b'\x00', self)
+
+    def pop_record(self, count):
+        record, address = self._write_queue.pop()
+        if len(record) > self.max_datagram:
+            log_p.error("Dropping %i byte record, too big for UDP" %
+                        len(record))
+            return
+        self._write_segs.append((record, address))
+        self._write_bytes += len(record)
+
+    def flush_pipe(self):
+        segs = self._write_segs
+        while segs:
+            record, address = segs[0]
+            try:
+                if address is None:
+                    self._s.send(record)
+                else:
+                    self._s.sendto(record, address)
+            except BlockingIOError:
+                return False
+            except socket.error as e:
+                # Only this datagram is lost, and the caller will retransmit
+                log_p.error("flush_pipe got exception %s" % str(e))
+            segs.popleft()
+            self._write_bytes -= len(record)
+        return True
+
+    def listen(self, xid, timeout=None):
+        """Wait for a reply to a CALL, retransmitting as needed."""
+        defer = self._pending[xid]
+        wait = self.retrans
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            while True:
+                if timeout is not None:
+                    wait = min(wait, max(0, deadline - time.time()))
+                done, not_done = concurrent.futures.wait([defer], wait)
+                if done:
+                    break
+                if timeout is not None and time.time() >= deadline:
+                    del self._pending[xid]
+                    raise RPCTimeout
+                record = self._calls.get(xid)
+                if record is not None:
+                    log_t.info("Retransmitting xid=%i" % xid)
+                    self._write_queue.appendleft((record, None))
+                    self._alarm.buzz(b'\x00', self)
+                wait = min(2 * wait, self.max_retrans)
+        finally:
+            self._calls.pop(xid, None)
+        return RpcPipe.listen(self, xid, 0)
+
+    def expire_calls(self, now=None):
+        count = RpcPipe.expire_calls(self, now)
+        for xid in [xid for xid in self._calls if xid not in self._pending]:
+            self._calls.pop(xid, None)
+        return count
+
+    def rcv_reply(self, msg, msg_data):
+        if msg.xid not in self._pending:
+            # A reply to a retransmit, after we had the first reply
+            log_t.debug("Ignoring duplicate reply xid=%i" % msg.xid)
+            return
+        self._calls.pop(msg.xid, None)
+        RpcPipe.rcv_reply(self, msg, msg_data)
+
+class UdpPeer(object):
+    """Sends replies to a client of a UdpPipe.
+
+    This is what handlers see as call_info.connection for calls which
+    arrived over UDP.
+    """
+    def __init__(self, pipe, address):
+        self._pipe = pipe
+        self.address = address
+
+    def __getattr__(self, attr):
+        """Show the interface of the shared pipe"""
+        return getattr(self._pipe, attr)
+
+    def __str__(self):
+        return "%s-%s" % (self._pipe, self.address)
+
+    def getpeername(self):
+        return self.address
+
+    def push_record(self, record):
+        self._pipe.push_datagram(record, self.address)
+
+    rpc_send = RpcPipe.rpc_send
+    send_reply = RpcPipe.send_reply
+
+class ConnectionPool(object):
+    """Several pipes to the same server, used as if they were one.
+
+    This is the rpc equivalent of the nfs nconnect mount option.  Each
+    CALL goes out on one of the pipes, picked either in turn
+    (ROUND_ROBIN) or as the pipe with fewest calls still waiting to be
+    listened for (LEAST_OUTSTANDING).  The latter helps when some calls
+    take much longer than others, say a mix of READs and GETATTRs.
+    The pipes share one XidCounter, so
+    the xid returned by send_call is enough to find the reply again:
+            xid = pool.send_call(...)
+            reply = pool.listen(xid)
+    """
+    ROUND_ROBIN = "round_robin"
+    LEAST_OUTSTANDING = "least_outstanding"
+
+    def __init__(self, pipes, policy=ROUND_ROBIN):
+        if policy not in (self.ROUND_ROBIN, self.LEAST_OUTSTANDING):
+            raise ValueError("Unknown pool policy %r" % policy)
+        self.pipes = list(pipes)
+        self.policy = policy
+        self.xids = XidCounter()
+        for pipe in self.pipes:
+            pipe.xids = self.xids
+        self._lock = threading.Lock() # Protects _next
+        self._next = 0
+        self._owner = {} # {xid: pipe the CALL went out on}
+
+    def __str__(self):
+        return "pool-%s" % ",".join(str(pipe) for pipe in self.pipes)
+
+    def __iter__(self):
+        return iter(self.pipes)
+
+    def __len__(self):
+        return len(self.pipes)
+
+    def choose(self):
+        """Return the pipe the next CALL should go out on"""
+        with self._lock:
+            i = self._next
+            self._next = (i + 1) % len(self.pipes)
+        if self.policy == self.ROUND_ROBIN:
+            return self.pipes[i]
+        # Start the search at the round robin choice, so that threads
+        # looking at the same counts don't all pick the same pipe.
+        # Note the counts are only a snapshot, others may be sending too.
+        pipes = self.pipes[i:] + self.pipes[:i]
+        return min(pipes, key=lambda pipe: len(pipe._pending))
+
+    def send_call(self, program, version, procedure, data, credinfo):
+        pipe = self.choose()
+        xid = pipe.send_call(program, version, procedure, data, credinfo)
+        self._owner[xid] = pipe
+        return xid
+
+    def send_call_future(self, program, version, procedure, data, credinfo,
+                         timeout=None):
+        pipe = self.choose()
+        return pipe.send_call_future(program, version, procedure, data,
+                                     credinfo, timeout)
+
+    def pipe_for(self, xid):
+        """The pipe a CALL went out on, until its reply is listened for"""
+        return self._owner[xid]
+
+    def future(self, xid):
+        return self._owner[xid].future(xid)
+
+    def wait_any(self, xids, timeout=None):
+        """As RpcPipe.wait_any, for calls spread over the pool"""
+        return _wait_xids(self, xids, timeout,
+                          concurrent.futures.FIRST_COMPLETED)
+
+    def wait_all(self, xids, timeout=None):
+        """As RpcPipe.wait_all, for calls spread over the pool"""
+        return _wait_xids(self, xids, timeout,
+                          concurrent.futures.ALL_COMPLETED)
+
+    def listen(self, xid, timeout=None):
+        """Wait for a reply to a CALL."""
+        pipe = self._owner.pop(xid)
+        return pipe.listen(xid, timeout)
+
+    async def wait(self, xid, timeout=300):
+        """As listen, for a pool of rpc.aio pipes"""
+        pipe = self._owner.pop(xid)
+        return await pipe.wait(xid, timeout)
+
+    def outstanding(self):
+        """Number of calls not yet listened for, on each pipe"""
+        return [len(pipe._pending) for pipe in self.pipes]
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.close()
+
+def bindsocket(s, port=1):
+    """Scan up through ports, looking for one we can bind to"""
+    # This is necessary when we need to use a 'secure' port
+    using = port
+    while 1:
+        try:
+            s.bind(('', using))
+            return
+        except OSError as why:
+            if why.errno == EADDRINUSE:
+                using += 1
+                if port < 1024 <= using:
+                    # If we ask for a secure port, make sure we don't
+                    # silently bind to a non-secure one
+                    raise
+            else:
+                raise
+
 #################################################
 
 class ConnectionHandler(object):
@@ -445,27 +1296,61 @@ class ConnectionHandler(object):
     NOTE that the _event_* functions should not be called directly,
     but only through start.  Thread safety depends on this.
     """
-    def __init__(self):
+    # If set, the procedure data passed to handlers is a memoryview into
+    # the record rather than a copy of it.  Only turn this on when all
+    # handlers only ever feed their data to an xdrgen Unpacker.
+    payload_views = False
+    # While the dispatcher is at capacity, calls wait on their pipe, which
+    # is still read so that replies reach workers waiting on them.  Reads
+    # stop once this many bytes of calls are waiting.
+    max_held = 4 << 20
+
+    def __init__(self, poller=None, workers=None, queue_size=1024,
+                 per_connection=None, max_inflight=0, max_conn_inflight=0,
+                 max_backlog=0, metrics=True, drc=None):
         self._stopped = False
-        # Set up polling lists
-        self.readlist = set()
+        # Kernel readiness interface, see make_poller
+        self._poller = make_poller(poller)
+        # Runs incoming calls, see make_dispatcher
+        self.dispatcher = make_dispatcher(workers, queue_size, per_connection)
+        # Flow control limits, see _throttle_check.  0 means no limit.
+        self.max_inflight = max_inflight # Calls being handled, all pipes
+        self.max_conn_inflight = max_conn_inflight # Calls from a single pipe
+        self.max_backlog = max_backlog # Unsent bytes waiting on a pipe
+        self._flow_lock = threading.Lock() # Protects fields below
+        self.inflight = 0 # Calls handed to dispatcher but not yet finished
+        self._throttled = {} # {pipe: time we stopped reading it}
+        self._waiting = {} # {pipe: None} with calls held for the dispatcher
+        # Statistics, see flow_stats
+        self.max_inflight_seen = 0
+        self.throttle_events = {"inflight" : 0,
+                                "conn_inflight" : 0,
+                                "backlog" : 0,
+                                "capacity" : 0,
+                                }
+        self.resume_events = 0
+        self._throttled_time = 0.0
+        # Per procedure call statistics, or None to skip collecting them
+        if metrics:
+            self.metrics = RpcMetrics()
+        else:
+            self.metrics = None
+        # Replies to recent calls, so retransmits are not run twice.
+        # See drc.DuplicateRequestCache, and _event_rpc_call.
+        if drc is True:
+            drc = DuplicateRequestCache()
+        self.drc = drc or None
+        # fds which have data waiting for the socket to become writable
         self.writelist = set()
-        self.errlist = set()
         # A list of all sockets we have open, indexed by fileno
         self.sockets = {} # {fd: pipe}
         # A list of the sockets set to listen for connections
         self.listeners = set()
 
-        # Create internal server for alarm system to connect to
-        self.s = self.expose((LOOPBACK, 0), socket.AF_INET, False)
-
         # Set up alarm system, which is how other threads inform the polling
         # thread that data is ready to be sent out
-        # NOTE that there are TWO sockets associated with alarm, one
-        # for each end of the connection.  Nasty bugs creep in here.
-        self._alarm = Alarm(self.s.getsockname())
-        self._alarm_poll = self._event_connect_incoming(self.s.fileno(),
-                                                        internal=True)
+        self._alarm = Alarm()
+        self._poller.register(self._alarm.fileno())
 
         # Set up some constants that effect general behavior
         self.rsize = 4096 # Read data in chunks of this size
@@ -475,21 +1360,33 @@ class ConnectionHandler(object):
         # Dictionary {flavor: handler} used for server-side authentication
         self.sec_flavors = security.instances()
 
-    def _buzz_write_ready(self, pipe):
-        """Pipe has data ready to be sent out"""
+    def _add_socket(self, fd, s):
+        """Start polling a socket.  Only call from the polling thread."""
+        self.sockets[fd] = s
+        self._poller.register(fd)
+
+    def _buzz_write_ready(self, pipe, dirty):
+        """Pipe has data ready to be sent out.
+
+        The record is moved to the pipe's write buffer, and the pipe added
+        to dirty, for _event_alarm to flush.
+        """
         pipe.pop_record(self.wsize)
-        self.writelist.add(pipe.fileno())
+        fd = pipe.fileno()
+        if self.sockets.get(fd) is not pipe:
+            # Pipe was closed before the polling thread got to it
+            return
+        # Unless already waiting for the socket to become writable, it is
+        # written to immediately, and only waits if the kernel pushes back.
+        dirty[fd] = pipe
 
     def _buzz_new_socket(self, data):
         """A new socket needs to be added"""
         pipe, defer = data
         fd = pipe.fileno()
         log_p.info("Adding %i generated by another thread" % fd)
-        # Add to known connections
-        self.sockets[fd] = pipe
-        # Start listening on new connection
-        self.readlist.add(fd)
-        self.errlist.add(fd)
+        # Add to known connections, and start listening on it
+        self._add_socket(fd, pipe)
         # Notify thread which created connection that it is now up
         defer.fill()
 
@@ -497,130 +1394,339 @@ class ConnectionHandler(object):
         """We want to exit the start loop"""
         self._stopped = True
 
+    def _buzz_call_done(self, pipe):
+        """A call finished, so throttled pipes might be readable again"""
+        for p in self._call_done(pipe):
+            fd = p.fileno()
+            if self.sockets.get(fd) is p:
+                self._flow_check(fd, p)
+
     def start(self):
-        switch = {0 : self._buzz_write_ready,
+        switch = {# 0, write ready, is handled in _event_alarm
                   1 : self._buzz_new_socket,
                   2 : self._buzz_stop,
+                  3 : self._buzz_call_done,
                   }
+        alarm_fd = self._alarm.fileno()
         while not self._stopped:
-            log_p.debug("Calling select")
-            log_p.log(5, "Sleeping for: %s, %s, %s" %
-                 (self.readlist, self.writelist, self.errlist))
-            r,w,e = select.select(self.readlist, self.writelist, self.errlist)
-            log_p.log(5, "Woke with: %s, %s, %s" % (r, w, e))
-            for fd in e:
-                log_p.warn(1, "polling error from %i" % fd)
-                # STUB - now what?
-            for fd in w:
-                try:
-                    self._event_write(fd)
-                except socket.error as e:
-                    self._event_close(fd)
-            for fd in r:
-                if fd in self.listeners:
+            log_p.debug("Calling poll")
+            events = self._poller.poll()
+            log_p.log(5, "Woke with: %s", events)
+            for fd, readable, writable in events:
+                if fd == alarm_fd:
+                    if readable:
+                        self._event_alarm(switch)
+                    continue
+                if fd not in self.sockets:
+                    # Closed while handling an earlier event
+                    continue
+                if writable and fd in self.writelist:
                     try:
-                        self._event_connect_incoming(fd)
+                        self._event_write(fd)
                     except socket.error as e:
                         self._event_close(fd)
-                elif fd == self._alarm_poll.fileno():
-                    commands = self._alarm_poll.recv(self.rsize)
-                    for c in commands:
-                        data = self._alarm.pop()
-                        try:
-                            switch[c](data)
-                        except socket.error as e:
-                            self._event_close(fd)
-                else:
+                        continue
+                if not readable:
+                    continue
+                if fd in self.listeners:
                     try:
-                        data = self.sockets[fd].recv_records(self.rsize)
-                    except socket.error:
-                        data = None
-                    if data is not None:
-                        self._event_read(data, fd)
-                    else:
+                        while (self._event_connect_incoming(fd) is not None
+                               and self._poller.edge):
+                            pass
+                    except socket.error as e:
                         self._event_close(fd)
+                elif self.sockets[fd] not in self._throttled:
+                    self._event_read_ready(fd)
         for s in self.sockets.values():
             s.close()
+        self._poller.close()
+        self._alarm.close()
 
     def stop(self):
         self._alarm.buzz(b'\x02', None)
 
-    def _event_connect_incoming(self, fd, internal=False):
+    def _event_alarm(self, switch):
+        """Other threads have buzzed us, run every command queued since.
+
+        Records pushed to the same pipe are gathered up, and flushed with
+        a single write once all the commands have been run.
+        """
+        self._alarm.clear()
+        pop = self._alarm.pop
+        dirty = {} # {fd: pipe} with new records in its write buffer
+        while True:
+            try:
+                c, data = pop()
+            except IndexError:
+                break
+            if c == 0:
+                self._buzz_write_ready(data, dirty)
+            else:
+                switch[c](data)
+        for fd, pipe in dirty.items():
+            if self.sockets.get(fd) is not pipe:
+                # Closed by a later command
+                continue
+            if fd not in self.writelist and not pipe.flush_pipe():
+                self.writelist.add(fd)
+                self._poller.want_write(fd, True)
+            if self.max_backlog:
+                self._flow_check(fd, pipe)
+
+    def _event_read_ready(self, fd):
+        """Socket is readable, pull in all available records."""
+        pipe = self.sockets[fd]
+        while True:
+            try:
+                data = pipe.recv_records(self.rsize)
+            except BlockingIOError:
+                return
+            except socket.error:
+                data = None
+            if data is None:
+                self._event_close(fd)
+                return
+            self._event_read(data, fd)
+            if not self._flow_check(fd, pipe):
+                # Stop reading until some calls finish
+                return
+            if not self._poller.edge:
+                return
+
+    def _event_connect_incoming(self, fd):
         """Someone else is trying to connect to us (we act like server)."""
         s = self.sockets[fd]
         try:
-            if internal:
-                # We are accepting from the same thread that tried to connect.
-                # In linux this works, but in Windows it raises EWOULDBLOCK
-                # if we don't do this
-                s.setblocking(1)
-                csock, caddr = s.accept()
-                s.setblocking(0)
-            else:
-                csock, caddr = s.accept()
+            csock, caddr = s.accept()
+        except BlockingIOError:
+            # No more pending connections
+            return
         except socket.error as e:
             log_p.error("accept() got error %s" % str(e))
             return
         csock.setblocking(0)
         fd = csock.fileno()
-        pipe = self.sockets[fd] = RpcPipe(csock, self._alarm)
+        pipe = RpcPipe(csock, self._alarm)
         log_p.info("got connection from %s, assigned to fd=%i" %
              (csock.getpeername(), fd))
         # Start listening for data to come in on new connection
-        self.readlist.add(fd)
-        self.errlist.add(fd)
+        self._add_socket(fd, pipe)
         return pipe
 
     def _event_close(self, fd):
         """Close the connection, and remove references to it."""
         log_p.info("Closing %i" % fd)
-        temp = set([fd])
-        self.writelist -= temp
-        self.readlist -= temp
-        self.errlist -= temp
-        self.sockets[fd].clear_active()
-        self.sockets[fd].close()
-        del self.sockets[fd]
+        self.writelist.discard(fd)
+        self.listeners.discard(fd)
+        self._poller.unregister(fd)
+        s = self.sockets.pop(fd)
+        self._throttle_forget(s)
+        if isinstance(s, RpcPipe):
+            s.clear_active()
+        s.close()
 
     def _event_write(self, fd):
         """Data is waiting to be written."""
-        if self.sockets[fd].flush_pipe():
+        pipe = self.sockets[fd]
+        if pipe.flush_pipe():
             self.writelist.remove(fd)
-            log_p.log(5, "Finished writing to %i" % fd)
+            self._poller.want_write(fd, False)
+            log_p.log(5, "Finished writing to %i", fd)
+        if self.max_backlog:
+            self._flow_check(fd, pipe)
+
+    def _flow_check(self, fd, pipe):
+        """Pause or resume reading from pipe, according to the flow limits.
+
+        Returns True if the pipe may be read.
+        """
+        was_ok = pipe not in self._throttled
+        ok = self._flow_update(pipe)
+        if ok != was_ok:
+            self._poller.want_read(fd, ok)
+            if ok:
+                # With an edge-triggered poller we will not be told about
+                # data which arrived while paused, so go get it now.
+                self._event_read_ready(fd)
+        return ok
 
     def _event_read(self, records, fd):
         """Data is waiting to be read.
 
-        For each full RPC record, then dispatch it to a thread.
+        Each full RPC CALL is queued on the pipe, for _flow_check to
+        dispatch to a worker as the flow limits allow.  Replies are cheap,
+        and a worker may be waiting on one, so they are handled right here
+        rather than queued behind calls.
         """
         s = self.sockets[fd]
         for r in records:
-            log_p.log(5, "Received record from %i" % fd)
+            log_p.log(5, "Received record from %i", fd)
             log_p.log(2, repr(r))
-            t = threading.Thread(target=self._event_rpc_record, args=(r, s))
-            t.setDaemon(True)
-            t.start()
+            if r[4:8] == _REPLY_MTYPE:
+                try:
+                    self._event_rpc_record(r, s)
+                except Exception:
+                    log_p.error("Problem handling reply", exc_info=True)
+            else:
+                s.held_calls.append((r, time.perf_counter()))
+                s.held_bytes += len(r)
+
+    def _flow_update(self, pipe):
+        """Dispatch whatever held calls the limits allow.
+
+        Returns False if pipe should not be read from.
+        """
+        while True:
+            self._release_calls(pipe)
+            if self._throttle_check(pipe):
+                return False
+            if not pipe.held_calls or pipe in self._waiting:
+                return True
+            # A call finished after _release_calls gave up, try again
+
+    def _release_calls(self, pipe):
+        """Hand held CALLs to the dispatcher, while under the limits"""
+        held = pipe.held_calls
+        while held:
+            with self._flow_lock:
+                if self._over_limit(pipe) is not None:
+                    return
+                pipe.inflight += 1
+                self.inflight += 1
+                if self.inflight > self.max_inflight_seen:
+                    self.max_inflight_seen = self.inflight
+            record, queued = held.popleft()
+            pipe.held_bytes -= len(record)
+            self.dispatcher.submit(pipe, self._run_call, record, pipe, queued)
+
+    def _run_call(self, record, pipe, queued):
+        """Handle a CALL, then tell the thread reading pipe it is done"""
+        try:
+            self._event_rpc_record(record, pipe.reply_pipe(record), queued)
+        finally:
+            if (self.max_inflight or self.max_conn_inflight or
+                self.max_backlog or self.dispatcher.capacity):
+                pipe.call_done()
+            else:
+                # Nothing can be throttled, so skip waking the reader
+                self._call_done(pipe)
+
+    def _call_done(self, pipe):
+        """Count a call from pipe as finished.
 
-    def _event_rpc_record(self, record, pipe):
+        Returns the throttled or waiting pipes which are now under the
+        limits.  This may be called from any thread, since it only touches
+        state under _flow_lock, but only the thread reading each returned
+        pipe may resume it.  So workers go through pipe.call_done, unless
+        nothing can be throttled, see _run_call.
+        """
+        with self._flow_lock:
+            pipe.inflight -= 1
+            self.inflight -= 1
+            ready = [p for p in self._throttled if self._over_limit(p) is None]
+            if self._waiting and self.inflight < self.dispatcher.capacity:
+                # Longest waiting first, they rejoin the back if still held
+                ready.extend(self._waiting)
+                self._waiting.clear()
+            return ready
+
+    def _over_limit(self, pipe):
+        """Return name of the flow limit pipe has hit, or None.
+
+        Must be called with _flow_lock held.
+        """
+        if self.max_conn_inflight and pipe.inflight >= self.max_conn_inflight:
+            return "conn_inflight"
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            return "inflight"
+        if self.max_backlog and pipe.write_backlog() >= self.max_backlog:
+            return "backlog"
+        capacity = self.dispatcher.capacity
+        if capacity and self.inflight >= capacity:
+            return "capacity"
+        return None
+
+    def _throttle_check(self, pipe):
+        """Update the throttled state of pipe, returning True if throttled.
+
+        A pipe is throttled while it has max_conn_inflight calls being
+        handled, or max_backlog bytes of replies the client has not read
+        yet, or while max_inflight calls are being handled over all pipes.
+        This should only be called by the thread reading from pipe, which
+        is responsible for actually stopping and restarting the reads.
+
+        A dispatcher at capacity only throttles pipes holding max_held bytes
+        of calls.  Others keep being read, and are remembered in _waiting.
+        """
+        with self._flow_lock:
+            reason = self._over_limit(pipe)
+            if reason == "capacity" and pipe.held_bytes < self.max_held:
+                reason = None
+                if pipe.held_calls:
+                    self._waiting.setdefault(pipe, None)
+            else:
+                self._waiting.pop(pipe, None)
+            if reason is not None:
+                if pipe not in self._throttled:
+                    log_p.debug("Throttling %s, hit %s limit" % (pipe, reason))
+                    self._throttled[pipe] = time.time()
+                    self.throttle_events[reason] += 1
+                return True
+            if pipe in self._throttled:
+                log_p.debug("Resuming reads from %s" % pipe)
+                self._throttled_time += time.time() - self._throttled.pop(pipe)
+                self.resume_events += 1
+            return False
+
+    def _throttle_forget(self, pipe):
+        """Pipe has closed, so stop tracking it"""
+        with self._flow_lock:
+            self._waiting.pop(pipe, None)
+            since = self._throttled.pop(pipe, None)
+            if since is not None:
+                self._throttled_time += time.time() - since
+
+    def flow_stats(self):
+        """Return a dictionary showing how often pipes were throttled"""
+        with self._flow_lock:
+            now = time.time()
+            waiting = sum(now - t for t in self._throttled.values())
+            return {"inflight" : self.inflight,
+                    "max_inflight_seen" : self.max_inflight_seen,
+                    "throttled" : len(self._throttled),
+                    "waiting" : len(self._waiting),
+                    "throttle_events" : dict(self.throttle_events),
+                    "resume_events" : self.resume_events,
+                    "throttled_time" : self._throttled_time + waiting,
+                    }
+
+    def _event_rpc_record(self, record, pipe, queued=None):
         """Deal with an incoming RPC record.
 
-        This is run in its own thread.
+        This is run in its own thread.  queued is the time.perf_counter()
+        at which the record was read.
         """
-        log_t.log(5, "_event_rpc_record thread receives %r" % record)
+        log_t.log(5, "_event_rpc_record thread receives %r", record)
         # log_t.info("_event_rpc_record thread receives %r" % record)
         try:
             p = FancyRPCUnpacker(record)
             msg = p.unpack_rpc_msg() # RPC header
-            msg_data = record[p.get_position():] # RPC payload
-            # Remember length of the header
+            if self.payload_views:
+                msg_data = memoryview(record)[p.get_position():]
+            else:
+                msg_data = record[p.get_position():] # RPC payload
+            # Remember length of the header, and when it arrived
             msg.length = p.get_position()
+            msg.queued = queued
         except (rpc_pack.XDRError, EOFError) as e:
             log_t.warn("XDRError: %s, dropping packet" % e)
             log_t.debug("unpacking raised the following error", exc_info=True)
             self._notify_drop()
             return # Drop incorrectly encoded packets
-        log_t.debug("MSG = %s" % str(msg))
-        log_t.debug("data = %r" % msg_data)
+        # Note these are formatted only when debugging, since repr(msg)
+        # costs more than the rest of the header handling.
+        log_t.debug("MSG = %s", msg)
+        log_t.debug("data = %r", msg_data)
         if msg.mtype == REPLY:
             self._event_rpc_reply(msg, msg_data, pipe)
         elif msg.mtype == CALL:
@@ -644,13 +1750,18 @@ class ConnectionHandler(object):
     def _event_rpc_call(self, msg, msg_data, pipe):
         """Deal with an incoming RPC CALL.
 
-        msg is unpacked header, with length fields added.
+        msg is unpacked header, with length and queued fields added.
         msg_data is raw procedure data.
         """
         """Given an RPC record, returns appropriate reply
 
         This is run in its own thread.
         """
+        clock = time.perf_counter
+        start = clock()
+        # Time taken by each step of the security flavor, for self.metrics
+        t_auth = t_unsecure = t_secure = None
+        request_size = msg.length + len(msg_data)
         class XXX(object):
             pass
         call_info = XXX() # Store various info we need to pass to procedure
@@ -659,11 +1770,14 @@ class ConnectionHandler(object):
         call_info.connection = pipe
         call_info.raw_cred = msg.body.cred
         notify = None
+        drc_key = None # Set if the reply should go in self.drc
         try:
             # Check for reasons to DENY the call
             try:
                 self._check_rpcvers(msg)
+                t = clock()
                 call_info.credinfo = self._check_auth(msg, msg_data)
+                t_auth = clock() - t
             except rpclib.RPCFlowContol:
                 raise
             except Exception:
@@ -672,7 +1786,12 @@ class ConnectionHandler(object):
                 raise rpclib.RPCDeniedReply(AUTH_ERROR, AUTH_FAILED)
             # Call has been ACCEPTED, now check for reasons not to succeed
             sec = call_info.credinfo.sec
+            # xid, mtype, reply_stat, verifier and accept_stat
+            call_info.reply_header_size = \
+                24 + (sec.reply_verf_size(msg) + 3) // 4 * 4
+            t = clock()
             msg_data = sec.unsecure_data(msg.body.cred, msg_data)
+            t_unsecure = clock() - t
             if not self._check_program(msg.prog):
                 log_t.warn("PROG_UNAVAIL, do not support prog=%i" % msg.prog)
                 raise rpclib.RPCUnsuccessfulReply(PROG_UNAVAIL)
@@ -685,6 +1804,30 @@ class ConnectionHandler(object):
                 log_t.warn("PROC_UNAVAIL for vers=%i, proc=%i" %
                            (msg.vers, msg.proc))
                 raise rpclib.RPCUnsuccessfulReply(PROC_UNAVAIL)
+            if self.drc is not None:
+                client = pipe.getpeername()
+                if not isinstance(pipe, UdpPeer) and \
+                   not isinstance(client, (str, bytes)):
+                    # A client which reconnects to retransmit does so from
+                    # a new port, so over connections only the host counts.
+                    # (AF_UNIX peers are names, not (host, port) tuples.)
+                    client = client[0]
+                drc_key = self.drc.make_key(msg.xid, client,
+                                            msg.prog, msg.vers, msg.proc,
+                                            msg.body.cred.flavor, msg_data)
+            if drc_key is not None:
+                state, cached = self.drc.lookup(drc_key)
+                if state == drc.IN_PROGRESS:
+                    # The original is still being handled, and will be
+                    # replied to.  Leave its cache entry alone.
+                    drc_key = None
+                    raise rpclib.RPCDrop
+                if state == drc.HIT:
+                    log_t.info("Replaying cached reply to xid=%i" % msg.xid)
+                    reply_size = pipe.send_reply(msg.xid, *cached)
+                    self._record_call(msg, start, request_size, reply_size,
+                                      t_auth, t_unsecure, t_secure)
+                    return
             # Everything looks good at this layer, time to do the call
             tuple = method(msg_data, call_info)
             if len(tuple) == 2:
@@ -696,13 +1839,18 @@ class ConnectionHandler(object):
             if isinstance(result, str):
                 result = bytes(result, encoding='UTF-8')
 
-            if not isinstance(result, bytes):
+            # A list of buffers is sent as is, without being joined
+            if not isinstance(result, (bytes, list, tuple)):
                 raise TypeError("Expected bytes, got %s" % type(result))
             # status, result = method(msg_data, call_info)
-            log_t.debug("Called method, got %r, %r" % (status, result))
+            log_t.debug("Called method, got %r, %r", status, result)
         except rpclib.RPCDrop:
             # Silently drop the request
+            if drc_key is not None:
+                self.drc.abandon(drc_key)
             self._notify_drop()
+            self._record_call(msg, start, request_size, None,
+                              t_auth, t_unsecure, t_secure)
             return
         except rpclib.RPCFlowContol as e:
             body, data = e.body()
@@ -711,16 +1859,40 @@ class ConnectionHandler(object):
             body, data = rpclib.RPCUnsuccessfulReply(SYSTEM_ERR).body()
         else:
             try:
+                t = clock()
                 data = sec.secure_data(msg.body.cred, result)
+                t_secure = clock() - t
                 verf = sec.make_reply_verf(msg.body.cred, status)
                 areply = accepted_reply(verf, rpc_reply_data(status, b''))
                 body = reply_body(MSG_ACCEPTED, areply=areply)
             except Exception:
                 body, data = rpclib.RPCUnsuccessfulReply(SYSTEM_ERR).body()
-        pipe.send_reply(msg.xid, body, data)
+        if drc_key is not None:
+            if not isinstance(data, (bytes, str)):
+                # A list of buffers, see rpc_send.  These may be views of
+                # buffers the handler goes on to reuse, so cache a copy.
+                data = b"".join(data)
+            self.drc.complete(drc_key, (body, data), len(data))
+        reply_size = pipe.send_reply(msg.xid, body, data)
+        self._record_call(msg, start, request_size, reply_size,
+                          t_auth, t_unsecure, t_secure)
         if notify is not None:
             notify()
 
+    def _record_call(self, msg, start, request_size, reply_size,
+                     t_auth, t_unsecure, t_secure):
+        """Add a finished call to self.metrics"""
+        if self.metrics is None:
+            return
+        now = time.perf_counter()
+        if msg.queued is None:
+            wait = 0.0
+        else:
+            wait = start - msg.queued
+        self.metrics.add_call(msg.prog, msg.vers, msg.proc,
+                              msg.body.cred.flavor, request_size, reply_size,
+                              wait, now - start, t_auth, t_unsecure, t_secure)
+
     def _notify_drop(self):
         """Debugging hook called when a request is dropped."""
         log_t.warn("Dropped request")
@@ -805,77 +1977,115 @@ class ConnectionHandler(object):
         #       else return AUTH_BADCRED
         return True
 
-    def connect(self, address, secure=False):
+    def connect(self, address, secure=False, udp=False):
         """Connect to given address, returning new pipe
 
+        address is usually a (host, port) pair.  It may also be the path of
+        an AF_UNIX socket, or a ConnectionHandler running in this process,
+        which is then reached over a socketpair.  Neither goes through
+        the TCP stack, which is useful for tests and benchmarks.
+
         If secure==True, will bind local asocket to a port < 1024.
+        If udp==True, calls are sent as datagrams, over a UdpPipe.
         """
         log_t.info("Called connect(%r)" % (address,))
+        if not isinstance(address, tuple) and udp:
+            raise ValueError("udp needs a (host, port) address")
+        if isinstance(address, ConnectionHandler):
+            s, peer = socket.socketpair()
+            address.add_connection(peer)
+        elif isinstance(address, str):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(address)
+            except:
+                s.close()
+                raise
+        else:
+            s = self._connect_inet(address, secure, udp)
+        s.setblocking(0)
+        if udp:
+            pipe = UdpPipe(s, self._alarm)
+        else:
+            pipe = RpcPipe(s, self._alarm)
+        # Tell polling loop about the new socket
+        defer = DeferredData()
+        self._alarm.buzz(b'\x01', (pipe, defer))
+        # Wait until polling loop knows about new socket
+        defer.wait()
+        return pipe
+
+    def _connect_inet(self, address, secure, udp):
+        """Return a socket connected to (host, port)"""
         host, port = address
-        err = None
-        for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        if udp:
+            socktype = socket.SOCK_DGRAM
+        else:
+            socktype = socket.SOCK_STREAM
+        for res in socket.getaddrinfo(host, port, 0, socktype):
             af, socktype, proto, cannonname, sa = res
-            sock = None
+            s = socket.socket(af, socktype, proto)
             try:
-                s = socket.socket(af, socktype, proto)
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 if secure:
                     self.bindsocket(s)
                 s.connect(sa)
-                err = None
-                break
-            except:
-                if s is not None:
-                    s.close()
+                return s
+            except socket.error:
+                s.close()
+        raise socket.error("Could not connect to %s:%s" % (host, port))
+
+    def add_connection(self, s):
+        """Start handling an already connected socket, returning its pipe
 
+        This is how the far end of a socketpair made by connect() is
+        handed over.
+        """
         s.setblocking(0)
         pipe = RpcPipe(s, self._alarm)
-        # Tell polling loop about the new socket
         defer = DeferredData()
         self._alarm.buzz(b'\x01', (pipe, defer))
-        # Wait until polling loop knows about new socket
         defer.wait()
         return pipe
 
     def bindsocket(self, s, port=1):
         """Scan up through ports, looking for one we can bind to"""
-        # This is necessary when we need to use a 'secure' port
-        using = port
-        while 1:
-            try:
-                s.bind(('', using))
-                return
-            except OSError as why:
-                if why.errno == EADDRINUSE:
-                    using += 1
-                    if port < 1024 <= using:
-                        # If we ask for a secure port, make sure we don't
-                        # silently bind to a non-secure one
-                        raise
-                else:
-                    raise
+        bindsocket(s, port)
 
+    def expose(self, address, af, safe=True, udp=False):
+        """Start listening for incoming connections on the given address
 
-    def expose(self, address, af, safe=True):
-        """Start listening for incoming connections on the given address"""
-        s = socket.socket(af, socket.SOCK_STREAM)
+        If udp==True, returns a UdpPipe which takes calls as datagrams.
+        For af == AF_UNIX, address is the path of the socket.
+        """
+        if af == socket.AF_UNIX:
+            # Remove the socket left behind by an earlier run, if any
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except FileNotFoundError:
+                pass
+        if udp:
+            s = socket.socket(af, socket.SOCK_DGRAM)
+        else:
+            s = socket.socket(af, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(address)
         s.setblocking(0)
-        s.listen(5)
-        self.listeners.add(s.fileno()) # XXX BUG - never removed
+        if udp:
+            s = UdpPipe(s, self._alarm)
+        else:
+            s.listen(5)
+            self.listeners.add(s.fileno())
         if safe:
             # Tell polling loop about the new socket
             defer = DeferredData()
-            self._alarm.buzz('\x01', (s, defer))
+            self._alarm.buzz(b'\x01', (s, defer))
             # Wait until polling loop knows about new socket
             defer.wait()
         else:
             # This should only be called before start is run
-            self.readlist.add(s.fileno())
-            self.errlist.add(s.fileno())
-            # A list of all sockets we have open, indexed by fileno
-            self.sockets[s.fileno()] = s
+            self._add_socket(s.fileno(), s)
         return s
 
     def make_call_function(self, pipe, procedure, prog, vers):
@@ -897,17 +2107,34 @@ class ConnectionHandler(object):
 #################################################
 
 class Server(ConnectionHandler):
-    def __init__(self, prog, versions, port, interface=''):
-        ConnectionHandler.__init__(self)
+    def __init__(self, prog, versions, port, interface='', poller=None,
+                 workers=None, queue_size=1024, per_connection=None,
+                 max_inflight=0, max_conn_inflight=0, max_backlog=0,
+                 metrics=True, udp=False, drc=None, unix=None):
+        ConnectionHandler.__init__(self, poller, workers, queue_size,
+                                   per_connection, max_inflight,
+                                   max_conn_inflight, max_backlog, metrics,
+                                   drc)
         self.prog = prog
         self.versions = versions # List of supported versions of prog
         self.default_cred = security.CredInfo()
+        if unix is not None:
+            # Also listen on an AF_UNIX socket at this path
+            self.expose(unix, socket.AF_UNIX, False)
+        if port is None:
+            # Caller will arrange for connections, say through rpc.aio
+            return
         try:
             # This listens on both AF_INET and AF_INET6
-            self.expose((interface, port), socket.AF_INET6, False)
+            af = socket.AF_INET6
+            s = self.expose((interface, port), af, False)
         except:
             # ipv6 not supported, fall back to ipv4
-            self.expose((interface, port), socket.AF_INET, False)
+            af = socket.AF_INET
+            s = self.expose((interface, port), af, False)
+        if udp:
+            # Also take calls as datagrams, on the same port
+            self.expose((interface, s.getsockname()[1]), af, False, udp=True)
 
     def _check_program(self, prog):
         return (self.prog == prog)
@@ -926,18 +2153,35 @@ class Server(ConnectionHandler):
         return method
 
 class Client(ConnectionHandler):
-    def __init__(self, program=None, version=None, secureport=False):
-        ConnectionHandler.__init__(self)
+    def __init__(self, program=None, version=None, secureport=False,
+                 poller=None, workers=None, queue_size=1024,
+                 per_connection=None, max_inflight=0, max_conn_inflight=0,
+                 max_backlog=0, metrics=True):
+        ConnectionHandler.__init__(self, poller, workers, queue_size,
+                                   per_connection, max_inflight,
+                                   max_conn_inflight, max_backlog, metrics)
         self.default_prog = program
         self.default_vers = version
         self.default_cred = security.CredInfo()
         self.secureport = secureport
 
         # Start polling
-        t = threading.Thread(target=self.start, name="PollingThread")
-        t.setDaemon(True)
+        t = threading.Thread(target=self.start, name="PollingThread",
+                             daemon=True)
         t.start()
 
+    def connect_pool(self, address, count, secure=None,
+                     policy=ConnectionPool.ROUND_ROBIN):
+        """Open count connections to address, returning a ConnectionPool
+
+        The pool can be passed anywhere a pipe is, to send_call for
+        instance, and calls are spread over its connections.
+        """
+        if secure is None:
+            secure = self.secureport
+        pipes = [self.connect(address, secure) for i in range(count)]
+        return ConnectionPool(pipes, policy)
+
     def send_call(self, pipe, procedure, data=b'', credinfo=None,
                   program=None, version=None):
         if program is None: program = self.default_prog
@@ -951,4 +2195,16 @@ class Client(ConnectionHandler):
         # from that, this is a logical place to do the init.
         return pipe.send_call(program, version, procedure, data, credinfo)
 
+    def send_call_future(self, pipe, procedure, data=b'', credinfo=None,
+                         program=None, version=None, timeout=None):
+        """As send_call, but returning a CallFuture for the reply"""
+        if program is None: program = self.default_prog
+        if version is None: version = self.default_vers
+        if program is None or version is None:
+            raise Exception("Badness")
+        if credinfo is None:
+            credinfo = self.default_cred
+        return pipe.send_call_future(program, version, procedure, data,
+                                     credinfo, timeout)
+
 #################################################
@@ -78,6 +78,10 @@ class AuthNone(object):
     def make_call_verf(self, xid, body):
         return rpclib.NULL_CRED
 
+    def reply_verf_size(self, msg):
+        """Length of the body of make_reply_verf's verifier for CALL msg"""
+        return 0
+
     def unsecure_data(self, cred, data):
         """Remove any security cruft from data"""
         return data
@@ -403,6 +407,9 @@ class AuthGss(AuthNone):
         if cred.service ==  rpc_gss_svc_none or \
            cred.gss_proc in (RPCSEC_GSS_INIT, RPCSEC_GSS_CONTINUE_INIT):
             return data
+        if isinstance(data, (list, tuple)):
+            # Checksum and wrap need the reply as a single buffer
+            data = b''.join(data)
         p = Packer()
         context = self._get_context(cred.handle)
         try:
@@ -453,6 +460,10 @@ class AuthGss(AuthNone):
             token = self._get_context(body.cred.body.handle).get_signature(data)
             return opaque_auth(RPCSEC_GSS, token)
 
+    def reply_verf_size(self, msg):
+        # A checksum, which for a given context is the size of the call's
+        return len(msg.verf.body)
+
     def check_call_verf(self, xid, body):
         if body.cred.body.gss_proc in (RPCSEC_GSS_INIT, RPCSEC_GSS_CONTINUE_INIT):
             return self.is_NULL(body.verf)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+# test_rpc.py - Regression tests for the rpc connection handling
+#
+# Needs the generated rpc_pack, so run from a built tree, with
+# "python3 -m pytest rpc/test_rpc.py" or "python3 -m unittest rpc.test_rpc".
+
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from rpc import aio, metrics, rpc, security
+
+PROG = 0x20000001
+CB_PROG = 0x40000001
+
+class Echo(rpc.Server):
+    """Replies with the call's arguments, and drops procedure 2"""
+    def handle_1(self, data, call_info):
+        return rpc.SUCCESS, bytes(data)
+
+    def handle_2(self, data, call_info):
+        raise rpc.rpclib.RPCDrop
+
+class Forgetful(Echo):
+    """Drops the first copy of each call, so only retransmits get replies"""
+    def __init__(self, *args, **kwargs):
+        Echo.__init__(self, *args, **kwargs)
+        self.seen = set()
+
+    def handle_1(self, data, call_info):
+        if bytes(data) not in self.seen:
+            self.seen.add(bytes(data))
+            raise rpc.rpclib.RPCDrop
+        return Echo.handle_1(self, data, call_info)
+
+class Callbacks(rpc.Server):
+    """Client side, answering the server's callbacks"""
+    def handle_1(self, data, call_info):
+        return rpc.SUCCESS, b''
+
+class CallingBack(rpc.Server):
+    """Calls back over the connection of each incoming call, and waits"""
+    def handle_1(self, data, call_info):
+        pipe = call_info.connection
+        xid = pipe.send_call(CB_PROG, 1, 1, b'', security.CredInfo())
+        pipe.listen(xid, 10)
+        return rpc.SUCCESS, b''
+
+class Reusing(rpc.Server):
+    """Replies with a view of a buffer, which it then overwrites"""
+    def __init__(self, *args, **kwargs):
+        rpc.Server.__init__(self, *args, **kwargs)
+        self.buf = bytearray(b"first")
+
+    def handle_1(self, data, call_info):
+        return rpc.SUCCESS, [memoryview(self.buf)], self.reuse
+
+    def reuse(self):
+        self.buf[:] = b"later"
+
+class Recording(rpc.Server):
+    """Keeps the call_info of the last call"""
+    def handle_1(self, data, call_info):
+        self.call_info = call_info
+        return rpc.SUCCESS, b''
+
+class Forwarding(rpc.Server):
+    """Passes each call on to another server, over a connection of its own"""
+    def handle_1(self, data, call_info):
+        pipe = self.connect(self.target)
+        xid = pipe.send_call(PROG, 1, 1, data, security.CredInfo())
+        header, data = pipe.listen(xid, 10)
+        pipe.close()
+        return rpc.SUCCESS, data
+
+def start(handler):
+    t = threading.Thread(target=handler.start)
+    t.daemon = True
+    t.start()
+
+def wait_for(test, timeout=10):
+    """Wait until test() is true, since servers record calls after replying"""
+    deadline = time.monotonic() + timeout
+    while not test():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+def port(server):
+    for s in server.sockets.values():
+        if not isinstance(s, rpc.Pipe):
+            return s.getsockname()[1]
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = CallingBack(PROG, [1], 0, interface="127.0.0.1",
+                                  workers=2, queue_size=2)
+        self.client = Callbacks(CB_PROG, [1], None)
+        start(self.server)
+        start(self.client)
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_callback_with_full_queue(self):
+        """Handlers waiting on callback replies finish with the pool full"""
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        cred = security.CredInfo()
+        xids = [pipe.send_call(PROG, 1, 1, b'', cred) for i in range(10)]
+        for xid in xids:
+            header, data = pipe.listen(xid, 20)
+            self.assertEqual(header.stat, rpc.MSG_ACCEPTED)
+        stats = self.server.dispatcher.stats()
+        self.assertEqual(stats["completed"], 10)
+        self.assertLessEqual(self.server.max_inflight_seen,
+                             self.server.dispatcher.capacity)
+
+    def test_other_connection_with_full_queue(self):
+        """A client filling the pool does not stop others being read"""
+        address = ("127.0.0.1", port(self.server))
+        busy = self.client.connect(address)
+        other = self.client.connect(address)
+        cred = security.CredInfo()
+        xids = [busy.send_call(PROG, 1, 1, b'', cred) for i in range(20)]
+        xid = other.send_call(PROG, 1, 1, b'', cred)
+        other.listen(xid, 20)
+        for xid in xids:
+            busy.listen(xid, 20)
+
+class DuplicateRequestCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Reusing(PROG, [1], 0, interface="127.0.0.1", drc=True)
+        self.client = rpc.Client(PROG, 1)
+        start(self.server)
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_replay_is_a_copy(self):
+        """A retransmit gets the bytes first sent, not the buffer's now"""
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        xid = self.client.send_call(pipe, 1, b'args')
+        self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"first")
+        pipe.xids._xid = xid # Retransmit
+        self.client.send_call(pipe, 1, b'args')
+        self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"first")
+        self.assertEqual(self.server.drc.stats()["hits"], 1)
+
+    def test_replay_after_reconnect(self):
+        """A retransmit over a new connection, from a new port, is a hit"""
+        address = ("127.0.0.1", port(self.server))
+        pipe = self.client.connect(address)
+        xid = self.client.send_call(pipe, 1, b'args')
+        self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"first")
+        pipe.close()
+        pipe = self.client.connect(address)
+        pipe.xids._xid = xid # Retransmit
+        self.client.send_call(pipe, 1, b'args')
+        self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"first")
+        self.assertEqual(self.server.drc.stats()["hits"], 1)
+
+class CallInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Recording(PROG, [1], 0, interface="127.0.0.1")
+        self.client = rpc.Client(PROG, 1)
+        start(self.server)
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_reply_header_size(self):
+        """The reply header size is known, however big the call's"""
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        cred = security.AuthSys().init_cred(name=b"m" * 255,
+                                            gids=list(range(16)))
+        xid = self.client.send_call(pipe, 1, b'', cred)
+        header, data = pipe.listen(xid, 20)
+        call_info = self.server.call_info
+        self.assertGreater(call_info.header_size, 300)
+        self.assertEqual(call_info.reply_header_size, header.length)
+
+    def test_reply_after_expiry(self):
+        """A reply nobody is waiting for is dropped, and the pipe goes on"""
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        xid = self.client.send_call(pipe, 1, b'')
+        header, data = pipe.listen(xid, 20)
+        self.assertIsNone(pipe.rcv_reply(header, data))
+        xid = self.client.send_call(pipe, 1, b'')
+        header, data = pipe.listen(xid, 20)
+        self.assertEqual(header.stat, rpc.MSG_ACCEPTED)
+
+class UdpTest(unittest.TestCase):
+    def setUp(self):
+        self.client = rpc.Client(PROG, 1)
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def connect(self, server):
+        self.server = server
+        start(server)
+        return self.client.connect(("127.0.0.1", port(server)), udp=True)
+
+    def test_echo(self):
+        """Calls and replies of all sizes fit in one datagram each"""
+        pipe = self.connect(Echo(PROG, [1], 0, interface="127.0.0.1",
+                                 udp=True))
+        data = [b"", b"x", b"y" * 1000, b"z" * 60000]
+        xids = [self.client.send_call(pipe, 1, d) for d in data]
+        for xid, d in zip(xids, data):
+            self.assertEqual(bytes(pipe.listen(xid, 20)[1]), d)
+        # TCP still works, on the same port
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        xid = self.client.send_call(pipe, 1, b"tcp")
+        self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"tcp")
+
+    def test_retransmit(self):
+        """listen retransmits a call until it gets a reply"""
+        pipe = self.connect(Forgetful(PROG, [1], 0, interface="127.0.0.1",
+                                      udp=True))
+        pipe.retrans = 0.05
+        for i in range(5):
+            xid = self.client.send_call(pipe, 1, b"%i" % i)
+            self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"%i" % i)
+        self.assertEqual(len(pipe._calls), 0)
+
+    def test_timeout(self):
+        """Without any reply, listen gives up at its timeout"""
+        pipe = self.connect(Echo(PROG, [1], 0, interface="127.0.0.1",
+                                 udp=True))
+        pipe.retrans = 0.05
+        xid = self.client.send_call(pipe, 2, b"")
+        self.assertRaises(rpc.RPCTimeout, pipe.listen, xid, 0.3)
+        self.assertEqual(len(pipe._calls), 0)
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Echo(PROG, [1], 0, interface="127.0.0.1", workers=2)
+        self.client = rpc.Client(PROG, 1)
+        start(self.server)
+        self.address = ("127.0.0.1", port(self.server))
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_xid_counter(self):
+        """Threads sharing an XidCounter never get the same xid"""
+        counter = rpc.XidCounter()
+        got = []
+        def take():
+            got.extend([counter.next() for i in range(1000)])
+        threads = [threading.Thread(target=take) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(got)), 4000)
+
+    def test_round_robin(self):
+        """Calls go out on each pipe in turn, and find their replies"""
+        pool = self.client.connect_pool(self.address, 3)
+        self.assertEqual(len(pool), 3)
+        xids = [self.client.send_call(pool, 1, b"%i" % i) for i in range(6)]
+        self.assertEqual([pool.pipe_for(xid) for xid in xids],
+                         pool.pipes * 2)
+        for i, xid in enumerate(xids):
+            self.assertEqual(bytes(pool.listen(xid, 20)[1]), b"%i" % i)
+        self.assertEqual(pool.outstanding(), [0, 0, 0])
+        pool.close()
+
+    def test_least_outstanding(self):
+        """Calls go out on the pipe with fewest calls not listened for"""
+        policy = rpc.ConnectionPool.LEAST_OUTSTANDING
+        pool = self.client.connect_pool(self.address, 2, policy=policy)
+        first = self.client.send_call(pool, 1, b"")
+        second = self.client.send_call(pool, 1, b"")
+        self.assertIsNot(pool.pipe_for(first), pool.pipe_for(second))
+        busy = pool.pipe_for(second)
+        pool.listen(first, 20)
+        third = self.client.send_call(pool, 1, b"")
+        self.assertIsNot(pool.pipe_for(third), busy)
+        pool.listen(second, 20)
+        pool.listen(third, 20)
+        pool.close()
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, rpc.ConnectionPool, [], "random")
+
+class CallFutureTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Echo(PROG, [1], 0, interface="127.0.0.1", workers=2)
+        self.client = rpc.Client(PROG, 1)
+        start(self.server)
+        self.pipe = self.client.connect(("127.0.0.1", port(self.server)))
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_result(self):
+        """A future gives the reply, and runs its callbacks"""
+        done = threading.Event()
+        future = self.client.send_call_future(self.pipe, 1, b"future")
+        future.add_done_callback(lambda f: done.set())
+        header, data = future.result(20)
+        self.assertEqual(bytes(data), b"future")
+        self.assertTrue(done.wait(20))
+        # Only the future holds the reply
+        self.assertNotIn(future.xid, self.pipe._pending)
+
+    def test_wait(self):
+        """wait_all returns once every reply is in, to collect with listen"""
+        xids = [self.client.send_call(self.pipe, 1, b"%i" % i)
+                for i in range(20)]
+        self.assertEqual(sorted(self.pipe.wait_all(xids, 20)), sorted(xids))
+        for i, xid in enumerate(xids):
+            self.assertEqual(bytes(self.pipe.listen(xid, 0)[1]), b"%i" % i)
+        xids = [self.client.send_call(self.pipe, 2, b""),
+                self.client.send_call(self.pipe, 1, b"")]
+        self.assertEqual(self.pipe.wait_any(xids, 20), [xids[1]])
+
+    def test_deadline(self):
+        """A call with a timeout fails with RPCTimeout once expired"""
+        future = self.client.send_call_future(self.pipe, 2, b"",
+                                              timeout=0.05)
+        self.assertEqual(self.pipe.expire_calls(), 0)
+        time.sleep(0.1)
+        self.assertEqual(self.pipe.expire_calls(), 1)
+        self.assertRaises(rpc.RPCTimeout, future.result, 0)
+        self.assertNotIn(future.xid, self.pipe._pending)
+
+class ConnectTest(unittest.TestCase):
+    def setUp(self):
+        self.client = rpc.Client(PROG, 1)
+
+    def tearDown(self):
+        self.client.stop()
+
+    def test_nobody_listening(self):
+        """Connecting to a closed port raises, not returns a closed socket"""
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        address = s.getsockname()
+        s.close()
+        self.assertRaises(socket.error, self.client._connect_inet,
+                          address, False, False)
+        self.assertRaises(socket.error, self.client.connect, address)
+
+class AsyncioTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = aio.LoopThread()
+        self.client = rpc.Client(PROG, 1)
+
+    def tearDown(self):
+        self.client.stop()
+        self.loop.stop()
+
+    def serve(self, handler, inline=False):
+        server = self.loop.run(aio.serve(handler, "127.0.0.1", 0, inline))
+        return ("127.0.0.1", server.sockets[0].getsockname()[1])
+
+    def test_async_client(self):
+        """Many calls outstanding on an AsyncClient, from a single thread"""
+        server = Echo(PROG, [1], 0, interface="127.0.0.1", workers=4)
+        start(server)
+        async def calls(address):
+            client = aio.AsyncClient(PROG, 1)
+            pipe = await client.connect(address)
+            xids = [await client.send_call(pipe, 1, b"%i" % i)
+                    for i in range(500)]
+            replies = await asyncio.gather(*[client.listen(pipe, xid, 20)
+                                             for xid in xids])
+            pipe.close()
+            return [bytes(data) for header, data in replies]
+        try:
+            got = asyncio.run(calls(("127.0.0.1", port(server))))
+        finally:
+            server.stop()
+        self.assertEqual(got, [b"%i" % i for i in range(500)])
+
+    def test_serve(self):
+        """A threaded client calls a server running on the event loop"""
+        for inline in (False, True):
+            with self.subTest(inline=inline):
+                server = Echo(PROG, [1], None, workers=2)
+                address = self.serve(server, inline)
+                pipe = self.client.connect(address)
+                data = [b"y" * 50000, b"", b"z"]
+                xids = [self.client.send_call(pipe, 1, d) for d in data]
+                for xid, d in zip(xids, data):
+                    self.assertEqual(bytes(pipe.listen(xid, 20)[1]), d)
+                # The blocking interface on an AsyncRpcPipe
+                pipe = self.loop.connect(address)
+                xid = self.client.send_call(pipe, 1, b"shim")
+                self.assertEqual(bytes(pipe.listen(xid, 20)[1]), b"shim")
+
+    def test_server_connects(self):
+        """A served handler opens its own connections on the event loop"""
+        target = Recording(PROG, [1], 0, interface="127.0.0.1")
+        start(target)
+        try:
+            server = Forwarding(PROG, [1], None, workers=1)
+            server.target = ("127.0.0.1", port(target))
+            pipe = self.client.connect(self.serve(server))
+            xid = self.client.send_call(pipe, 1, b'')
+            header, data = pipe.listen(xid, 20)
+            self.assertEqual(header.reply_data.stat, rpc.SUCCESS)
+            self.assertTrue(hasattr(target, "call_info"))
+        finally:
+            target.stop()
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Echo(PROG, [1], 0, interface="127.0.0.1", workers=2)
+        self.client = rpc.Client(PROG, 1)
+        start(self.server)
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_histogram(self):
+        """Small values are exact, larger ones kept to within about 6%"""
+        h = metrics.Histogram()
+        for value in range(1, 10001):
+            h.record(value)
+        self.assertEqual(h.count, 10000)
+        self.assertEqual(h.max, 10000)
+        for pct in (50, 90, 99):
+            exact = 100 * pct
+            self.assertLessEqual(abs(h.percentile(pct) - exact), exact * 0.07)
+        h = metrics.Histogram()
+        for value in (3, 3, 17):
+            h.record(value)
+        self.assertEqual(h.percentile(50), 3)
+        self.assertEqual(h.percentile(100), 17)
+        self.assertEqual(metrics.Histogram().percentile(99), 0)
+
+    def test_calls_and_drops(self):
+        """Each procedure's calls, drops and bytes are counted"""
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        for i in range(10):
+            xid = self.client.send_call(pipe, 1, b"x" * 100)
+            pipe.listen(xid, 20)
+        self.client.send_call(pipe, 2, b"")
+        def procs():
+            return dict((p["proc"], p) for p in
+                        self.server.metrics.snapshot()["procs"])
+        wait_for(lambda: procs().get(1, {}).get("calls") == 10 and
+                 procs().get(2, {}).get("calls") == 1)
+        echo, dropped = procs()[1], procs()[2]
+        self.assertEqual(echo["drops"], 0)
+        self.assertGreaterEqual(echo["request_bytes"], 10 * 100)
+        self.assertGreaterEqual(echo["reply_bytes"], 10 * 100)
+        self.assertEqual(echo["latency_us"]["count"], 10)
+        self.assertEqual(dropped["drops"], 1)
+        self.assertEqual(dropped["reply_bytes"], 0)
+
+    def test_dump(self):
+        """dump writes the snapshot as JSON"""
+        pipe = self.client.connect(("127.0.0.1", port(self.server)))
+        pipe.listen(self.client.send_call(pipe, 1, b""), 20)
+        wait_for(lambda: self.server.metrics.snapshot()["procs"])
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.server.metrics.dump(path)
+            with open(path) as f:
+                dumped = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual(dumped["procs"][0]["prog"], PROG)
+        self.assertEqual(dumped["procs"][0]["calls"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
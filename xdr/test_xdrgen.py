@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# test_xdrgen.py - Check the optional code generation modes of xdrgen
+#
+# Each mode must pack and unpack exactly as the plain generated code does.
+# Needs ply.  Run with "python3 -m pytest xdr/test_xdrgen.py", or
+# "python3 -m unittest test_xdrgen" from this directory.
+
+import contextlib
+import importlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import xdrgen
+
+SPEC = """
+const COUNT = 3;
+
+enum color {
+    RED = 0,
+    GREEN = 1,
+    BLUE = 2
+};
+
+typedef opaque blob<>;
+typedef unsigned counts<>;
+
+struct point {
+    int x;
+    unsigned y;
+    hyper z;
+    bool flag;
+    opaque tag[6];
+    uhyper w;
+};
+
+struct bag {
+    point where;
+    int fixed_ints[COUNT];
+    counts many;
+    hyper stamps<4>;
+    bool flags<>;
+    blob data;
+    string name<>;
+    point *next;
+    color shade;
+};
+
+union choice switch (unsigned which) {
+    case 0:
+        void;
+    case 1:
+        int i;
+    case 2:
+        hyper h;
+    case 3:
+        point p;
+    case 4:
+        blob b;
+    case 5:
+        counts c;
+    case 6:
+        color k;
+    case 7:
+        bag g;
+    default:
+        void;
+};
+"""
+
+# The options of each mode, beside the plain code with all of them off
+PLAIN = dict(fast_structs=False, union_tables=False, bulk_arrays=False)
+MODES = {
+    "fast_structs": dict(PLAIN, fast_structs=True),
+    "union_tables": dict(PLAIN, union_tables=True),
+    "bulk_arrays": dict(PLAIN, bulk_arrays=True),
+    "default": {},
+}
+
+def generate(dir, name, options):
+    """Generate the spec as package name in dir, returning its _pack module"""
+    pkg = os.path.join(dir, name)
+    os.mkdir(pkg)
+    open(os.path.join(pkg, "__init__.py"), "w").close()
+    with open(os.path.join(pkg, "spec.x"), "w") as f:
+        f.write(SPEC)
+    cwd = os.getcwd()
+    os.chdir(pkg)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            xdrgen.run("spec.x", **options)
+    finally:
+        os.chdir(cwd)
+    return importlib.import_module(name + ".spec_pack")
+
+def values(types):
+    """[(type name, value)] covering each kind of declaration"""
+    point = types.point(-5, 7, -(2**40), True, b"abcdef", 2**63)
+    bag = types.bag(point, [1, -2, 3], [4, 5, 2**32 - 1], [2**62, -1],
+                    [True, False], b"x" * 100, b"name", [point], 2)
+    empty = types.bag(types.point(0, 0, 0, False, b"\0" * 6, 0), [0, 0, 0],
+                      [], [], [], b"", b"", [], 0)
+    out = [("point", point), ("bag", bag), ("bag", empty)]
+    arms = [(0, None), (1, 42), (2, -(2**33)), (3, point), (4, b"blob"),
+            (5, [9, 8, 7]), (6, 1), (7, bag), (99, None)]
+    for which, value in arms:
+        choice = types.choice(which)
+        if which in (1, 2, 3, 4, 5, 6, 7):
+            setattr(choice, "ihpbckg"[which - 1], value)
+        out.append(("choice", choice))
+    return out
+
+def pack(module, name, value, **attrs):
+    p = module.SPECPacker()
+    for attr, x in attrs.items():
+        setattr(p, attr, x)
+    getattr(p, "pack_" + name)(value)
+    return p
+
+def unpack(module, name, data, **attrs):
+    u = module.SPECUnpacker(data)
+    for attr, x in attrs.items():
+        setattr(u, attr, x)
+    value = getattr(u, "unpack_" + name)()
+    u.done()
+    return value
+
+class GeneratedCodeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        sys.path.insert(0, cls.dir)
+        cls.plain = generate(cls.dir, "xdr_plain", PLAIN)
+        cls.modes = dict((mode, generate(cls.dir, "xdr_" + mode, options))
+                         for mode, options in MODES.items())
+        cls.values = values(cls.plain.types)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.dir)
+        shutil.rmtree(cls.dir)
+
+    def test_pack_as_plain(self):
+        """Each mode packs to the same bytes as the plain code"""
+        for mode, module in self.modes.items():
+            for name, value in self.values:
+                with self.subTest(mode=mode, type=name):
+                    self.assertEqual(
+                        pack(module, name, value).get_buffer(),
+                        pack(self.plain, name, value).get_buffer())
+
+    def test_round_trip(self):
+        """Each mode unpacks what it packed, as the plain code does"""
+        for mode, module in self.modes.items():
+            for name, value in self.values:
+                with self.subTest(mode=mode, type=name):
+                    data = pack(module, name, value).get_buffer()
+                    got = unpack(module, name, data)
+                    self.assertEqual(repr(got),
+                                     repr(unpack(self.plain, name, data)))
+                    self.assertEqual(pack(module, name, got).get_buffer(),
+                                     data)
+
+    def test_sizeof(self):
+        """sizeof_X(v) is the length pack_X(v) gives"""
+        for mode, module in self.modes.items():
+            for name, value in self.values:
+                with self.subTest(mode=mode, type=name):
+                    p = pack(module, name, value)
+                    self.assertEqual(getattr(p, "sizeof_" + name)(value),
+                                     len(p.get_buffer()))
+
+    def test_segment_min(self):
+        """Long opaques become segments of their own, not copies"""
+        module = self.modes["default"]
+        for name, value in self.values:
+            with self.subTest(type=name):
+                p = pack(module, name, value, segment_min=50)
+                self.assertEqual(b"".join(p.get_segments()),
+                                 pack(self.plain, name, value).get_buffer())
+        bag = self.values[1][1]
+        p = pack(module, "bag", bag, segment_min=50)
+        self.assertTrue(any(s is bag.data for s in p.get_segments()))
+
+    def test_opaque_view_min(self):
+        """Long opaques unpack as views of the data, short ones as bytes"""
+        module = self.modes["default"]
+        for name, value in self.values:
+            with self.subTest(type=name):
+                data = pack(module, name, value).get_buffer()
+                got = unpack(module, name, data, opaque_view_min=50)
+                self.assertEqual(pack(self.plain, name, got).get_buffer(),
+                                 data)
+        data = pack(module, "bag", self.values[1][1]).get_buffer()
+        got = unpack(module, "bag", data, opaque_view_min=50)
+        self.assertIsInstance(got.data, memoryview)
+        self.assertEqual(bytes(got.data), b"x" * 100)
+        self.assertIsInstance(got.name, bytes)
+
+if __name__ == "__main__":
+    unittest.main()
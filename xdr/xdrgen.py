@@ -221,6 +221,9 @@ except:
     from io import StringIO
 import time
 import os
+import struct
+import hashlib
+import compileall
 # Allow to be run stright from package
 if  __name__ == "__main__":
     if os.path.isfile(os.path.join(sys.path[0], 'lib', 'testmod.py')):
@@ -672,6 +675,193 @@ def id_unique(id, name, lineno):
     else:
         return True
 
+# struct codes for the primitive types, when packed on their own
+fixed_codes = {"int" : "l",
+               "uint" : "L",
+               "unsigned" : "L",
+               "hyper" : "q",
+               "uhyper" : "Q",
+               "float" : "f",
+               "double" : "d",
+               "bool" : "L",
+               }
+
+def const_value(value):
+    """Returns integer value of a constant or const name, or None"""
+    seen = set()
+    while value in name_dict and value not in seen:
+        seen.add(value)
+        info = name_dict[value]
+        if not isinstance(info, const_info):
+            return None
+        value = info.value
+    try:
+        if value.lower().startswith(("0x", "-0x")):
+            return int(value, 16)
+        if len(value) > 1 and value[0] == '0':
+            return int(value, 8)
+        return int(value)
+    except (AttributeError, ValueError):
+        return None
+
+def fixed_code(decl):
+    """Returns struct code for a declaration of fixed size, or None.
+
+    Only primitives and fixed length opaques qualify, looking through
+    typedefs.  A typedef with an array has its own pack_ method with a
+    filter hook, so is left alone unless filters are turned off.
+    """
+    if decl.array:
+        if decl.type != 'opaque' or not decl.fixed:
+            return None
+        size = const_value(decl.len)
+        if size is None or size < 0:
+            return None
+        pad = (4 - size % 4) % 4
+        return "%is%s" % (size, pad and "%ix" % pad or '')
+    return type_code(decl.type)
+
+def type_code(type):
+    """As fixed_code, but for a single value of the named type"""
+    if type in fixed_codes:
+        return fixed_codes[type]
+    typedef = name_dict.get(type, None)
+    if not isinstance(typedef, type_info):
+        # Either unknown, or an enum, struct or union
+        return None
+    if typedef.array and use_filters:
+        return None
+    return fixed_code(typedef)
+
+def element_code(decl):
+    """Returns struct code for one element of array decl, or None.
+
+    Such arrays are packed and unpacked in one go.  Arrays of bools are
+    left out, as each element must be made into True or False.
+    """
+    if not use_bulk_arrays or decl.type in ('opaque', 'string'):
+        return None
+    type = decl.type
+    while isinstance(name_dict.get(type, None), type_info) and \
+          not name_dict[type].array:
+        type = name_dict[type].type
+    if type == 'bool':
+        return None
+    return type_code(decl.type)
+
+def fixed_runs(body):
+    """Split declarations into runs that can be packed by one struct.
+
+    Returns a list of (format, declarations), where format is None for
+    declarations which must be packed one at a time.
+    """
+    runs = []
+    codes = []
+    decls = []
+    def flush():
+        if len(decls) > 1:
+            runs.append((">" + ''.join(codes), decls[:]))
+        else:
+            runs.extend([(None, [d]) for d in decls])
+        del codes[:], decls[:]
+    for decl in body:
+        code = None
+        if use_fixed_layouts and decl.type != 'void':
+            code = fixed_code(decl)
+        if code is None:
+            flush()
+            runs.append((None, [decl]))
+        else:
+            codes.append(code)
+            decls.append(decl)
+    flush()
+    return runs
+
+def fixed_layout(format):
+    """Returns the name of the module level struct.Struct for format"""
+    if format not in fixed_layouts:
+        fixed_layouts[format] = "_fixed_%s" % format[1:]
+    return fixed_layouts[format]
+
+def union_arms(union):
+    """Return [(case, declaration or None)] if union can use a dispatch table.
+
+    That needs enough cases to beat an if/elif chain, and every arm to be
+    void or a single named type, so it can be handled by one method call.
+    """
+    if not use_union_tables:
+        return None
+    arms = []
+    for l in union.body[1:-1]:
+        decl = None
+        for d in l.declarations:
+            if d.type == 'void':
+                continue
+            if decl is not None or d.array or \
+               d.type in ('struct', 'union', 'enum'):
+                return None
+            decl = d
+        arms += [(c, decl) for c in l.cases]
+    if len(arms) < union_table_min:
+        return None
+    return arms
+
+sizing = [] # Named types whose fixed_size is being worked out
+fixed_sizes = {"int" : 4,
+               "uint" : 4,
+               "unsigned" : 4,
+               "float" : 4,
+               "bool" : 4,
+               "hyper" : 8,
+               "uhyper" : 8,
+               "double" : 8,
+               "quadruple" : 8, # Packed as a double, see known_basics
+               "void" : 0,
+               }
+
+def fixed_size(decl):
+    """Returns the encoded size of decl if it is always the same, or None"""
+    if decl.array:
+        if not decl.fixed:
+            return None
+        count = const_value(decl.len)
+        if count is None or count < 0:
+            return None
+        if decl.type in ('opaque', 'string'):
+            return (count + 3) // 4 * 4
+        size = element_size(decl)
+        if size is None:
+            return None
+        return size * count
+    return element_size(decl)
+
+def element_size(decl):
+    """As fixed_size, but for a single element of an array decl"""
+    if decl.type in fixed_sizes:
+        return fixed_sizes[decl.type]
+    if decl.type == 'enum':
+        return 4
+    if decl.type == 'struct':
+        total = 0
+        for d in decl.body:
+            size = fixed_size(d)
+            if size is None:
+                return None
+            total += size
+        return total
+    info = name_dict.get(decl.type, None)
+    if info in sizing:
+        # A type containing itself can't be of fixed size
+        return None
+    if isinstance(info, (type_info, struct_info, enum_info)):
+        sizing.append(info)
+        try:
+            return fixed_size(info)
+        finally:
+            sizing.pop()
+    # Either unknown, or a union
+    return None
+
 class Case_Spec(object):
     def __init__(self, cases, declarations):
         self.cases = cases
@@ -740,6 +930,25 @@ class Info(object):
     def unpack_output(self):
         return None
 
+    def size_output(self):
+        return None
+
+    def _size_method(self, body):
+        """Wrap body, which adds to size, into a sizeof_ method"""
+        header = "%sdef sizeof_%s(self, data):\n" % (indent, self.id)
+        size = fixed_size(self)
+        if size is not None:
+            return header + "%sreturn %i\n" % (indent2, size)
+        start = "%ssize = 0\n" % indent2
+        first, rest = body.split('\n', 1)
+        if first.startswith(indent2 + "size += ") and \
+           first.split()[-1].isdigit():
+            # Start from the leading fixed size
+            start = first.replace("+=", "=") + '\n'
+            body = rest
+        return header + self._get_filter() + start + \
+               body + "%sreturn size\n" % indent2
+
     def _get_unpack_footer(self):
         footer = "%sreturn data\n" % indent2
         return self._get_filter() + footer
@@ -765,6 +974,16 @@ class Info(object):
         else:
             return "const." + value
 
+    def typeslots(self, varlist, prefix=indent):
+        if not use_slots:
+            return ''
+        names = []
+        for var in varlist:
+            if var.id not in names:
+                names.append(var.id)
+        return "%s__slots__ = (%s)\n\n" % \
+               (prefix, ''.join(["'%s', " % id for id in names]).rstrip())
+
     def typeinit(self, varlist, prefix=indent):
         initargs = ''.join([", %s=None" % var.id for var in varlist])
         initvars = ''.join(["%s%sself.%s = %s\n" % (prefix, indent, var.id, var.id)
@@ -876,7 +1095,28 @@ class Info(object):
 
     def packstruct(self, prefix, data='data'):
         prefix, data, subheader, array = self._array_pack(prefix, data)
-        pack = ''.join( [l.packout(prefix, data) for l in self.body] )
+        pack = ''
+        for format, decls in fixed_runs(self.body):
+            if format is None:
+                pack += ''.join( [l.packout(prefix, data) for l in decls] )
+                continue
+            # Out of range or None values make struct complain, in which
+            # case go field by field to raise the usual errors.
+            values = []
+            for l in decls:
+                value = "%s.%s" % (data, l.id)
+                if self._resolves_to_bool(l):
+                    # As xdrlib.Packer.pack_bool, but keeping the None check
+                    value = "(None if %s is None else 1 if %s else 0)" % \
+                            (value, value)
+                values.append(value)
+            pack += "%stry:\n" \
+                    "%s%sself._buf.write(%s.pack(%s))\n" \
+                    "%sexcept struct.error:\n" % \
+                    (prefix, prefix, indent, fixed_layout(format),
+                     ', '.join(values), prefix)
+            pack += ''.join( [l.packout(prefix + indent, data)
+                              for l in decls] )
         return subheader + pack + array
 
     def unpackstruct(self, prefix, data='data'):
@@ -885,14 +1125,71 @@ class Info(object):
             classname = "types.%s" % self.id
         else:
             classname = 'nullclass'
-        unpack = "%s%s = %s()\n" % (prefix, data, classname) + \
-                 ''.join( [l.unpackout(prefix, data) for l in self.body] )
+        unpack = "%s%s = %s()\n" % (prefix, data, classname)
+        for format, decls in fixed_runs(self.body):
+            if format is None:
+                unpack += ''.join( [l.unpackout(prefix, data) for l in decls] )
+                continue
+            size = struct.calcsize(format)
+            targets = ["%s.%s" % (data, l.id) for l in decls]
+            if len(targets) == 1:
+                targets[0] += ','
+            unpack += "%spos = self._pos\n" \
+                      "%sif pos + %i <= len(self._buf):\n" \
+                      "%s%s%s = %s.unpack_from(self._buf, pos)\n" % \
+                      (prefix, prefix, size, prefix, indent,
+                       ', '.join(targets), fixed_layout(format))
+            unpack += ''.join(["%s%s%s.%s = bool(%s.%s)\n" %
+                               (prefix, indent, data, l.id, data, l.id)
+                               for l in decls if self._resolves_to_bool(l)])
+            # Too short, so go field by field to raise the usual EOFError
+            unpack += "%s%sself._pos = pos + %i\n" \
+                      "%selse:\n" % (prefix, indent, size, prefix)
+            unpack += ''.join( [l.unpackout(prefix + indent, data)
+                                for l in decls] )
         return subheader + unpack + array
 
+    def _resolves_to_bool(self, decl):
+        """Is decl a bool, or a typedef of one?"""
+        while not decl.array:
+            if decl.type == 'bool':
+                return True
+            decl = name_dict.get(decl.type, None)
+            if not isinstance(decl, type_info):
+                break
+        return False
+
+    def arms_table(self, method, prefix=indent):
+        """Class attribute mapping each case to (attr, method name)
+
+        Void arms map to (), and the default arm is left out.
+        """
+        arms = union_arms(self)
+        if arms is None:
+            return ''
+        seen = []
+        items = ''
+        for case, decl in arms:
+            case = self.fullname(case)
+            if case in seen:
+                # As in the if/elif chain, the first arm wins
+                continue
+            seen.append(case)
+            if decl is None:
+                arm = "()"
+            else:
+                arm = "(%r, %r)" % (decl.id, "%s_%s" % (method, decl.type))
+            items += "%s%s%s: %s,\n" % (prefix, indent, case, arm)
+        return "%s_%s_%s_arms = {\n%s%s}\n\n" % \
+               (prefix, method, self.id, items, prefix)
+
     def packunion(self, prefix, data='data'):
         prefix, data, subheader, array = self._array_pack(prefix, data)
         switch = self.body[0].declarations[0]
         pack = switch.packout(prefix, data)
+        if isinstance(self, union_info) and union_arms(self) is not None:
+            return subheader + pack + self._packtable(prefix, data, switch) + \
+                   array
         first = ''
         for l in self.body[1:-1]:
             cases = ' or '.join(["%s.%s == %s" %
@@ -912,6 +1209,43 @@ class Info(object):
                     (prefix, indent, data, switch.id)
         return subheader + pack + array
 
+    def _packtable(self, prefix, data, switch):
+        """Pack the arm found in the table written by arms_table"""
+        pack = "%sarm = self._pack_%s_arms.get(%s.%s)\n" \
+               "%sif arm is None:\n" % \
+               (prefix, self.id, data, switch.id, prefix)
+        default = self.body[-1].declarations
+        if default != []:
+            pack += default[0].packout(prefix + indent, data)
+        else:
+            pack += "%s%sraise XDRError('bad switch=%%s' %% %s.%s)\n" % \
+                    (prefix, indent, data, switch.id)
+        pack += "%selif arm:\n" \
+                "%s%svalue = getattr(%s, arm[0])\n" \
+                "%s%sif value is None:\n" \
+                "%s%s%sraise TypeError('%s.%%s == None' %% arm[0])\n" \
+                "%s%sgetattr(self, arm[1])(value)\n" % \
+                (prefix, prefix, indent, data, prefix, indent,
+                 prefix, indent, indent, data, prefix, indent)
+        return pack
+
+    def _unpacktable(self, prefix, data, switch):
+        """Unpack the arm found in the table written by arms_table"""
+        unpack = "%sarm = self._unpack_%s_arms.get(%s.%s)\n" \
+                 "%sif arm is None:\n" % \
+                 (prefix, self.id, data, switch.id, prefix)
+        default = self.body[-1].declarations
+        if default != []:
+            unpack += ''.join( [d.unpackout(prefix + indent, data) \
+                                for d in default] )
+        else:
+            unpack += "%s%sraise XDRError('bad switch=%%s' %% %s.%s)\n" % \
+                      (prefix, indent, data, switch.id)
+        unpack += "%selif arm:\n" \
+                  "%s%ssetattr(%s, arm[0], getattr(self, arm[1])())\n" % \
+                  (prefix, prefix, indent, data)
+        return unpack
+
     def unpackunion(self, prefix, data='data'):
         prefix, data, subheader, array = self._array_unpack(prefix, data)
         if isinstance(self, union_info):
@@ -921,6 +1255,9 @@ class Info(object):
         unpack = "%s%s = %s()\n" % (prefix, data, classname)
         switch = self.body[0].declarations[0]
         unpack += switch.unpackout(prefix, data)
+        if isinstance(self, union_info) and union_arms(self) is not None:
+            return subheader + unpack + \
+                   self._unpacktable(prefix, data, switch) + array
         first = ''
         for l in self.body[1:-1]:
             cases = ' or '.join(["%s.%s == %s" %
@@ -955,6 +1292,82 @@ class Info(object):
 
         return subheader + unpack + array
 
+    def sizestruct(self, prefix, data='data'):
+        """Code which adds the encoded size of struct data to size"""
+        fixed = 0
+        size = ''
+        for l in self.body:
+            length = fixed_size(l)
+            if length is None:
+                size += l.sizeout(prefix, data)
+            else:
+                fixed += length
+        if fixed:
+            size = "%ssize += %i\n" % (prefix, fixed) + size
+        return size
+
+    def sizeunion(self, prefix, data='data'):
+        """Code which adds the encoded size of union data to size"""
+        switch = self.body[0].declarations[0]
+        size = switch.sizeout(prefix, data)
+        default = self.body[-1].declarations
+        if len(self.body) == 2:
+            # Only a default arm
+            inner = prefix
+        else:
+            inner = prefix + indent
+        if default != []:
+            other = default[0].sizeout(inner, data)
+        else:
+            other = "%sraise XDRError('bad switch=%%s' %% %s.%s)\n" % \
+                    (inner, data, switch.id)
+        if isinstance(self, union_info) and union_arms(self) is not None:
+            return size + "%sarm = self._sizeof_%s_arms.get(%s.%s)\n" \
+                   "%sif arm is None:\n%s" \
+                   "%selif arm:\n" \
+                   "%s%ssize += getattr(self, arm[1])(getattr(%s, arm[0]))\n" % \
+                   (prefix, self.id, data, switch.id, prefix, other,
+                    prefix, prefix, indent, data)
+        first = ''
+        for l in self.body[1:-1]:
+            cases = ' or '.join(["%s.%s == %s" %
+                                 (data, switch.id, self.fullname(c))
+                                 for c in l.cases])
+            size += "%s%sif %s:\n" % (prefix, first, cases)
+            size += ''.join( [d.sizeout(prefix + indent, data) \
+                              for d in l.declarations] )
+            first = 'el'
+        if first:
+            size += "%selse:\n" % prefix
+        return size + other
+
+    def sizearray(self, prefix, data='data'):
+        """Code which adds the encoded size of array data to size"""
+        if self.type == 'string' or self.type == 'opaque':
+            if self.fixed:
+                return "%ssize += (%s + 3) // 4 * 4\n" % \
+                       (prefix, self.fullname(self.len))
+            return "%ssize += 4 + (len(%s) + 3) // 4 * 4\n" % (prefix, data)
+        lead = (not self.fixed) and "4 + " or ""
+        length = element_size(self)
+        if length is not None:
+            return "%ssize += %s%i * len(%s)\n" % (prefix, lead, length, data)
+        if self.type in ('struct', 'union'):
+            # The element type has no sizeof_ method of its own
+            one = "sizeof_one_%s" % self.id
+            size = "%sdef %s(data):\n%s%ssize = 0\n" % \
+                   (prefix, one, prefix, indent)
+            if self.type == 'struct':
+                size += self.sizestruct(prefix + indent)
+            else:
+                size += self.sizeunion(prefix + indent)
+            size += "%s%sreturn size\n" % (prefix, indent)
+        else:
+            one = "self.sizeof_%s" % self.type
+            size = ''
+        return size + "%ssize += %ssum(map(%s, %s))\n" % \
+               (prefix, lead, one, data)
+
     def xdrbody(self, prefix=''):
         """Return xdr code for the body (part between braces) of big 3 types"""
         body = ''
@@ -1031,6 +1444,11 @@ class enum_info(Info):
         header = self._get_pack_header()
         return header + self.packenum(indent2)
 
+    def size_output(self):
+        if self.array:
+            return self._size_method(self.sizearray(indent2))
+        return self._size_method('')
+
     def unpack_output(self):
         header = "%sdef unpack_%s(self):\n" % (indent, self.id)
         return header + self.unpackenum(indent2) + \
@@ -1063,11 +1481,13 @@ class struct_info(Info):
         xdrdef = "%sXDR definition:\n%sstruct %s {\n%s%s};\n" % \
                  (comment, comment, self.id, xdrbody, comment)
         varlist = [l for l in self.body if l.type != 'void']
+        slots = self.typeslots(varlist)
         init = self.typeinit(varlist)
         repr = self.typerepr(varlist)
         pass_attr = self.pass_through(varlist)
-        return "class %s:\n%s%s\n%s%s\n" % \
-               (self.id, xdrdef, init, pass_attr, repr)
+        return "class %s%s:\n%s%s%s\n%s%s\n" % \
+               (self.id, slots and "(_slotted)", xdrdef, slots, init,
+                pass_attr, repr)
 
     def pass_through(self, varlist):
         def check(v):
@@ -1093,6 +1513,11 @@ class struct_info(Info):
         header = self._get_pack_header()
         return header + self.packstruct(indent2)
 
+    def size_output(self):
+        if self.array:
+            return self._size_method(self.sizearray(indent2))
+        return self._size_method(self.sizestruct(indent2))
+
     def unpack_output(self):
         header = "%sdef unpack_%s(self):\n" % (indent, self.id)
         return header + self.unpackstruct(indent2) + \
@@ -1159,20 +1584,28 @@ class union_info(Info):
         varlist = []
         for c in self.body:
             varlist += [l for l in c.declarations if l.type != 'void']
+        slots = self.typeslots(varlist)
         init = self.typeinit(varlist)
         repr = self.typerepr(varlist)
-        return "class %s:\n%s%s\n%s\n%s\n%s\n" % \
-               (self.id, xdrdef, init, self.union_switch(),
-                self.union_getattr(), repr)
+        return "class %s%s:\n%s%s%s\n%s\n%s\n%s\n" % \
+               (self.id, slots and "(_slotted)", xdrdef, slots, init,
+                self.union_switch(), self.union_getattr(), repr)
 
     def pack_output(self):
         header = self._get_pack_header()
-        return header + self.packunion(indent2)
+        return self.arms_table("pack") + header + self.packunion(indent2)
+
+    def size_output(self):
+        if self.array:
+            size = self.sizearray(indent2)
+        else:
+            size = self.sizeunion(indent2)
+        return self.arms_table("sizeof") + self._size_method(size)
 
     def unpack_output(self):
         header = "%sdef unpack_%s(self):\n" % (indent, self.id)
-        return header + self.unpackunion(indent2) + \
-               self._get_unpack_footer()
+        return self.arms_table("unpack") + header + \
+               self.unpackunion(indent2) + self._get_unpack_footer()
 
 class type_info(Info):
     def __init__(self, type, lineno=None, body=None):
@@ -1264,6 +1697,21 @@ class type_info(Info):
                    (prefix, data, self.id, self.type)
         return self._unpack_array(prefix, "%s.%s" % (data, self.id))
 
+    def sizeout(self, prefix='', data='data'):
+        value = "%s.%s" % (data, self.id)
+        size = fixed_size(self)
+        if self.type == 'void':
+            return prefix + 'pass\n'
+        elif size is not None:
+            return "%ssize += %i\n" % (prefix, size)
+        elif self.array:
+            return self.sizearray(prefix, value)
+        elif self.type == 'struct':
+            return self.sizestruct(prefix, value)
+        elif self.type == 'union':
+            return self.sizeunion(prefix, value)
+        return "%ssize += self.sizeof_%s(%s)\n" % (prefix, self.type, value)
+
     def type_output(self):
         if not self.array:
             # XXX BUG this needs to be thought out better - probably need to
@@ -1282,6 +1730,11 @@ class type_info(Info):
         header = self._get_pack_header()
         return header + self._pack_array(indent2)
 
+    def size_output(self):
+        if not self.array:
+            return "%ssizeof_%s = sizeof_%s\n" % (indent, self.id, self.type)
+        return self._size_method(self.sizearray(indent2))
+
     def unpack_output(self):
         if not self.array:
             return "%sunpack_%s = unpack_%s\n" % (indent, self.id, self.type)
@@ -1311,6 +1764,15 @@ class type_info(Info):
 
         pack = "%sself.pack_%s%s(%s%s%s)\n" % \
                (prefix, fixchar, type, fixnum, data, packer)
+        bulk = self._bulk_format("len(%s)" % data)
+        if bulk is not None:
+            # As for fixed layouts, let the basic pack methods raise the usual errors
+            count = not self.fixed and "len(%s), " % data or ''
+            pack = "%stry:\n" \
+                   "%s%sself._buf.write(%s.pack(%s%s*%s))\n" \
+                   "%sexcept struct.error:\n%s" % \
+                   (prefix, prefix, indent, bulk[0], bulk[1], count, data,
+                    prefix, indent + pack)
         return limit + pack
 
     def _unpack_array(self, prefix, data='data'):
@@ -1334,10 +1796,54 @@ class type_info(Info):
             type = 'array'
             packer = ["self.unpack_%s" % self.type]
 
-        pack = "%s%s = self.unpack_%s%s(%s)\n" % \
-               (prefix, data, fixchar, type, ', '.join(fixnum+packer))
+        bulk = self._bulk_format('n', unpack=True)
+        if bulk is not None:
+            size = struct.calcsize(">" + element_code(self))
+            if self.fixed:
+                count = "%sn = %s\n" % (prefix, self.fullname(self.len))
+            else:
+                count = "%sn = self.unpack_uint()\n" % prefix
+            # Too short, so go element by element to raise the usual EOFError
+            pack = "%s" \
+                   "%spos = self._pos\n" \
+                   "%sif pos + n * %i <= len(self._buf):\n" \
+                   "%s%s%s = list(%s.unpack_from(%s" \
+                   "self._buf, pos))\n" \
+                   "%s%sself._pos = pos + n * %i\n" \
+                   "%selse:\n" \
+                   "%s%s%s = self.unpack_farray(n, %s)\n" % \
+                   (count, prefix, prefix, size,
+                    prefix, indent, data, bulk[0], bulk[1],
+                    prefix, indent, size, prefix,
+                    prefix, indent, data, packer[0])
+        else:
+            pack = "%s%s = self.unpack_%s%s(%s)\n" % \
+                   (prefix, data, fixchar, type, ', '.join(fixnum+packer))
         return pack + limit
 
+    def _bulk_format(self, count, unpack=False):
+        """Returns (struct, format argument) handling the whole array at
+        once, or None if it is not an array of primitives.  count is the
+        expression for the length of a variable length array, which when
+        packing goes first.
+        """
+        code = element_code(self)
+        if code is None:
+            return None
+        length = not self.fixed and not unpack and "L" or ''
+        if self.fixed:
+            count = const_value(self.len)
+            if count is None or count < 0:
+                return None
+            if len(code) > 1:
+                code *= count
+            else:
+                code = "%i%s" % (count, code)
+            return fixed_layout(">" + code), ''
+        if len(code) == 1:
+            return "struct", "'>%s%%i%s' %% %s, " % (length, code, count)
+        return "struct", "'>%s' + '%s' * %s, " % (length, code, count)
+
 
 
 ##########################################################################
@@ -1353,8 +1859,22 @@ use_filters = True  # Option which causes hooks to be generated which
 allow_attr_passthrough = True # Option which allows substructure attrs to
                               # be referenced directly, in cases where there
                               # is a unique substructure to search.
+use_fixed_layouts = True # Option which packs runs of fixed size struct
+                         # fields with a single struct.Struct call
+use_slots = False # Option which gives struct and union classes __slots__,
+                  # so instances have no __dict__.  This saves memory when
+                  # holding many of them, but no other attributes can then
+                  # be set on them.
+use_union_tables = True # Option which dispatches on union discriminants
+                        # with a dict, instead of an if/elif chain
+union_table_min = 8 # Fewest cases for which a union gets a dispatch table
+use_bulk_arrays = True # Option which packs and unpacks arrays of fixed
+                       # size primitives with one struct call
+fixed_layouts = {} # {struct format: name}, of the layouts used so far
 pack_header = """\
 import sys,os
+import struct
+from io import BytesIO
 from . import %s as const
 from . import %s as types
 
@@ -1370,23 +1890,237 @@ class nullclass(object):
 
 """
 
-pack_init = """\
-class %sPacker(xdrlib.Packer):
-%sdef __init__(self, check_enum=True, check_array=True):
-%sxdrlib.Packer.__init__(self)
-%sself.check_enum = check_enum
-%sself.check_array = check_array
+slotted_header = """\
+class _slotted(object):
+    # Pickle and copy support for classes using __slots__
+    __slots__ = ()
 
-""" % ("%s", indent, indent2, indent2, indent2)
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
 
-unpack_init = """\
-class %sUnpacker(xdrlib.Unpacker):
-%sdef __init__(self, data, check_enum=True, check_array=True):
-%sxdrlib.Unpacker.__init__(self, data)
-%sself.check_enum = check_enum
-%sself.check_array = check_array
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+
+"""
 
-""" % ("%s", indent, indent2, indent2, indent2)
+pack_init = """\
+class %(name)sPacker(xdrlib.Packer):
+%(i1)s# The buffer is our own BytesIO rather than xdrlib's private one, so
+%(i1)s# generated code can write to it.  So every xdrlib.Packer method which
+%(i1)s# touches the buffer is replaced here.
+
+%(i1)s# Strings and opaques at least this long are not copied into the
+%(i1)s# buffer, but kept as they are, as segments of their own.  See
+%(i1)s# get_segments.  The caller must not change them until sent.
+%(i1)ssegment_min = None
+
+%(i1)sdef __init__(self, check_enum=True, check_array=True):
+%(i2)sself.reset()
+%(i2)sself.check_enum = check_enum
+%(i2)sself.check_array = check_array
+
+%(i1)sdef reset(self):
+%(i2)sself._buf = BytesIO()
+%(i2)sself._segments = []
+
+%(i1)sdef get_buffer(self):
+%(i2)sif not self._segments:
+%(i2)s%(i1)sreturn self._buf.getvalue()
+%(i2)sreturn b''.join(self.get_segments())
+
+%(i1)sget_buf = get_buffer
+
+%(i1)sdef get_segments(self):
+%(i2)s# The packed data as a list of buffers, which can be sent as they are
+%(i2)sreturn self._segments + [self._buf.getvalue()]
+
+%(i1)sdef pack_uint(self, x):
+%(i2)stry:
+%(i2)s%(i1)sself._buf.write(struct.pack('>L', x))
+%(i2)sexcept struct.error as e:
+%(i2)s%(i1)sraise xdrlib.ConversionError(e.args[0]) from None
+
+%(i1)sdef pack_int(self, x):
+%(i2)stry:
+%(i2)s%(i1)sself._buf.write(struct.pack('>l', x))
+%(i2)sexcept struct.error as e:
+%(i2)s%(i1)sraise xdrlib.ConversionError(e.args[0]) from None
+
+%(i1)spack_enum = pack_int
+
+%(i1)sdef pack_bool(self, x):
+%(i2)sif x: self._buf.write(b'\\0\\0\\0\\1')
+%(i2)selse: self._buf.write(b'\\0\\0\\0\\0')
+
+%(i1)sdef pack_uhyper(self, x):
+%(i2)stry:
+%(i2)s%(i1)sself.pack_uint(x >> 32 & 0xffffffff)
+%(i2)s%(i1)sself.pack_uint(x & 0xffffffff)
+%(i2)sexcept TypeError as e:
+%(i2)s%(i1)sraise xdrlib.ConversionError(e.args[0]) from None
+
+%(i1)spack_hyper = pack_uhyper
+
+%(i1)sdef pack_float(self, x):
+%(i2)stry:
+%(i2)s%(i1)sself._buf.write(struct.pack('>f', x))
+%(i2)sexcept struct.error as e:
+%(i2)s%(i1)sraise xdrlib.ConversionError(e.args[0]) from None
+
+%(i1)sdef pack_double(self, x):
+%(i2)stry:
+%(i2)s%(i1)sself._buf.write(struct.pack('>d', x))
+%(i2)sexcept struct.error as e:
+%(i2)s%(i1)sraise xdrlib.ConversionError(e.args[0]) from None
+
+%(i1)sdef pack_fstring(self, n, s):
+%(i2)s# As xdrlib, but also takes a memoryview or other buffer, uncopied
+%(i2)sif n < 0:
+%(i2)s%(i1)sraise ValueError('fstring size must be nonnegative')
+%(i2)sdata = s[:n]
+%(i2)sif self.segment_min is not None and len(data) >= self.segment_min:
+%(i2)s%(i1)sself._segments += [self._buf.getvalue(), data]
+%(i2)s%(i1)sself._buf = BytesIO()
+%(i2)selse:
+%(i2)s%(i1)sself._buf.write(data)
+%(i2)sself._buf.write(((n + 3) // 4 * 4 - len(data)) * b'\\0')
+
+%(i1)spack_fopaque = pack_fstring
+
+%(i1)sdef pack_string(self, s):
+%(i2)sn = len(s)
+%(i2)sself.pack_uint(n)
+%(i2)sself.pack_fstring(n, s)
+
+%(i1)spack_opaque = pack_bytes = pack_string
+
+%(i1)s# The sizeof_ methods return the length data would be packed to,
+%(i1)s# without packing it.  These are for the basic types.
+%(i1)sdef sizeof_int(self, data):
+%(i2)sreturn 4
+
+%(i1)sdef sizeof_hyper(self, data):
+%(i2)sreturn 8
+
+%(i1)sdef sizeof_opaque(self, data):
+%(i2)sreturn 4 + (len(data) + 3) // 4 * 4
+
+%(i1)ssizeof_uint = sizeof_unsigned = sizeof_float = sizeof_bool = sizeof_int
+%(i1)ssizeof_uhyper = sizeof_double = sizeof_quadruple = sizeof_hyper
+%(i1)ssizeof_string = sizeof_opaque
+
+""" % {"name": "%s", "i1": indent, "i2": indent2}
+
+unpack_init = """\
+class %(name)sUnpacker(xdrlib.Unpacker):
+%(i1)s# As for the Packer, the data and position are our own rather than
+%(i1)s# xdrlib's, and every xdrlib.Unpacker method using them is replaced.
+
+%(i1)s# Variable length opaques at least this long are returned as memoryview
+%(i1)s# slices of the data being unpacked, rather than as copies.  The caller
+%(i1)s# must then be happy with the views keeping that data alive.
+%(i1)sopaque_view_min = None
+
+%(i1)sdef __init__(self, data, check_enum=True, check_array=True):
+%(i2)sself.reset(data)
+%(i2)sself.check_enum = check_enum
+%(i2)sself.check_array = check_array
+
+%(i1)sdef reset(self, data):
+%(i2)sself._buf = data
+%(i2)sself._pos = 0
+
+%(i1)sdef get_position(self):
+%(i2)sreturn self._pos
+
+%(i1)sdef set_position(self, position):
+%(i2)sself._pos = position
+
+%(i1)sdef get_buffer(self):
+%(i2)sreturn self._buf
+
+%(i1)sdef done(self):
+%(i2)sif self._pos < len(self._buf):
+%(i2)s%(i1)sraise XDRError('unextracted data remains')
+
+%(i1)sdef unpack_uint(self):
+%(i2)si = self._pos
+%(i2)sself._pos = j = i + 4
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sreturn struct.unpack_from('>L', self._buf, i)[0]
+
+%(i1)sdef unpack_int(self):
+%(i2)si = self._pos
+%(i2)sself._pos = j = i + 4
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sreturn struct.unpack_from('>l', self._buf, i)[0]
+
+%(i1)sunpack_enum = unpack_int
+
+%(i1)sdef unpack_bool(self):
+%(i2)sreturn bool(self.unpack_int())
+
+%(i1)sdef unpack_uhyper(self):
+%(i2)si = self._pos
+%(i2)sself._pos = j = i + 8
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sreturn struct.unpack_from('>Q', self._buf, i)[0]
+
+%(i1)sdef unpack_hyper(self):
+%(i2)si = self._pos
+%(i2)sself._pos = j = i + 8
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sreturn struct.unpack_from('>q', self._buf, i)[0]
+
+%(i1)sdef unpack_float(self):
+%(i2)si = self._pos
+%(i2)sself._pos = j = i + 4
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sreturn struct.unpack_from('>f', self._buf, i)[0]
+
+%(i1)sdef unpack_double(self):
+%(i2)si = self._pos
+%(i2)sself._pos = j = i + 8
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sreturn struct.unpack_from('>d', self._buf, i)[0]
+
+%(i1)sdef unpack_fstring(self, n):
+%(i2)s# As xdrlib, but always returns bytes, even if data is a memoryview
+%(i2)sif n < 0:
+%(i2)s%(i1)sraise ValueError('fstring size must be nonnegative')
+%(i2)si = self._pos
+%(i2)sj = i + (n + 3) // 4 * 4
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sself._pos = j
+%(i2)sreturn bytes(self._buf[i:i + n])
+
+%(i1)sunpack_fopaque = unpack_fstring
+
+%(i1)sdef unpack_string(self):
+%(i2)sreturn self.unpack_fstring(self.unpack_uint())
+
+%(i1)sunpack_bytes = unpack_string
+
+%(i1)sdef unpack_opaque(self):
+%(i2)sn = self.unpack_uint()
+%(i2)sif self.opaque_view_min is None or n < self.opaque_view_min:
+%(i2)s%(i1)sreturn self.unpack_fstring(n)
+%(i2)si = self._pos
+%(i2)sj = i + (n + 3) // 4 * 4
+%(i2)sif j > len(self._buf):
+%(i2)s%(i1)sraise EOFError
+%(i2)sself._pos = j
+%(i2)sreturn memoryview(self._buf)[i:i + n]
+
+""" % {"name": "%s", "i1": indent, "i2": indent2}
 
 known_basics = {"int" : "pack_int",
                 #"enum" : "pack_enum",
@@ -1402,16 +2136,59 @@ known_basics = {"int" : "pack_int",
                 "bool" : "pack_bool",
                 "opaque": "pack_opaque",
                 "string": "pack_string"}
-packer_start = ''.join(["%spack_%s = xdrlib.Packer.%s\n" % (indent, k, v)
-                        for k, v in known_basics.items()])
+# The basics themselves are defined in pack_init and unpack_init
+packer_start = ''.join(["%spack_%s = %s\n" % (indent, k, v)
+                        for k, v in known_basics.items() if k != v[5:]])
+unpacker_start = ''.join(["%sunpack_%s = un%s\n" % (indent, k, v)
+                          for k, v in known_basics.items() if k != v[5:]])
+
+stamp_prefix = "# xdrgen stamp: " # Second line of each generated file
+
+def output_stamp(data, options):
+    """A hash of the .x file data, this generator and the options used"""
+    h = hashlib.sha1()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    h.update(data.encode())
+    h.update(repr(sorted(options.items())).encode())
+    return h.hexdigest()
+
+def read_stamp(filename):
+    """The stamp of a previously generated file, or None"""
+    try:
+        with open(filename) as f:
+            f.readline()
+            line = f.readline()
+    except IOError:
+        return None
+    if not line.startswith(stamp_prefix):
+        return None
+    return line[len(stamp_prefix):].strip()
 
-unpacker_start = ''.join(["%sunpack_%s = xdrlib.Unpacker.un%s\n" % (indent, k, v)
-                          for k, v in known_basics.items()])
+def compile_output(files):
+    """Byte compile the generated files, unless already done.
 
-def run(infile, filters=True, pass_attrs=True, debug=False):
-    global use_filters, allow_attr_passthrough
+    They are large enough that compiling them can take most of the startup
+    time of a tool, so doing it here saves that where the tool is run
+    without write access to the tree, or with PYTHONDONTWRITEBYTECODE.
+    """
+    for file in files:
+        compileall.compile_file(file, quiet=1)
+
+def run(infile, filters=True, pass_attrs=True, debug=False,
+        fast_structs=True, slots=False, union_tables=True, bulk_arrays=True,
+        force=False):
+    options = dict(filters=filters, pass_attrs=pass_attrs,
+                   fast_structs=fast_structs, slots=slots,
+                   union_tables=union_tables, bulk_arrays=bulk_arrays)
+    global use_filters, allow_attr_passthrough, use_fixed_layouts, use_slots
+    global use_union_tables, use_bulk_arrays
     use_filters = filters
     allow_attr_passthrough = pass_attrs
+    use_fixed_layouts = fast_structs
+    use_slots = slots
+    use_union_tables = union_tables
+    use_bulk_arrays = bulk_arrays
     print("Input file is", infile)
 
     # Create output file names (without .py)
@@ -1422,13 +2199,25 @@ def run(infile, filters=True, pass_attrs=True, debug=False):
     packer_file = name_base + "_pack"
     print("Will use output files %s.py, %s.py, and %s.py" % \
           (constants_file, types_file, packer_file))
+    outputs = [name + ".py" for name in
+               (constants_file, types_file, packer_file)]
 
-    # Parse the input data with yacc
-    global name_dict
-    name_dict = {}
     f = open(infile)
     data = f.read()
     f.close()
+    # Leave the output alone if generated from the same input, by the
+    # same version of this file, with the same options.
+    stamp = output_stamp(data, options)
+    if not force and \
+       all([read_stamp(name) == stamp for name in outputs]):
+        print("Output files are up to date")
+        compile_output(outputs)
+        return
+
+    # Parse the input data with yacc
+    global name_dict, fixed_layouts
+    name_dict = {}
+    fixed_layouts = {}
     import ply.yacc as yacc
     yacc.yacc()
     yacc.parse(data, debug=debug)
@@ -1438,18 +2227,18 @@ def run(infile, filters=True, pass_attrs=True, debug=False):
         print("Error occurred, did not write output files")
         return 1
 
-    comment_string = "# Generated by rpcgen.py from %s on %s\n" % \
-                     (infile, time.asctime())
+    comment_string = "# Generated by rpcgen.py from %s on %s\n%s%s\n" % \
+                     (infile, time.asctime(), stamp_prefix, stamp)
     const_fd = open(constants_file + ".py", "w")
     const_fd.write(comment_string)
     type_fd = open(types_file + ".py", "w")
     type_fd.write(comment_string)
     type_fd.write("import sys,os\nfrom . import %s as const\n" % constants_file)
-    pack_fd = open(packer_file + ".py", "w")
-    pack_fd.write(comment_string)
-    pack_fd.write(pack_header % (constants_file, types_file))
-    pack_fd.write(pack_init % name_base.upper())
-    pack_fd.write(packer_start)
+    if use_slots:
+        type_fd.write("\n" + slotted_header)
+    # The packers are collected first, since they add to fixed_layouts,
+    # which must be written above them
+    pack_out = [pack_init % name_base.upper(), packer_start]
 
     type_list = sorted(name_dict.values())
     for value in type_list:
@@ -1464,31 +2253,53 @@ def run(infile, filters=True, pass_attrs=True, debug=False):
             type_fd.write(output)
         output = value.pack_output()
         if output is not None:
-            #pack_fd.write("# **** %s %s %s****\n" % (value.id, value.lineno, value.sortno))
-            pack_fd.write(output)
-            pack_fd.write('\n')
-    pack_fd.write(unpack_init % name_base.upper())
-    pack_fd.write(unpacker_start)
+            #pack_out.append("# **** %s %s %s****\n" % (value.id, value.lineno, value.sortno))
+            pack_out.append(output)
+            pack_out.append('\n')
+        output = value.size_output()
+        if output is not None:
+            pack_out.append(output)
+            pack_out.append('\n')
+    pack_out.append(unpack_init % name_base.upper())
+    pack_out.append(unpacker_start)
     for value in type_list:
         output = value.unpack_output()
         if output is not None:
-            pack_fd.write(output)
-            pack_fd.write('\n')
+            pack_out.append(output)
+            pack_out.append('\n')
+
+    pack_fd = open(packer_file + ".py", "w")
+    pack_fd.write(comment_string)
+    pack_fd.write(pack_header % (constants_file, types_file))
+    if fixed_layouts:
+        pack_fd.write("# Runs of fixed size fields, packed with one call\n")
+        for format, name in sorted(fixed_layouts.items(), key=lambda x: x[1]):
+            pack_fd.write("%s = struct.Struct(%r)\n" % (name, format))
+        pack_fd.write('\n')
+    pack_fd.write(''.join(pack_out))
 
     const_fd.close()
     type_fd.close()
     pack_fd.close()
+    compile_output(outputs)
     return
 
 #
 # Section: main
 #
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: %s <filename>" % sys.argv[0])
+    args = sys.argv[1:]
+    slots = "--slots" in args
+    if slots:
+        args.remove("--slots")
+    force = "--force" in args
+    if force:
+        args.remove("--force")
+    if len(args) != 1:
+        print("Usage: %s [--slots] [--force] <filename>" % sys.argv[0])
         sys.exit(1)
 
-    run(sys.argv[1])
+    run(args[0], slots=slots, force=force)
 
 # Local variables:
 # py-indent-offset: 4